@@ -36,6 +36,10 @@ LLM_CONFIG = {
         "smart": {"provider": "google", "model_name": "gemini-1.5-pro-latest"},
         # (يمكن إضافة OpenAI أو Claude هنا إذا كانت المفاتيح متوفرة)
         # "smart_openai": {"provider": "openai", "model_name": "gpt-4o"},
+    },
+    # حدود كل مزود (طلبات/دقيقة، tokens/دقيقة، طلبات متزامنة) - الافتراضي من LLM_RPM_<PROVIDER> ...
+    "rate_limits": {
+        # "google": {"rpm": 60, "tpm": 1000000, "max_concurrency": 8},
     }
 }
 
@@ -0,0 +1,138 @@
+import json
+import logging
+import os
+from datetime import date, datetime
+from typing import Any, Optional
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:  # (اختياري)
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:  # (اختياري)
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # (اختياري - بدونه لا يُضغط شيء)
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+def _to_builtin(value: Any) -> Any:
+    """
+    تحويل الأنواع غير القياسية (numpy / datetime) لأنواع يفهمها أي مفكك.
+    أي نوع آخر يرفع TypeError بدلاً من تخزين str(value) بصمت (فقدان بيانات).
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (set, tuple)):
+        return list(value)
+    raise TypeError(f"CacheCodec: نوع غير قابل للترميز: {type(value).__name__}")
+
+class CacheCodec:
+    """
+    ترميز قيم الكاش بصيغة محايدة بدلاً من pickle (أسرع، أصغر، وآمنة للقراءة
+    من Redis مشترك، ويمكن لخدمات أخرى مثل المنصة الأكاديمية قراءتها).
+
+    صيغة القيمة المخزنة:
+        البايت 0: نسخة الصيغة (FORMAT_VERSION)
+        البايت 1: المرمّز (1=msgpack، 2=orjson/json - كلاهما JSON UTF-8)
+        البايت 2: الأعلام (bit 0 = مضغوط بـ zstd)
+        الباقي:  الحمولة
+
+    القيم التي لا تطابق هذه الصيغة (مثل pickle قديم) تُعامل كإخفاق ولا تُفك أبداً.
+    """
+
+    FORMAT_VERSION = 1
+    CODEC_MSGPACK = 1
+    CODEC_JSON = 2
+    FLAG_ZSTD = 0x01
+    HEADER_SIZE = 3
+
+    def __init__(self,
+                 codec: Optional[str] = None,
+                 compress_threshold: Optional[int] = None,
+                 compression_level: int = 3):
+        """
+        Args:
+            codec: "msgpack" | "orjson" | "json" (الافتراضي من CACHE_CODEC، ثم أفضل المتاح).
+            compress_threshold: حجم الحمولة (بايت) الذي يبدأ عنده الضغط بـ zstd.
+            compression_level: مستوى ضغط zstd.
+        """
+        codec = (codec or os.getenv("CACHE_CODEC", "")).strip().lower()
+        if not codec:
+            codec = "msgpack" if msgpack else ("orjson" if orjson else "json")
+        if codec == "msgpack" and not msgpack:
+            logger.warning("⚠️ CacheCodec: msgpack غير مثبت، استخدام JSON")
+            codec = "orjson" if orjson else "json"
+        if codec == "orjson" and not orjson:
+            codec = "json"
+        self.codec = codec
+        self.codec_id = self.CODEC_MSGPACK if codec == "msgpack" else self.CODEC_JSON
+
+        if compress_threshold is None:
+            compress_threshold = int(os.getenv("CACHE_COMPRESS_THRESHOLD", "4096"))
+        self.compress_threshold = compress_threshold
+        self._compressor = zstandard.ZstdCompressor(level=compression_level) if zstandard else None
+        self._decompressor = zstandard.ZstdDecompressor() if zstandard else None
+
+    # ------------------------------------------------------------------
+    def _serialize(self, value: Any) -> bytes:
+        if self.codec_id == self.CODEC_MSGPACK:
+            return msgpack.packb(value, default=_to_builtin, use_bin_type=True)
+        if orjson:
+            # (OPT_NON_STR_KEYS: مفاتيح القواميس غير النصية تُحول لنص كما يفعل json)
+            return orjson.dumps(value, default=_to_builtin,
+                                option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+        return json.dumps(value, default=_to_builtin, ensure_ascii=False).encode('utf-8')
+
+    @staticmethod
+    def _deserialize(codec_id: int, payload: bytes) -> Any:
+        if codec_id == CacheCodec.CODEC_MSGPACK:
+            if not msgpack:
+                raise ValueError("قيمة msgpack بدون مكتبة msgpack")
+            # (strict_map_key=False: مفاتيح القواميس الرقمية تبقى أرقاماً كما خُزنت)
+            return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+        if codec_id == CacheCodec.CODEC_JSON:
+            return orjson.loads(payload) if orjson else json.loads(payload.decode('utf-8'))
+        raise ValueError(f"مرمّز غير معروف: {codec_id}")
+
+    # ------------------------------------------------------------------
+    def encode(self, value: Any) -> bytes:
+        """ترميز قيمة (مع ضغط zstd إذا تجاوزت الحد)"""
+        payload = self._serialize(value)
+        flags = 0
+        if self._compressor and len(payload) >= self.compress_threshold:
+            compressed = self._compressor.compress(payload)
+            if len(compressed) < len(payload):
+                payload, flags = compressed, flags | self.FLAG_ZSTD
+        return bytes((self.FORMAT_VERSION, self.codec_id, flags)) + payload
+
+    def decode(self, data: bytes) -> Any:
+        """فك قيمة مخزنة؛ يرفع ValueError إذا لم تكن بالصيغة المعروفة"""
+        if not data or len(data) < self.HEADER_SIZE or data[0] != self.FORMAT_VERSION:
+            raise ValueError("صيغة كاش غير معروفة (ربما pickle قديم)")
+        codec_id, flags = data[1], data[2]
+        payload = data[self.HEADER_SIZE:]
+        if flags & self.FLAG_ZSTD:
+            if not self._decompressor:
+                raise ValueError("قيمة مضغوطة بـ zstd بدون مكتبة zstandard")
+            payload = self._decompressor.decompress(payload)
+        return self._deserialize(codec_id, payload)
+
+    def describe(self) -> dict:
+        return {
+            "codec": self.codec,
+            "format_version": self.FORMAT_VERSION,
+            "compression": "zstd" if self._compressor else None,
+            "compress_threshold": self.compress_threshold,
+        }
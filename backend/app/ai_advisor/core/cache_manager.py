@@ -1,101 +1,377 @@
+import asyncio
 import logging
-import pickle
-from typing import Any, Optional
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 import os
 
+from .cache_codec import CacheCodec
+
 logger = logging.getLogger(__name__)
 
 class CacheManager:
     """
-    مدير كاش مرن - يعمل مع Redis أو بديل في الذاكرة
+    مدير كاش بطبقتين:
+
+    1. طبقة في الذاكرة (LRU) محدودة بعدد العناصر وبالحجم (بايت)، مع TTL لكل مفتاح.
+       تحفظ القيمة مرمّزة مثل Redis وتُفك عند كل قراءة: نفس الأنواع أياً كانت الطبقة
+       التي أجابت، ولا يتشارك الطلبات كائناً قابلاً للتعديل.
+    2. Redis (مشترك بين العمليات) - عند فشله نتوقف عن استخدامه مؤقتاً ونعيد
+       المحاولة بمهلة متزايدة (Backoff) بدلاً من تعطيله نهائياً.
+
+    كما يمنع تكرار الحساب لنفس المفتاح (Single-Flight) عبر get_or_set،
+    ويحتفظ بعدادات إصابة/إخفاق/إزاحة لكل بادئة مفتاح.
+
+    القيم في Redis مرمّزة عبر CacheCodec (msgpack/JSON مع zstd اختياري)
+    وليس pickle، فلا يُنفذ أي كود عند قراءة قيمة من Redis مشترك.
     """
-    
-    def __init__(self, redis_url: str):
+
+    # البادئات المعروفة لعدادات الإحصائيات (أي مفتاح آخر يُحسب تحت "other")
+    KEY_PREFIXES = ("rag_answer:", "rerank:", "translate:", "analyze:", "llm_response:")
+
+    MEMORY_MAX_ITEMS = int(os.getenv("CACHE_MEMORY_MAX_ITEMS", "10000"))
+    MEMORY_MAX_BYTES = int(os.getenv("CACHE_MEMORY_MAX_BYTES", str(64 * 1024 * 1024)))
+    # أقصى مدة بقاء في الذاكرة (تحد من قِدم البيانات بين العمليات عند وجود Redis)
+    MEMORY_MAX_TTL = int(os.getenv("CACHE_MEMORY_MAX_TTL", "300"))
+
+    RECONNECT_BASE_DELAY = 1.0
+    RECONNECT_MAX_DELAY = 60.0
+
+    def __init__(self, redis_url: str,
+                 memory_max_items: int = MEMORY_MAX_ITEMS,
+                 memory_max_bytes: int = MEMORY_MAX_BYTES,
+                 memory_max_ttl: int = MEMORY_MAX_TTL,
+                 codec: Optional[CacheCodec] = None):
         self.redis_url = redis_url
+        self.codec = codec or CacheCodec()
         self.use_redis = True
-        self.memory_cache = {}  # بديل في الذاكرة
         self.client = None
         self.pool = None
 
+        # الطبقة الأولى: key -> (القيمة المرمّزة، expires_at)
+        self.memory_cache: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()
+        self.memory_max_items = memory_max_items
+        self.memory_max_bytes = memory_max_bytes
+        self.memory_max_ttl = memory_max_ttl
+        self.memory_bytes = 0
+
+        # إعادة الاتصال بـ Redis
+        self._redis_retry_at = 0.0
+        self._redis_backoff = self.RECONNECT_BASE_DELAY
+        self._reconnect_lock = asyncio.Lock()
+
+        # Single-Flight: key -> [Task الحساب الجاري، عدد المنتظرين]
+        self._inflight: Dict[str, List[Any]] = {}
+
+        self.stats: Dict[str, Dict[str, int]] = {}
+
     async def initialize(self):
-        """محاولة الاتصال بـ Redis، إذا فشل يستخدم الذاكرة"""
+        """محاولة الاتصال بـ Redis، إذا فشل يستخدم الذاكرة (مع إعادة المحاولة لاحقاً)"""
+        if await self._connect_redis():
+            logger.info(f"✅ CacheManager: متصل بـ Redis بنجاح")
+        else:
+            logger.warning(f"⚠️ CacheManager: فشل الاتصال بـ Redis. استخدام الذاكرة المؤقتة مع إعادة المحاولة.")
+        return True
+
+    # ------------------------------------------------------------------
+    # Redis: الاتصال وإعادة الاتصال
+    # ------------------------------------------------------------------
+    async def _connect_redis(self) -> bool:
         try:
             import redis.asyncio as aioredis
             from redis.asyncio.connection import ConnectionPool
-            
-            self.pool = ConnectionPool.from_url(self.redis_url, max_connections=20, decode_responses=False)
-            self.client = aioredis.Redis(connection_pool=self.pool)
-            await self.client.ping()
-            logger.info(f"✅ CacheManager: متصل بـ Redis بنجاح")
+
+            pool = ConnectionPool.from_url(self.redis_url, max_connections=20, decode_responses=False)
+            client = aioredis.Redis(connection_pool=pool)
+            await client.ping()
+
+            self.pool, self.client = pool, client
             self.use_redis = True
+            self._redis_backoff = self.RECONNECT_BASE_DELAY
+            self._redis_retry_at = 0.0
             return True
-            
+
         except Exception as e:
-            logger.warning(f"⚠️ CacheManager: فشل الاتصال بـ Redis. استخدام الذاكرة المؤقتة. {e}")
-            self.use_redis = False
-            self.client = None
-            self.pool = None
+            logger.debug(f"CacheManager: تعذر الاتصال بـ Redis: {e}")
+            self._mark_redis_down()
+            return False
+
+    def _mark_redis_down(self, error: Optional[Exception] = None):
+        """إيقاف Redis مؤقتاً حتى موعد إعادة المحاولة (المهلة تتضاعف حتى RECONNECT_MAX_DELAY)"""
+        if error:
+            logger.warning(f"Redis error: {error} - إعادة المحاولة بعد {self._redis_backoff:.0f} ثانية")
+        self.use_redis = False
+        self._redis_retry_at = time.monotonic() + self._redis_backoff
+        self._redis_backoff = min(self._redis_backoff * 2, self.RECONNECT_MAX_DELAY)
+
+    async def _redis_ready(self) -> bool:
+        """هل يمكن استخدام Redis الآن؟ (مع محاولة إعادة الاتصال إذا حان موعدها)"""
+        if self.use_redis and self.client:
             return True
+        if not self.redis_url or time.monotonic() < self._redis_retry_at:
+            return False
+
+        async with self._reconnect_lock:
+            if self.use_redis and self.client:
+                return True
+            if time.monotonic() < self._redis_retry_at:
+                return False
+            await self._close_redis()
+            if await self._connect_redis():
+                logger.info("✅ CacheManager: تمت إعادة الاتصال بـ Redis")
+                return True
+            return False
+
+    async def get_redis(self):
+        """عميل Redis إن كان متاحاً الآن (للأقفال و pub/sub بين العمليات)، وإلا None"""
+        return self.client if await self._redis_ready() else None
+
+    async def _close_redis(self):
+        try:
+            if self.client:
+                await self.client.close()
+            if self.pool:
+                await self.pool.disconnect()
+        except Exception:
+            pass
+        self.client = None
+        self.pool = None
+
+    # ------------------------------------------------------------------
+    # الطبقة الأولى (الذاكرة)
+    # ------------------------------------------------------------------
+    def _prefix_stats(self, key: str) -> Dict[str, int]:
+        prefix = next((p for p in self.KEY_PREFIXES if key.startswith(p)), "other")
+        stats = self.stats.get(prefix)
+        if stats is None:
+            stats = self.stats[prefix] = {
+                "hits_memory": 0, "hits_redis": 0, "misses": 0, "sets": 0,
+                "evictions": 0, "expirations": 0, "singleflight_waits": 0,
+            }
+        return stats
+
+    def _memory_get(self, key: str) -> Any:
+        entry = self.memory_cache.get(key)
+        if entry is None:
+            return None
+        data, expires_at = entry
+        if expires_at < time.monotonic():
+            self._memory_pop(key)
+            self._prefix_stats(key)["expirations"] += 1
+            return None
+        self.memory_cache.move_to_end(key)
+        return self._loads(data)
+
+    def _memory_set(self, key: str, data: bytes, ttl: int):
+        if len(data) > self.memory_max_bytes:
+            return  # (قيمة أكبر من الطبقة كلها - تبقى في Redis فقط)
+        self._memory_pop(key)
+        self.memory_cache[key] = (data, time.monotonic() + min(ttl, self.memory_max_ttl))
+        self.memory_bytes += len(data)
+
+        while self.memory_cache and (len(self.memory_cache) > self.memory_max_items
+                                     or self.memory_bytes > self.memory_max_bytes):
+            evicted_key, _ = next(iter(self.memory_cache.items()))
+            self._memory_pop(evicted_key)
+            self._prefix_stats(evicted_key)["evictions"] += 1
+
+    def _memory_pop(self, key: str):
+        entry = self.memory_cache.pop(key, None)
+        if entry is not None:
+            self.memory_bytes -= len(entry[0])
+
+    # ------------------------------------------------------------------
+    # التسلسل
+    # ------------------------------------------------------------------
+    def _dumps(self, value: Any, key: str) -> Optional[bytes]:
+        """ترميز قيمة للتخزين (None = نوع غير قابل للترميز: لا تُخزن، والخطأ يُسجل)"""
+        try:
+            return self.codec.encode(value)
+        except (TypeError, ValueError) as e:
+            logger.error(f"❌ CacheManager: تعذر ترميز قيمة المفتاح {key[:50]}... ({e}) - لن تُخزن")
+            return None
+
+    def _loads(self, data: bytes) -> Any:
+        """فك قيمة مخزنة (القيم بصيغة غير معروفة تُعامل كإخفاق)"""
+        try:
+            return self.codec.decode(data)
+        except Exception as e:
+            logger.debug(f"CacheManager: تجاهل قيمة غير قابلة للفك: {e}")
+            return None
 
+    # ------------------------------------------------------------------
+    # الواجهة العامة
+    # ------------------------------------------------------------------
     async def get(self, key: str) -> Any:
-        """الحصول على قيمة من الكاش"""
-        if self.use_redis and self.client:
+        """الحصول على قيمة من الكاش (الذاكرة أولاً ثم Redis)"""
+        stats = self._prefix_stats(key)
+
+        value = self._memory_get(key)
+        if value is not None:
+            stats["hits_memory"] += 1
+            logger.debug(f"Cache HIT (Memory) for key: {key[:50]}...")
+            return value
+
+        if await self._redis_ready():
             try:
-                cached_data = await self.client.get(key)
-                if cached_data:
+                # (القيمة والمدة المتبقية في رحلة واحدة)
+                async with self.client.pipeline(transaction=False) as pipe:
+                    pipe.get(key)
+                    pipe.ttl(key)
+                    cached_data, ttl = await pipe.execute()
+                value = self._loads(cached_data) if cached_data else None
+                if value is not None:
+                    self._memory_set(key, cached_data, ttl if ttl and ttl > 0 else self.memory_max_ttl)
+                    stats["hits_redis"] += 1
                     logger.debug(f"Cache HIT (Redis) for key: {key[:50]}...")
-                    return pickle.loads(cached_data)
-                return None
+                    return value
             except Exception as e:
-                logger.warning(f"Redis GET error: {e}")
-                self.use_redis = False
-        
-        # استخدام الذاكرة كبديل
-        value = self.memory_cache.get(key)
-        if value:
-            logger.debug(f"Cache HIT (Memory) for key: {key[:50]}...")
-        return value
+                self._mark_redis_down(e)
+
+        stats["misses"] += 1
+        return None
 
     async def set(self, key: str, value: Any, ttl: int = 3600):
-        """تخزين قيمة في الكاش"""
-        if self.use_redis and self.client:
+        """تخزين قيمة في الطبقتين"""
+        serialized_value = self._dumps(value, key)
+        if serialized_value is None:
+            return
+        self._memory_set(key, serialized_value, ttl)
+        self._prefix_stats(key)["sets"] += 1
+
+        if await self._redis_ready():
             try:
-                serialized_value = pickle.dumps(value)
                 await self.client.set(key, serialized_value, ex=ttl)
                 logger.debug(f"Cache SET (Redis) for key: {key[:50]}...")
-                return
             except Exception as e:
-                logger.warning(f"Redis SET error: {e}")
-                self.use_redis = False
-        
-        # استخدام الذاكرة كبديل
-        self.memory_cache[key] = value
-        logger.debug(f"Cache SET (Memory) for key: {key[:50]}...")
+                self._mark_redis_down(e)
+
+    async def get_many(self, keys: List[str]) -> List[Any]:
+        """الحصول على عدة قيم - ما لا يوجد في الذاكرة يُجلب من Redis في رحلة واحدة (MGET)"""
+        if not keys:
+            return []
+
+        results: List[Any] = [self._memory_get(key) for key in keys]
+        missing = [i for i, value in enumerate(results) if value is None]
+
+        if missing and await self._redis_ready():
+            try:
+                cached = await self.client.mget([keys[i] for i in missing])
+                for i, data in zip(missing, cached):
+                    results[i] = self._loads(data) if data else None
+                    if results[i] is not None:
+                        self._memory_set(keys[i], data, self.memory_max_ttl)
+                        self._prefix_stats(keys[i])["hits_redis"] += 1
+            except Exception as e:
+                self._mark_redis_down(e)
+
+        for i, (key, value) in enumerate(zip(keys, results)):
+            if value is None:
+                self._prefix_stats(key)["misses"] += 1
+            elif i not in missing:
+                self._prefix_stats(key)["hits_memory"] += 1
+        return results
+
+    async def set_many(self, items: Dict[str, Any], ttl: int = 3600):
+        """تخزين عدة قيم في رحلة واحدة (Pipeline)"""
+        if not items:
+            return
+        serialized = {key: self._dumps(value, key) for key, value in items.items()}
+        serialized = {key: data for key, data in serialized.items() if data is not None}
+        for key, data in serialized.items():
+            self._memory_set(key, data, ttl)
+            self._prefix_stats(key)["sets"] += 1
+
+        if serialized and await self._redis_ready():
+            try:
+                async with self.client.pipeline(transaction=False) as pipe:
+                    for key, data in serialized.items():
+                        pipe.set(key, data, ex=ttl)
+                    await pipe.execute()
+            except Exception as e:
+                self._mark_redis_down(e)
+
+    async def get_or_set(self, key: str, factory: Callable[[], Awaitable[Any]], ttl: int = 3600) -> Any:
+        """
+        إرجاع القيمة المخزنة، أو حسابها مرة واحدة فقط حتى لو طلبها عدة مستدعين معاً
+        (Single-Flight): factory تعمل في Task مستقلة وكل المستدعين ينتظرون نتيجتها.
+        إذا رفعت factory استثناءً يصل لكل المنتظرين ولا يُخزن شيء.
+
+        إلغاء أحد المستدعين (مثلاً انقطاع اتصال العميل) لا يلغي الحساب للباقين؛
+        يُلغى الحساب فقط إذا أُلغي كل من ينتظره.
+        """
+        value = await self.get(key)
+        if value is not None:
+            return value
+
+        entry = self._inflight.get(key)
+        if entry is None:
+            task = asyncio.create_task(self._compute(key, factory, ttl))
+            entry = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda _, key=key, entry=entry: self._release_inflight(key, entry))
+        else:
+            self._prefix_stats(key)["singleflight_waits"] += 1
+
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done():
+                # (لم يبق من ينتظر النتيجة)
+                self._release_inflight(key, entry)
+                task.cancel()
+
+    async def _compute(self, key: str, factory: Callable[[], Awaitable[Any]], ttl: int) -> Any:
+        value = await factory()
+        if value is not None:
+            await self.set(key, value, ttl=ttl)
+        return value
+
+    def _release_inflight(self, key: str, entry: List[Any]):
+        if self._inflight.get(key) is entry:
+            del self._inflight[key]
 
     async def delete(self, key: str):
         """حذف مفتاح"""
-        if self.use_redis and self.client:
+        self._memory_pop(key)
+        if await self._redis_ready():
             try:
                 await self.client.delete(key)
-            except Exception:
-                self.use_redis = False
-        
-        self.memory_cache.pop(key, None)
+            except Exception as e:
+                self._mark_redis_down(e)
 
     async def clear_all(self):
         """مسح الكاش"""
-        if self.use_redis and self.client:
+        self.memory_cache.clear()
+        self.memory_bytes = 0
+        if await self._redis_ready():
             try:
                 await self.client.flushdb()
-            except Exception:
-                self.use_redis = False
-        
-        self.memory_cache.clear()
+            except Exception as e:
+                self._mark_redis_down(e)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """عدادات كل بادئة + حالة الطبقتين"""
+        return {
+            "prefixes": {prefix: dict(counters) for prefix, counters in self.stats.items()},
+            "memory": {
+                "items": len(self.memory_cache),
+                "bytes": self.memory_bytes,
+                "max_items": self.memory_max_items,
+                "max_bytes": self.memory_max_bytes,
+            },
+            "redis": {
+                "connected": bool(self.use_redis and self.client),
+                "retry_in_seconds": max(0.0, round(self._redis_retry_at - time.monotonic(), 1)),
+            },
+            "inflight": len(self._inflight),
+            "codec": self.codec.describe(),
+        }
 
     async def close(self):
         """إغلاق الاتصالات"""
-        if self.client:
-            await self.client.close()
-        if self.pool:
-            await self.pool.disconnect()
-        self.memory_cache.clear()
\ No newline at end of file
+        await self._close_redis()
+        self.memory_cache.clear()
+        self.memory_bytes = 0
@@ -0,0 +1,231 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class EmbeddingMicroBatcher:
+    """
+    مجمّع دفعات صغيرة (Micro-Batching) لطلبات التضمين المتزامنة.
+
+    بدلاً من أن يشغّل كل طلب model.encode([text]) في ثريد مستقل
+    (عشرات الثريدات تتنافس على نفس نموذج torch)، تُجمع الطلبات المعلقة
+    لبضع ملي ثوان (أو حتى الحد الأقصى للدفعة)، ثم تُنفذ كاستدعاء encode واحد
+    على عامل (Worker) مخصص، وتُحل نتيجة كل طلب في الـ Future الخاص به.
+
+    الأولوية للاستعلامات التفاعلية: الدفعات الكبيرة (run_bulk) تُقسم لأجزاء من
+    bulk_chunk_size نص، ولا يُرسل جزء للعامل ما دام هناك استعلام تفاعلي معلق،
+    ولا يكون على العامل أكثر من جزء واحد في المرة. أقصى انتظار لاستعلام = جزء واحد.
+    """
+
+    def __init__(self,
+                 encode_fn: Callable[[List[str]], np.ndarray],
+                 max_batch_size: int = 32,
+                 max_wait_ms: float = 5.0,
+                 max_queue_size: int = 1024,
+                 bulk_chunk_size: int = 128):
+        """
+        Args:
+            encode_fn: دالة متزامنة تأخذ قائمة نصوص وترجع مصفوفة تضمينات بنفس الترتيب.
+            max_batch_size: الحد الأقصى لعدد النصوص في الدفعة الواحدة.
+            max_wait_ms: أقصى زمن انتظار (ملي ثانية) لتجميع الدفعة بعد وصول أول طلب.
+            max_queue_size: عمق الطابور؛ عند امتلائه ينتظر المستدعي (Backpressure).
+            bulk_chunk_size: حجم جزء الدفعات الكبيرة بين كل فرصتين للاستعلامات التفاعلية.
+        """
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_queue_size = max_queue_size
+        self.bulk_chunk_size = max(1, bulk_chunk_size)
+
+        # عامل واحد فقط: كل استدعاءات النموذج تمر بالتسلسل عبر هذا الثريد
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedder")
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # عدد الطلبات التفاعلية المعلقة (في الطابور أو قيد التنفيذ) وبوابة الدفعات الكبيرة
+        self._interactive_pending = 0
+        self._interactive_idle: Optional[asyncio.Event] = None
+        self._bulk_lock: Optional[asyncio.Lock] = None
+
+        self.metrics = {
+            "requests": 0,
+            "batches": 0,
+            "batched_items": 0,
+            "max_batch_seen": 0,
+            "total_wait_ms": 0.0,
+            "total_encode_ms": 0.0,
+            "errors": 0,
+            "bulk_chunks": 0,
+            "bulk_yields": 0,
+        }
+
+    def _ensure_worker(self):
+        """تشغيل مهمة التجميع (مرة لكل Event Loop)"""
+        loop = asyncio.get_running_loop()
+        if self._worker_task is None or self._worker_task.done() or self._loop is not loop:
+            if self._worker_task is not None:
+                self._retire_worker(loop)
+            self._loop = loop
+            self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self._interactive_pending = 0
+            self._interactive_idle = asyncio.Event()
+            self._interactive_idle.set()
+            self._bulk_lock = asyncio.Lock()
+            self._worker_task = loop.create_task(self._collect_loop())
+
+    def _retire_worker(self, loop: asyncio.AbstractEventLoop):
+        """
+        إنهاء العامل السابق قبل استبدال طابوره: تسجيل سبب توقفه، وإفشال الطلبات المعلقة
+        في طابوره القديم (لا يوجد عامل سيخدمها فتبقى معلقة للأبد).
+        """
+        worker = self._worker_task
+        if not worker.done():
+            error = RuntimeError("EmbeddingMicroBatcher: تغيرت حلقة الأحداث قبل تضمين الطلب")
+            logger.warning("⚠️ EmbeddingMicroBatcher: تغيرت حلقة الأحداث - إعادة تشغيل العامل")
+        elif worker.cancelled():
+            error = RuntimeError("EmbeddingMicroBatcher: أُلغي العامل قبل تضمين الطلب")
+            logger.warning("⚠️ EmbeddingMicroBatcher: العامل أُلغي - إعادة تشغيله")
+        else:
+            cause = worker.exception()
+            error = RuntimeError(f"EmbeddingMicroBatcher: توقف العامل قبل تضمين الطلب: {cause}")
+            logger.error(f"❌ EmbeddingMicroBatcher: توقف العامل بخطأ - إعادة تشغيله: {cause!r}", exc_info=cause)
+
+        failed = 0
+        while True:
+            try:
+                _, future, _ = self._queue.get_nowait()
+            except (asyncio.QueueEmpty, RuntimeError):
+                # (RuntimeError: منتظرو الإضافة على حلقة مغلقة - لا يمكن إيقاظهم)
+                break
+            if future.done():
+                continue
+            failed += 1
+            future_loop = future.get_loop()
+            if future_loop is loop:
+                future.set_exception(error)
+            elif not future_loop.is_closed():
+                future_loop.call_soon_threadsafe(self._fail_future, future, error)
+        if failed:
+            self.metrics["errors"] += 1
+            logger.warning(f"⚠️ EmbeddingMicroBatcher: إفشال {failed} طلب معلق في الطابور السابق")
+
+    @staticmethod
+    def _fail_future(future: asyncio.Future, error: BaseException):
+        if not future.done():
+            future.set_exception(error)
+
+    async def submit(self, text: str) -> np.ndarray:
+        """إضافة نص للدفعة الحالية وانتظار تضمينه"""
+        self._ensure_worker()
+        future = self._loop.create_future()
+        self.metrics["requests"] += 1
+        self._interactive_pending += 1
+        self._interactive_idle.clear()
+        try:
+            await self._queue.put((text, future, time.perf_counter()))
+        except BaseException:
+            self._interactive_done(1)
+            raise
+        return await future
+
+    def _interactive_done(self, count: int):
+        self._interactive_pending = max(0, self._interactive_pending - count)
+        if self._interactive_pending == 0:
+            self._interactive_idle.set()
+
+    async def run_bulk(self, texts: List[str]) -> np.ndarray:
+        """
+        تشغيل دفعة كبيرة جاهزة (مثل الابتلاع) على نفس العامل المخصص، جزءاً جزءاً،
+        مع إفساح المجال للاستعلامات التفاعلية المعلقة قبل كل جزء.
+        """
+        self._ensure_worker()
+        parts = []
+        for start in range(0, len(texts), self.bulk_chunk_size):
+            chunk = texts[start:start + self.bulk_chunk_size]
+            async with self._bulk_lock:
+                if not self._interactive_idle.is_set():
+                    self.metrics["bulk_yields"] += 1
+                    await self._interactive_idle.wait()
+                parts.append(await self._loop.run_in_executor(self._executor, self.encode_fn, chunk))
+                self.metrics["bulk_chunks"] += 1
+        if not parts:
+            return np.array([])
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts, axis=0)
+
+    async def _collect_loop(self):
+        """حلقة التجميع: أول طلب يفتح نافذة زمنية، وتُغلق الدفعة بانتهائها أو امتلائها"""
+        while True:
+            first = await self._queue.get()
+            batch: List[Tuple[str, asyncio.Future, float]] = [first]
+            deadline = self._loop.time() + self.max_wait
+
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._run_batch(batch)
+
+    async def _run_batch(self, batch: List[Tuple[str, asyncio.Future, float]]):
+        texts = [text for text, _, _ in batch]
+        started = time.perf_counter()
+        self.metrics["total_wait_ms"] += sum((started - enqueued) * 1000 for _, _, enqueued in batch)
+
+        try:
+            vectors = await self._loop.run_in_executor(self._executor, self.encode_fn, texts)
+            if len(vectors) != len(batch):
+                raise RuntimeError(f"عدد التضمينات ({len(vectors)}) لا يطابق حجم الدفعة ({len(batch)})")
+            for (_, future, _), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+        except Exception as e:
+            self.metrics["errors"] += 1
+            logger.error(f"❌ EmbeddingMicroBatcher: فشل تضمين دفعة من {len(batch)} نص: {e}")
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.metrics["batches"] += 1
+            self.metrics["batched_items"] += len(batch)
+            self.metrics["max_batch_seen"] = max(self.metrics["max_batch_seen"], len(batch))
+            self.metrics["total_encode_ms"] += (time.perf_counter() - started) * 1000
+            self._interactive_done(len(batch))
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """مقاييس التجميع: متوسط حجم الدفعة، زمن الانتظار، وعمق الطابور الحالي"""
+        batches = self.metrics["batches"] or 1
+        items = self.metrics["batched_items"] or 1
+        return {
+            **self.metrics,
+            "avg_batch_size": round(self.metrics["batched_items"] / batches, 2),
+            "avg_wait_ms": round(self.metrics["total_wait_ms"] / items, 3),
+            "avg_encode_ms": round(self.metrics["total_encode_ms"] / batches, 3),
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "config": {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+                "max_queue_size": self.max_queue_size,
+                "bulk_chunk_size": self.bulk_chunk_size,
+            },
+        }
+
+    async def close(self):
+        """إيقاف مهمة التجميع والعامل"""
+        if self._worker_task and not self._worker_task.done():
+            self._worker_task.cancel()
+            try:
+                await self._worker_task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,214 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+try:
+    import fcntl  # (قفل الملفات بين العمليات - متاح على Linux/macOS)
+except ImportError:  # (Windows: القفل يقتصر على الثريدات داخل العملية)
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+class EmbeddingCache:
+    """
+    كاش تضمينات معنون بالمحتوى (Content-Addressed) بطبقتين:
+
+    1. طبقة في الذاكرة (LRU) محدودة الحجم داخل العملية.
+    2. طبقة على القرص مشتركة بين العمليات وتبقى بعد إعادة التشغيل:
+       - vectors.f32: مصفوفة float32 (memory-mapped) صف لكل نص.
+       - index.bin: سجل إلحاقي (append-only) من بصمات SHA-256 (32 بايت)،
+         ترتيب البصمة في الملف هو رقم الصف في المصفوفة.
+
+    المفتاح = SHA-256(اسم النموذج + واجهة الاستدلال + علم التطبيع + النص)، وكل تركيبة
+    (نموذج، واجهة، تطبيع) لها مجلد مستقل حتى لا تختلط الأبعاد ولا متجهات int8 بمتجهات torch.
+    """
+
+    DIGEST_SIZE = 32
+    INITIAL_CAPACITY = 4096
+
+    def __init__(self,
+                 cache_dir: str,
+                 model_name: str,
+                 dimension: int,
+                 normalize: bool = True,
+                 memory_items: int = 10000,
+                 backend: str = "torch"):
+        self.model_name = model_name
+        self.backend = backend
+        self.dimension = dimension
+        self.normalize = normalize
+        self.memory_items = memory_items
+
+        namespace = re.sub(r'[^A-Za-z0-9_.-]+', '_', f"{model_name}__{backend}__norm{int(normalize)}__d{dimension}")
+        self.dir = Path(cache_dir) / namespace
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.vectors_path = self.dir / "vectors.f32"
+        self.index_path = self.dir / "index.bin"
+        self.lock_path = self.dir / ".lock"
+
+        self._memory: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._rows: Dict[bytes, int] = {}
+        self._index_offset = 0
+        self._matrix: Optional[np.memmap] = None
+        self._thread_lock = threading.RLock()
+
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0}
+
+        self.index_path.touch(exist_ok=True)
+        self.vectors_path.touch(exist_ok=True)
+        self._refresh_index()
+        logger.info(f"✅ EmbeddingCache: {len(self._rows)} تضمين محفوظ على القرص في {self.dir}")
+
+    # ------------------------------------------------------------------
+    # المفاتيح
+    # ------------------------------------------------------------------
+    def key_for(self, text: str) -> bytes:
+        """بصمة ثابتة للنص مرتبطة بالنموذج والواجهة وعلم التطبيع"""
+        payload = f"{self.model_name}\x00{self.backend}\x00{int(self.normalize)}\x00{text}".encode('utf-8')
+        return hashlib.sha256(payload).digest()
+
+    # ------------------------------------------------------------------
+    # القراءة
+    # ------------------------------------------------------------------
+    def get_many(self, texts: List[str], blocking: bool = True) -> List[Optional[np.ndarray]]:
+        """
+        جلب تضمينات مجموعة نصوص (None للنص غير الموجود في الكاش).
+        blocking=False للاستدعاء من الـ Event Loop: إذا كان العامل يكتب حالياً
+        لا ننتظره، بل نعيد None للجميع (وسيُعاد الفحص على العامل).
+        """
+        if not self._thread_lock.acquire(blocking=blocking):
+            return [None] * len(texts)
+        try:
+            results: List[Optional[np.ndarray]] = []
+            refreshed = False
+            for text in texts:
+                key = self.key_for(text)
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    results.append(vector)
+                    continue
+
+                # تحديث الفهرس مرة واحدة لالتقاط ما كتبته العمليات الأخرى
+                if key not in self._rows and not refreshed:
+                    self._refresh_index()
+                    refreshed = True
+
+                row = self._rows.get(key)
+                if row is not None:
+                    vector = np.array(self._get_matrix(row)[row], dtype=np.float32)
+                    self._remember(key, vector)
+                    self.stats["disk_hits"] += 1
+                    results.append(vector)
+                else:
+                    # (الإخفاق يُحسب في الفحص النهائي على العامل فقط حتى لا يُعد مرتين)
+                    if blocking:
+                        self.stats["misses"] += 1
+                    results.append(None)
+            return results
+        finally:
+            self._thread_lock.release()
+
+    # ------------------------------------------------------------------
+    # الكتابة
+    # ------------------------------------------------------------------
+    def put_many(self, texts: List[str], vectors: np.ndarray):
+        """تخزين تضمينات جديدة في الطبقتين (الكتابة على القرص تحت قفل ملف)"""
+        if len(texts) == 0:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(texts), self.dimension)
+
+        with self._thread_lock, open(self.lock_path, 'a+') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._refresh_index()
+
+                new_keys, new_vectors = [], []
+                for text, vector in zip(texts, vectors):
+                    key = self.key_for(text)
+                    self._remember(key, vector)
+                    if key not in self._rows and key not in new_keys:
+                        new_keys.append(key)
+                        new_vectors.append(vector)
+
+                if not new_keys:
+                    return
+
+                start_row = self._index_offset // self.DIGEST_SIZE
+                end_row = start_row + len(new_keys)
+                matrix = self._ensure_capacity(end_row)
+                matrix[start_row:end_row] = np.stack(new_vectors)
+                matrix.flush()
+
+                # البصمات تُلحق بعد كتابة المتجهات حتى لا يرى قارئ بصمة بلا متجه
+                with open(self.index_path, 'ab') as index_file:
+                    index_file.write(b''.join(new_keys))
+                    index_file.flush()
+                    os.fsync(index_file.fileno())
+
+                for offset, key in enumerate(new_keys):
+                    self._rows[key] = start_row + offset
+                self._index_offset += len(new_keys) * self.DIGEST_SIZE
+                self.stats["writes"] += len(new_keys)
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # ------------------------------------------------------------------
+    # أدوات داخلية
+    # ------------------------------------------------------------------
+    def _remember(self, key: bytes, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _refresh_index(self):
+        """قراءة البصمات الجديدة فقط (من آخر موضع مقروء) من سجل الفهرس"""
+        size = self.index_path.stat().st_size
+        usable = size - (size % self.DIGEST_SIZE)
+        if usable <= self._index_offset:
+            return
+        with open(self.index_path, 'rb') as index_file:
+            index_file.seek(self._index_offset)
+            data = index_file.read(usable - self._index_offset)
+        row = self._index_offset // self.DIGEST_SIZE
+        for i in range(0, len(data), self.DIGEST_SIZE):
+            self._rows[data[i:i + self.DIGEST_SIZE]] = row
+            row += 1
+        self._index_offset = usable
+
+    def _capacity_on_disk(self) -> int:
+        return self.vectors_path.stat().st_size // (self.dimension * 4)
+
+    def _get_matrix(self, row: int) -> np.memmap:
+        """إرجاع الـ memmap، مع إعادة فتحه إذا كبّرته عملية أخرى"""
+        if self._matrix is None or row >= self._matrix.shape[0]:
+            capacity = self._capacity_on_disk()
+            self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r+',
+                                     shape=(capacity, self.dimension))
+        return self._matrix
+
+    def _ensure_capacity(self, rows_needed: int) -> np.memmap:
+        """توسيع ملف المتجهات (بالمضاعفة) عند الحاجة"""
+        capacity = self._capacity_on_disk()
+        if capacity < rows_needed:
+            new_capacity = max(self.INITIAL_CAPACITY, capacity)
+            while new_capacity < rows_needed:
+                new_capacity *= 2
+            self._matrix = None  # تحرير الـ memmap القديم قبل تغيير حجم الملف
+            with open(self.vectors_path, 'r+b') as vectors_file:
+                vectors_file.truncate(new_capacity * self.dimension * 4)
+        return self._get_matrix(rows_needed - 1)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {**self.stats, "memory_items": len(self._memory), "disk_items": len(self._rows)}
@@ -1,12 +1,25 @@
 import logging
+import os
+from pathlib import Path
 from sentence_transformers import SentenceTransformer
 import numpy as np
-from typing import List
-import asyncio
+from typing import Dict, List, Optional, Tuple
 from functools import lru_cache
 
+from .embedding_cache import EmbeddingCache
+from .embedding_batcher import EmbeddingMicroBatcher
+from .inference_backends import (
+    ARABIC_LEGAL_PROBES, embeddings_match, load_sentence_encoder,
+    resolve_backend, select_validated_backend
+)
+
 logger = logging.getLogger(__name__)
 
+# الكاش والمجمّع مشتركان بين كل نسخ HybridEmbedder بنفس الإعدادات داخل العملية:
+# عامل واحد لكل نموذج بدلاً من عامل لكل نسخة (API + المسترجع + معالج Excel...)
+# يتنافسون على نفس نموذج torch. أول نسخة تحدد إعدادات التجميع.
+_SHARED_RUNTIMES: Dict[tuple, Tuple[Optional[EmbeddingCache], EmbeddingMicroBatcher]] = {}
+
 class HybridEmbedder:
     """
     مسؤول عن إنشاء التضمينات (Embeddings) للنصوص.
@@ -23,30 +36,93 @@ class HybridEmbedder:
    
     DEFAULT_MODEL = "intfloat/multilingual-e5-base"
 
+    # مجلد كاش التضمينات الدائم (مشترك بين العمليات وإعادة التشغيل)
+    DEFAULT_CACHE_DIR = os.getenv(
+        "EMBEDDING_CACHE_DIR",
+        str(Path(__file__).resolve().parents[3] / "data" / "embedding_cache")
+    )
+    
+    # إعدادات تجميع طلبات get_embedding المتزامنة في دفعات صغيرة
+    BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "32"))
+    BATCH_MAX_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_MAX_WAIT_MS", "5"))
+    BATCH_MAX_QUEUE = int(os.getenv("EMBEDDING_BATCH_MAX_QUEUE", "1024"))
+    # حجم جزء دفعات الابتلاع بين كل فرصتين للاستعلامات التفاعلية
+    BULK_CHUNK_SIZE = int(os.getenv("EMBEDDING_BULK_CHUNK_SIZE", "128"))
     
-    def __init__(self, model_name: str = DEFAULT_MODEL):
+    # واجهة الاستدلال: torch | int8 (مع التحقق من التطابق مع PyTorch عند التحميل)
+    DEFAULT_BACKEND = resolve_backend("EMBEDDER_BACKEND")
+    BACKEND_TOLERANCE = float(os.getenv("EMBEDDER_BACKEND_TOLERANCE", "0.02"))
+    
+    def __init__(self, model_name: str = DEFAULT_MODEL, normalize_embeddings: bool = True,
+                 backend: str = DEFAULT_BACKEND, backend_tolerance: float = BACKEND_TOLERANCE,
+                 use_cache: bool = True, cache_dir: Optional[str] = None,
+                 batch_max_size: int = BATCH_MAX_SIZE, batch_max_wait_ms: float = BATCH_MAX_WAIT_MS,
+                 batch_max_queue: int = BATCH_MAX_QUEUE, bulk_chunk_size: int = BULK_CHUNK_SIZE):
         try:
             # استخدام @lru_cache يضمن تحميل النموذج مرة واحدة فقط
-            self.model = self._get_model(model_name)
+            self.model_name = model_name
+            self.normalize_embeddings = normalize_embeddings
+            self.model, self.backend = self._get_model(model_name, backend, backend_tolerance)
             self.dimension = self.model.get_sentence_embedding_dimension()
             
+            # كل استدعاءات النموذج (استعلامات مفردة أو دفعات ابتلاع) تمر عبر عامل واحد مشترك
+            cache_dir = (cache_dir or self.DEFAULT_CACHE_DIR) if use_cache else None
+            runtime_key = (model_name, self.backend, normalize_embeddings, cache_dir)
+            runtime = _SHARED_RUNTIMES.get(runtime_key)
+            if runtime is None:
+                self.cache = self._create_cache(cache_dir) if cache_dir else None
+                self.batcher = EmbeddingMicroBatcher(
+                    encode_fn=self._encode_cached_or_plain,
+                    max_batch_size=batch_max_size,
+                    max_wait_ms=batch_max_wait_ms,
+                    max_queue_size=batch_max_queue,
+                    bulk_chunk_size=bulk_chunk_size
+                )
+                _SHARED_RUNTIMES[runtime_key] = (self.cache, self.batcher)
+            else:
+                self.cache, self.batcher = runtime
+            
             if self.dimension != 768:
                 logger.warning(f"أبعاد النموذج ({self.dimension}) لا تتطابق مع أبعاد قاعدة البيانات (768). قد تحدث أخطاء.")
                 
-            logger.info(f"✅ HybridEmbedder: تم تحميل نموذج {model_name} (أبعاد: {self.dimension})")
+            logger.info(f"✅ HybridEmbedder: تم تحميل نموذج {model_name} (أبعاد: {self.dimension}، واجهة: {self.backend})")
             
         except Exception as e:
             logger.error(f"❌ HybridEmbedder: فشل تحميل نموذج {model_name}. خطأ: {e}")
             raise
 
+    def _create_cache(self, cache_dir: str) -> Optional[EmbeddingCache]:
+        """إنشاء كاش التضمينات؛ فشله لا يوقف الـ embedder (يعمل بدون كاش)"""
+        try:
+            return EmbeddingCache(
+                cache_dir=cache_dir,
+                model_name=self.model_name,
+                dimension=self.dimension,
+                normalize=self.normalize_embeddings,
+                backend=self.backend
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ HybridEmbedder: تعذر تهيئة كاش التضمينات ({cache_dir}). المتابعة بدونه. {e}")
+            return None
+
     @staticmethod
     @lru_cache(maxsize=None)
-    def _get_model(model_name: str) -> SentenceTransformer:
+    def _get_model(model_name: str, backend: str = "torch", tolerance: float = 0.02) -> Tuple[SentenceTransformer, str]:
         """
         دالة ستاتيكية مع كاش لتحميل النموذج مرة واحدة فقط على مستوى التطبيق.
+        
+        الواجهة البديلة (int8) تُعتمد فقط إذا طابقت مخرجاتها مسار PyTorch
+        على مجموعة اختبار عربية قانونية ثابتة، وإلا يُستخدم نموذج PyTorch.
         """
-        logger.info(f"تحميل نموذج SentenceTransformer: {model_name}...")
-        return SentenceTransformer(model_name)
+        logger.info(f"تحميل نموذج SentenceTransformer: {model_name} (واجهة مطلوبة: {backend})...")
+        return select_validated_backend(
+            kind="HybridEmbedder",
+            backend=backend,
+            load_fn=lambda b: load_sentence_encoder(model_name, b),
+            run_fn=lambda m: m.encode(ARABIC_LEGAL_PROBES, normalize_embeddings=True, show_progress_bar=False),
+            compare_fn=embeddings_match,
+            tolerance=tolerance
+        )
 
     def _encode_sync(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
         """
@@ -57,7 +133,7 @@ class HybridEmbedder:
         return self.model.encode(
             texts, 
             batch_size=batch_size, 
-            normalize_embeddings=True,  # مهم جداً لبحث Cosine Similarity
+            normalize_embeddings=self.normalize_embeddings,  # مهم جداً لبحث Cosine Similarity
             show_progress_bar=False
         )
 
@@ -65,33 +141,82 @@ class HybridEmbedder:
         """
         إنشاء تضمين لنص واحد (بشكل غير متزامن).
         """
-        # (استدعاء get_embeddings بدلاً من get_embedding لتوحيد المنطق)
-        embeddings = await self.get_embeddings([text])
-        return embeddings[0]
+        # الكاش يُفحص قبل الطابور: الاستعلام المكرر لا ينتظر خلف أي دفعة
+        cached = self._cached_lookup([text])[0]
+        if cached is not None:
+            return cached
+        # الطلبات المتزامنة تُجمع في دفعة واحدة (Micro-Batching) بدلاً من encode لكل نص
+        try:
+            return await self.batcher.submit(text)
+        except Exception as e:
+            logger.error(f"❌ فشل في إنشاء التضمين: {e}")
+            raise
 
     async def get_embeddings(self, texts: List[str]) -> np.ndarray:
         """
         إنشاء تضمينات لمجموعة نصوص (بشكل غير متزامن).
         
-        نستخدم asyncio.to_thread لتشغيل دالة .encode() المتزامنة 
-        (التي تستهلك CPU/GPU) في "ثريد" منفصل لمنع تجميد (Blocking) الـ Event Loop.
+        دالة .encode() المتزامنة (التي تستهلك CPU/GPU) تعمل على العامل المخصص للمجمّع
+        لمنع تجميد (Blocking) الـ Event Loop ومنع التنافس مع دفعات الاستعلامات.
         """
         if not texts:
             return np.array([])
             
         try:
-            # تشغيل المهمة الحسابية في ثريد منفصل
-            embeddings = await asyncio.to_thread(self._encode_sync, texts)
-            return embeddings
+            # النصوص المخزنة لا تدخل الطابور أصلاً؛ الباقي فقط يُضمَّن على العامل
+            vectors = self._cached_lookup(texts)
+            missing = [i for i, vector in enumerate(vectors) if vector is None]
+            if missing:
+                encoded = await self.batcher.run_bulk([texts[i] for i in missing])
+                for i, vector in zip(missing, encoded):
+                    vectors[i] = vector
+            return np.stack(vectors).astype(np.float32, copy=False)
         
         except Exception as e:
             logger.error(f"❌ فشل في إنشاء التضمينات: {e}")
             # إرجاع مصفوفة فارغة بالشكل الصحيح
             return np.empty((0, self.dimension))
 
+    def _cached_lookup(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """فحص سريع للكاش من الـ Event Loop (لا ينتظر العامل إذا كان يكتب)"""
+        if self.cache is None:
+            return [None] * len(texts)
+        try:
+            return self.cache.get_many(texts, blocking=False)
+        except Exception as e:
+            logger.warning(f"⚠️ HybridEmbedder: تعذر فحص كاش التضمينات: {e}")
+            return [None] * len(texts)
+
+    def _encode_cached_or_plain(self, texts: List[str]) -> np.ndarray:
+        """الدالة التي ينفذها العامل: عبر الكاش إن وُجد، وإلا تضمين مباشر"""
+        if self.cache is None:
+            return self._encode_sync(texts)
+        return self._encode_with_cache_sync(texts)
+
+    def _encode_with_cache_sync(self, texts: List[str]) -> np.ndarray:
+        """
+        تضمين مع الكاش: النصوص المكررة داخل الدفعة أو المخزنة مسبقاً
+        لا يعاد تضمينها، والنتائج تُعاد بنفس ترتيب المدخلات.
+        """
+        cached = self.cache.get_many(texts)
+        
+        missing_texts = list(dict.fromkeys(
+            text for text, vector in zip(texts, cached) if vector is None
+        ))
+        if missing_texts:
+            new_vectors = self._encode_sync(missing_texts)
+            self.cache.put_many(missing_texts, new_vectors)
+            encoded = dict(zip(missing_texts, new_vectors))
+            cached = [vector if vector is not None else encoded[text] for text, vector in zip(texts, cached)]
+        
+        return np.stack(cached).astype(np.float32, copy=False)
+
     def get_model_info(self) -> dict:
         """إرجاع معلومات عن النموذج المستخدم."""
         return {
-            "model_name": self.model.model.name_or_path,
-            "dimension": self.dimension
+            "model_name": self.model_name,
+            "backend": self.backend,
+            "dimension": self.dimension,
+            "cache": self.cache.get_stats() if self.cache else None,
+            "batching": self.batcher.get_metrics()
         }
\ No newline at end of file
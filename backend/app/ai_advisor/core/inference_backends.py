@@ -0,0 +1,121 @@
+import logging
+import os
+from typing import Any, Callable, List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# الواجهات الخلفية المدعومة للاستدلال على CPU
+#   torch: نموذج PyTorch الأصلي (المرجع).
+#   int8:  تكميم ديناميكي (Dynamic Quantization) لطبقات Linear إلى int8.
+# (ONNX Runtime يتطلب sentence-transformers >= 3.2 للمضمِّن و >= 4.1 للـ CrossEncoder،
+#  والمثبت 2.5.1 - يُضاف هنا عند ترقية الاعتماديات)
+SUPPORTED_BACKENDS = ("torch", "int8")
+
+# مجموعة اختبار عربية قانونية ثابتة للتحقق من تطابق المخرجات مع مسار PyTorch
+ARABIC_LEGAL_PROBES: List[str] = [
+    "ما هي عقوبة السرقة في قانون العقوبات المصري؟",
+    "المادة 318: يعاقب بالحبس مع الشغل مدة لا تتجاوز سنتين على السرقات التي لم يتوفر فيها شيء من الظروف المشددة.",
+    "يلتزم المؤجر بتسليم العين المؤجرة وملحقاتها في حالة تصلح معها لأن تفي بما أعدت له من المنفعة.",
+    "لا جريمة ولا عقوبة إلا بناء على قانون، ولا توقع عقوبة إلا بحكم قضائي.",
+    "ما هي شروط صحة عقد البيع وفقاً للقانون المدني؟",
+    "ينقضي الالتزام بالوفاء أو بما يعادل الوفاء كالمقاصة واتحاد الذمة.",
+]
+
+ARABIC_LEGAL_PAIRS: List[Tuple[str, str]] = [
+    (ARABIC_LEGAL_PROBES[0], ARABIC_LEGAL_PROBES[1]),
+    (ARABIC_LEGAL_PROBES[0], ARABIC_LEGAL_PROBES[2]),
+    (ARABIC_LEGAL_PROBES[4], ARABIC_LEGAL_PROBES[2]),
+    (ARABIC_LEGAL_PROBES[4], ARABIC_LEGAL_PROBES[5]),
+    (ARABIC_LEGAL_PROBES[3], ARABIC_LEGAL_PROBES[1]),
+]
+
+def resolve_backend(env_var: str, default: str = "torch") -> str:
+    """قراءة الواجهة الخلفية من متغير بيئة مع التحقق من قيمتها"""
+    backend = os.getenv(env_var, default).strip().lower()
+    if backend not in SUPPORTED_BACKENDS:
+        logger.warning(f"⚠️ قيمة {env_var}='{backend}' غير مدعومة، استخدام 'torch'")
+        return "torch"
+    return backend
+
+def _quantize_dynamic_int8(model: Any) -> Any:
+    """تكميم ديناميكي int8 لكل طبقات Linear (يعمل على CPU فقط)"""
+    import torch
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def load_sentence_encoder(model_name: str, backend: str = "torch") -> Any:
+    """تحميل SentenceTransformer بالواجهة الخلفية المطلوبة"""
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device="cpu" if backend == "int8" else None)
+    if backend == "int8":
+        model = _quantize_dynamic_int8(model)
+    return model
+
+def load_cross_encoder(model_name: str, backend: str = "torch") -> Any:
+    """تحميل CrossEncoder بالواجهة الخلفية المطلوبة"""
+    from sentence_transformers import CrossEncoder
+
+    model = CrossEncoder(model_name, device="cpu" if backend == "int8" else None)
+    if backend == "int8":
+        model.model = _quantize_dynamic_int8(model.model)
+    return model
+
+def embeddings_match(reference: np.ndarray, candidate: np.ndarray, tolerance: float) -> Tuple[bool, float]:
+    """
+    مقارنة تضمينات الواجهة البديلة بالمرجع: أقل تشابه Cosine بين كل زوج
+    يجب أن يكون >= 1 - tolerance.
+    """
+    reference = np.asarray(reference, dtype=np.float32)
+    candidate = np.asarray(candidate, dtype=np.float32)
+    if reference.shape != candidate.shape:
+        return False, 0.0
+    ref_norm = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    cand_norm = candidate / np.linalg.norm(candidate, axis=1, keepdims=True)
+    min_cosine = float(np.min(np.sum(ref_norm * cand_norm, axis=1)))
+    return min_cosine >= 1.0 - tolerance, min_cosine
+
+def scores_match(reference: np.ndarray, candidate: np.ndarray, tolerance: float) -> Tuple[bool, float]:
+    """
+    مقارنة درجات إعادة الترتيب: أكبر فرق مطلق <= tolerance،
+    مع اشتراط بقاء ترتيب الأزواج كما هو.
+    """
+    reference = np.asarray(reference, dtype=np.float32).reshape(-1)
+    candidate = np.asarray(candidate, dtype=np.float32).reshape(-1)
+    if reference.shape != candidate.shape:
+        return False, float("inf")
+    max_diff = float(np.max(np.abs(reference - candidate)))
+    same_order = list(np.argsort(-reference)) == list(np.argsort(-candidate))
+    return max_diff <= tolerance and same_order, max_diff
+
+def select_validated_backend(kind: str,
+                             backend: str,
+                             load_fn: Callable[[str], Any],
+                             run_fn: Callable[[Any], np.ndarray],
+                             compare_fn: Callable[[np.ndarray, np.ndarray, float], Tuple[bool, float]],
+                             tolerance: float) -> Tuple[Any, str]:
+    """
+    تحميل الواجهة المطلوبة والتحقق منها مقابل مسار PyTorch على مجموعة الاختبار الثابتة.
+    عند فشل التحميل أو تجاوز حد التفاوت نرجع لنموذج PyTorch.
+
+    Returns:
+        (النموذج المختار، اسم الواجهة الفعلية)
+    """
+    reference_model = load_fn("torch")
+    if backend == "torch":
+        return reference_model, "torch"
+
+    try:
+        candidate_model = load_fn(backend)
+        ok, metric = compare_fn(run_fn(reference_model), run_fn(candidate_model), tolerance)
+    except Exception as e:
+        logger.warning(f"⚠️ {kind}: تعذر تحميل الواجهة '{backend}' ({e}). الرجوع إلى torch.")
+        return reference_model, "torch"
+
+    if not ok:
+        logger.warning(f"⚠️ {kind}: مخرجات '{backend}' خارج حد التفاوت ({metric:.4f}، tolerance={tolerance}). الرجوع إلى torch.")
+        return reference_model, "torch"
+
+    logger.info(f"✅ {kind}: تم اعتماد الواجهة '{backend}' (مقياس التطابق: {metric:.4f})")
+    return candidate_model, backend
@@ -0,0 +1,214 @@
+import logging
+import math
+import os
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+class LatencyWindow:
+    """نافذة متحركة لآخر N قياس زمن (لحساب p50 / p95)"""
+
+    def __init__(self, size: int = 100):
+        self.samples: deque = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+class ModelHealth:
+    """
+    صحة نموذج واحد: زمن الاستجابة الكامل، زمن أول جزء في البث (TTFT)،
+    نسبة الأخطاء في آخر N طلب، وحالة قاطع الدائرة (Circuit Breaker).
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, window: int):
+        self.latency = LatencyWindow(window)
+        self.ttft = LatencyWindow(window)
+        self.outcomes: deque = deque(maxlen=window)  # (True = نجاح)
+        self.consecutive_failures = 0
+        self.state = self.CLOSED
+        self.open_until = 0.0
+        self.probe_in_flight = False
+
+    @property
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return 1.0 - sum(self.outcomes) / len(self.outcomes)
+
+class LLMRouter:
+    """
+    توجيه الطلبات بين نماذج نفس الفئة (tier) حسب الصحة:
+
+    - كل مفتاح نموذج له فئة: conf["tier"] أو بادئة المفتاح ("smart_openai" -> "smart").
+    - الترتيب: النماذج ذات الدائرة المغلقة أولاً، بأقل p95 مرجح بنسبة الأخطاء
+      (النموذج بلا قياسات ولا أخطاء يُجرَّب أولاً لجمع بيانات عنه، أما الذي فشل فقط فيأتي أخيراً).
+    - قاطع الدائرة: بعد CIRCUIT_FAILURES أخطاء متتالية (أو نسبة أخطاء عالية) يُستبعد
+      النموذج لمدة CIRCUIT_COOLDOWN، ثم يُسمح بطلب تجريبي واحد (half-open) يُحجز عند التوجيه.
+    - التحوط (Hedging): إذا تأخر الطلب الأول عن p95 (أو HEDGE_DELAY) يُرسل طلب ثانٍ
+      لأفضل نموذج تالٍ، ويُلغى الأبطأ.
+    """
+
+    WINDOW = int(os.getenv("LLM_ROUTER_WINDOW", "100"))
+    CIRCUIT_FAILURES = int(os.getenv("LLM_CIRCUIT_FAILURES", "5"))
+    CIRCUIT_ERROR_RATE = float(os.getenv("LLM_CIRCUIT_ERROR_RATE", "0.5"))
+    CIRCUIT_MIN_SAMPLES = int(os.getenv("LLM_CIRCUIT_MIN_SAMPLES", "10"))
+    CIRCUIT_COOLDOWN = float(os.getenv("LLM_CIRCUIT_COOLDOWN", "30"))
+    HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "true").lower() == "true"
+    # (0 = استخدام p95 للنموذج الأساسي كعتبة)
+    HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "0"))
+    HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1.0"))
+    HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+
+    def __init__(self, tiers: Optional[Dict[str, List[str]]] = None):
+        self.tiers: Dict[str, List[str]] = {}
+        self.tier_of: Dict[str, str] = {}
+        self.health: Dict[str, ModelHealth] = {}
+        self.stats = {"hedges": 0, "hedge_wins": 0, "failovers": 0, "circuit_opens": 0}
+        for tier, keys in (tiers or {}).items():
+            for key in keys:
+                self.register(key, tier)
+
+    @staticmethod
+    def tier_for(model_key: str, conf: Optional[Dict[str, Any]] = None) -> str:
+        return (conf or {}).get("tier") or model_key.split("_")[0]
+
+    def register(self, model_key: str, tier: str):
+        self.tiers.setdefault(tier, [])
+        if model_key not in self.tiers[tier]:
+            self.tiers[tier].append(model_key)
+        self.tier_of[model_key] = tier
+        self.health.setdefault(model_key, ModelHealth(self.WINDOW))
+
+    # ------------------------------------------------------------------
+    # قاطع الدائرة
+    # ------------------------------------------------------------------
+    def _available(self, model_key: str, now: float) -> bool:
+        health = self.health[model_key]
+        if health.state == ModelHealth.OPEN and now >= health.open_until:
+            health.state = ModelHealth.HALF_OPEN
+            health.probe_in_flight = False
+        if health.state == ModelHealth.OPEN:
+            return False
+        if health.state == ModelHealth.HALF_OPEN:
+            return not health.probe_in_flight
+        return True
+
+    def _open_circuit(self, model_key: str):
+        health = self.health[model_key]
+        health.state = ModelHealth.OPEN
+        health.open_until = time.monotonic() + self.CIRCUIT_COOLDOWN
+        health.probe_in_flight = False
+        self.stats["circuit_opens"] += 1
+        logger.warning(
+            f"🔌 LLMRouter: فتح الدائرة للنموذج '{model_key}' لمدة {self.CIRCUIT_COOLDOWN:g}ث "
+            f"(أخطاء متتالية: {health.consecutive_failures}، نسبة الأخطاء: {health.error_rate:.0%})"
+        )
+
+    # ------------------------------------------------------------------
+    # التسجيل
+    # ------------------------------------------------------------------
+    def acquire(self, model_key: str):
+        """تسجيل بدء طلب (في حالة half-open يُسمح بطلب تجريبي واحد فقط)"""
+        health = self.health.get(model_key)
+        if health and health.state == ModelHealth.HALF_OPEN:
+            health.probe_in_flight = True
+
+    def record_success(self, model_key: str, latency: float, first_chunk: bool = False):
+        health = self.health.get(model_key)
+        if not health:
+            return
+        (health.ttft if first_chunk else health.latency).add(latency)
+        health.outcomes.append(True)
+        health.consecutive_failures = 0
+        if health.state != ModelHealth.CLOSED:
+            logger.info(f"🔌 LLMRouter: إغلاق الدائرة للنموذج '{model_key}' (نجح الطلب التجريبي)")
+        health.state = ModelHealth.CLOSED
+        health.probe_in_flight = False
+
+    def record_failure(self, model_key: str):
+        health = self.health.get(model_key)
+        if not health:
+            return
+        health.outcomes.append(False)
+        health.consecutive_failures += 1
+        if health.state == ModelHealth.HALF_OPEN:
+            self._open_circuit(model_key)
+        elif health.state == ModelHealth.CLOSED and (
+            health.consecutive_failures >= self.CIRCUIT_FAILURES
+            or (len(health.outcomes) >= self.CIRCUIT_MIN_SAMPLES and health.error_rate >= self.CIRCUIT_ERROR_RATE)
+        ):
+            self._open_circuit(model_key)
+
+    def record_cancelled(self, model_key: str):
+        """الطلب أُلغي أو لم يُرسل (خاسر التحوط، تجاوز حد المزود، مرشح لم يُستخدم): ليس خطأ، لكن يُحرر الطلب التجريبي"""
+        health = self.health.get(model_key)
+        if health:
+            health.probe_in_flight = False
+
+    # ------------------------------------------------------------------
+    # التوجيه
+    # ------------------------------------------------------------------
+    def _score(self, model_key: str, first_chunk: bool) -> float:
+        health = self.health[model_key]
+        window = health.ttft if first_chunk else health.latency
+        p95 = window.percentile(0.95)
+        if p95 is None:
+            # (بلا قياسات: يُجرَّب أولاً إلا إذا كانت له أخطاء فقط - حينها بعد النماذج السليمة)
+            return 0.0 if health.error_rate == 0 else math.inf
+        return p95 * (1.0 + 4.0 * health.error_rate)
+
+    def route(self, model_key: str, first_chunk: bool = False) -> List[str]:
+        """
+        قائمة النماذج المرشحة للطلب بالترتيب (الأول = الأساسي، والباقي للتحوط والتحويل عند الفشل).
+        model_key يمكن أن يكون مفتاح نموذج (تُستخدم فئته) أو اسم فئة مباشرة.
+        """
+        tier = self.tier_of.get(model_key) or self.tier_for(model_key)
+        keys = self.tiers.get(tier, [])
+        now = time.monotonic()
+        available = [key for key in keys if self._available(key, now)]
+        ordered = sorted(available, key=lambda key: (self._score(key, first_chunk), key != model_key))
+        if not ordered and keys:
+            # كل الدوائر مفتوحة: نجرب الأقرب لانتهاء فترة التبريد بدلاً من الفشل الفوري
+            ordered = sorted(keys, key=lambda key: self.health[key].open_until)[:1]
+        # حجز الطلب التجريبي للنماذج half-open هنا وليس عند الاستدعاء (بينهما انتظار في طابور
+        # المجدول، فتوجه الطلبات المتزامنة كلها للنموذج نفسه). المستدعي يحرر ما لم يستخدمه.
+        for key in ordered:
+            self.acquire(key)
+        return ordered
+
+    def hedge_delay(self, model_key: str, first_chunk: bool = False) -> Optional[float]:
+        """متى يُرسل الطلب التحوطي (None = لا تحوط بعد: التحوط معطل أو القياسات غير كافية)"""
+        if not self.HEDGE_ENABLED:
+            return None
+        if self.HEDGE_DELAY > 0:
+            return self.HEDGE_DELAY
+        health = self.health.get(model_key)
+        window = (health.ttft if first_chunk else health.latency) if health else None
+        if not window or len(window.samples) < self.HEDGE_MIN_SAMPLES:
+            return None
+        return max(window.percentile(0.95), self.HEDGE_MIN_DELAY)
+
+    def get_stats(self) -> Dict[str, Any]:
+        models = {}
+        for key, health in self.health.items():
+            models[key] = {
+                "tier": self.tier_of.get(key),
+                "state": health.state,
+                "p50": health.latency.percentile(0.5),
+                "p95": health.latency.percentile(0.95),
+                "ttft_p50": health.ttft.percentile(0.5),
+                "ttft_p95": health.ttft.percentile(0.95),
+                "error_rate": round(health.error_rate, 3),
+                "requests": len(health.outcomes),
+            }
+        return {**self.stats, "models": models}
@@ -0,0 +1,260 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# فئات الأولوية (الأصغر يُخدم أولاً)
+PRIORITY_CLASSES = {"interactive": 0, "default": 1, "batch": 2}
+
+# متوسط الحروف لكل token (تقدير للحجز المسبق قبل معرفة الاستهلاك الفعلي)
+CHARS_PER_TOKEN = 3.0
+
+def estimate_tokens(*texts: Optional[str]) -> int:
+    return math.ceil(sum(len(text) for text in texts if text) / CHARS_PER_TOKEN)
+
+class _Grant:
+    """حجز مُنح لطلب (يُحرر مرة واحدة فقط، مع تصحيح عدد الـ tokens الفعلي)"""
+
+    def __init__(self, limiter: "_ProviderLimiter", tokens: int):
+        self.limiter = limiter
+        self.tokens = tokens
+        self.generation = limiter.generation
+        self.released = False
+
+    def release(self, used_tokens: Optional[int] = None):
+        if self.released:
+            return
+        self.released = True
+        self.limiter.release(self.tokens, used_tokens, self.generation)
+
+class _ProviderLimiter:
+    """
+    دلوا tokens لمزود واحد (طلبات/دقيقة و tokens/دقيقة) + حد للطلبات المتزامنة،
+    وطابور أولويات: الطلب في رأس الطابور يُخدم أولاً حتى لو كان طلب أقل أولوية يتسع الآن.
+
+    الدلاء مشتركة بين حلقات الأحداث، أما الطابور والـ Event والـ dispatcher فمرتبطة بالحلقة
+    الحالية: عند تغيرها (asyncio.run متتالية، عامل يعيد إنشاء حلقته) تُبنى من جديد.
+    """
+
+    def __init__(self, provider: str, rpm: float, tpm: float, max_concurrency: int):
+        self.provider = provider
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.request_tokens = rpm
+        self.token_tokens = tpm
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.updated_at = time.monotonic()
+
+        self._queue: List[Any] = []
+        self._sequence = itertools.count()
+        self._changed = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.generation = 0
+
+        self.stats = {"granted": 0, "waited": 0, "wait_seconds": 0.0, "rate_limited": 0}
+
+    def _bind_loop(self):
+        """ربط الطابور والـ dispatcher بالحلقة الجارية (إعادة بنائهما إن تغيرت)"""
+        loop = asyncio.get_running_loop()
+        if loop is self._loop:
+            return
+        if self._loop is not None:
+            stale = sum(1 for *_, future in self._queue if not future.done())
+            logger.warning(
+                f"⚠️ LLMScheduler: تغيرت حلقة الأحداث للمزود '{self.provider}' - إعادة بناء الطابور "
+                f"(تجاهل {stale} طلب منتظر و {self.in_flight} طلب جارٍ من الحلقة السابقة)"
+            )
+        # (مستقبلات وطلبات الحلقة السابقة لا يمكن إكمالها من هذه الحلقة؛ منحها القديم
+        # يُتجاهل عند تحريره عبر generation)
+        self._loop = loop
+        self.generation += 1
+        self._queue = []
+        self._changed = asyncio.Event()
+        self._dispatcher = None
+        self.in_flight = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        self.request_tokens = min(self.rpm, self.request_tokens + elapsed * self.rpm / 60.0)
+        self.token_tokens = min(self.tpm, self.token_tokens + elapsed * self.tpm / 60.0)
+
+    def _wait_time(self, tokens: int) -> Optional[float]:
+        """الثواني حتى يتسع الطلب (0 = الآن، None = ينتظر انتهاء طلب جارٍ)"""
+        self._refill()
+        waits = [max(self.paused_until - time.monotonic(), 0.0)]
+        if self.request_tokens < 1:
+            waits.append((1 - self.request_tokens) * 60.0 / self.rpm)
+        # (طلب أكبر من السعة كلها يُسمح به عند امتلاء الدلو بدلاً من انتظاره للأبد)
+        needed = min(tokens, self.tpm)
+        if self.token_tokens < needed:
+            waits.append((needed - self.token_tokens) * 60.0 / self.tpm)
+        wait = max(waits)
+        if wait <= 0 and self.in_flight >= self.max_concurrency:
+            return None
+        return wait
+
+    async def _dispatch(self):
+        generation = self.generation
+        while self._queue and generation == self.generation:
+            priority, _, tokens, future = self._queue[0]
+            if future.done():  # (أُلغي أثناء الانتظار)
+                heapq.heappop(self._queue)
+                continue
+
+            wait = self._wait_time(tokens)
+            if wait == 0:
+                heapq.heappop(self._queue)
+                self.request_tokens -= 1
+                self.token_tokens -= tokens
+                self.in_flight += 1
+                future.set_result(_Grant(self, tokens))
+                continue
+
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+        if generation == self.generation:
+            self._dispatcher = None
+
+    def _kick(self):
+        self._bind_loop()
+        self._changed.set()
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def acquire(self, tokens: int, priority: int) -> _Grant:
+        self._bind_loop()
+        future = self._loop.create_future()
+        heapq.heappush(self._queue, (priority, next(self._sequence), tokens, future))
+        started = time.monotonic()
+        self._kick()
+        try:
+            grant = await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                future.result().release()
+            future.cancel()
+            raise
+
+        self.stats["granted"] += 1
+        waited = time.monotonic() - started
+        if waited > 0.05:
+            self.stats["waited"] += 1
+            self.stats["wait_seconds"] += waited
+        return grant
+
+    def release(self, reserved_tokens: int, used_tokens: Optional[int] = None, generation: Optional[int] = None):
+        if generation is not None and generation != self.generation:
+            return  # (منح من حلقة سابقة: أُعيد ضبط in_flight عند تغير الحلقة)
+        self.in_flight -= 1
+        if used_tokens is not None:
+            # تصحيح الحجز بالاستهلاك الفعلي (قد يصبح الرصيد سالباً فينتظر التالي أكثر)
+            self._refill()
+            self.token_tokens = min(self.tpm, self.token_tokens + reserved_tokens - used_tokens)
+        if self._queue:
+            self._kick()
+
+    def pause(self, seconds: float):
+        """المزود رد بـ 429: إيقاف المنح مؤقتاً (الطلبات تنتظر في الطابور بدلاً من الفشل)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.stats["rate_limited"] += 1
+        if self._queue:
+            self._kick()
+
+# حدود كل مزود مشتركة بين كل المجدولات في العملية: كل منسق (المستشار، القاضي، الخصم،
+# مولد السيناريوهات...) ينشئ LLMScheduler خاصاً به، لكن حصة المزود واحدة.
+_PROVIDER_LIMITERS: Dict[str, _ProviderLimiter] = {}
+
+class LLMScheduler:
+    """
+    مجدول استدعاءات الـ LLM لكل مزود: حدود الطلبات/الدقيقة والـ tokens/الدقيقة
+    والطلبات المتزامنة، مع فئات أولوية (interactive قبل default قبل batch).
+
+    الحدود لكل مزود من إعدادات المنسق (rate_limits) أو من المتغيرات
+    LLM_RPM_<PROVIDER> / LLM_TPM_<PROVIDER> / LLM_CONCURRENCY_<PROVIDER>.
+
+    الحدود مشتركة على مستوى العملية (أول مجدول يطلب المزود يحدد إعداداته)، وليست
+    بين العمليات: مع عدة عمال (uvicorn --workers) تُضبط القيم بحصة كل عامل.
+    """
+
+    DEFAULT_RPM = float(os.getenv("LLM_DEFAULT_RPM", "60"))
+    DEFAULT_TPM = float(os.getenv("LLM_DEFAULT_TPM", "200000"))
+    DEFAULT_CONCURRENCY = int(os.getenv("LLM_DEFAULT_CONCURRENCY", "8"))
+    # الـ tokens المتوقعة للرد (تُضاف لحجم البرومبت عند الحجز)
+    EXPECTED_OUTPUT_TOKENS = int(os.getenv("LLM_EXPECTED_OUTPUT_TOKENS", "600"))
+    RATE_LIMIT_PAUSE = float(os.getenv("LLM_RATE_LIMIT_PAUSE", "10"))
+
+    def __init__(self, rate_limits: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.rate_limits = rate_limits or {}
+        self._limiters = _PROVIDER_LIMITERS
+
+    def _limiter(self, provider: str) -> _ProviderLimiter:
+        limiter = self._limiters.get(provider)
+        if limiter is None:
+            conf = self.rate_limits.get(provider, {})
+            name = provider.upper()
+            limiter = _ProviderLimiter(
+                provider,
+                rpm=float(conf.get("rpm") or os.getenv(f"LLM_RPM_{name}", self.DEFAULT_RPM)),
+                tpm=float(conf.get("tpm") or os.getenv(f"LLM_TPM_{name}", self.DEFAULT_TPM)),
+                max_concurrency=int(conf.get("max_concurrency") or os.getenv(f"LLM_CONCURRENCY_{name}", self.DEFAULT_CONCURRENCY)),
+            )
+            self._limiters[provider] = limiter
+        return limiter
+
+    @staticmethod
+    def priority_value(priority: str) -> int:
+        return PRIORITY_CLASSES.get(priority, PRIORITY_CLASSES["default"])
+
+    @staticmethod
+    def is_rate_limit_error(error: BaseException) -> bool:
+        text = str(error).lower()
+        return "429" in text or "rate limit" in text or "ratelimit" in text or "quota" in text \
+            or "resource_exhausted" in text or type(error).__name__ in ("RateLimitError", "ResourceExhausted")
+
+    async def acquire(self, provider: str, prompt_tokens: int, priority: str = "default") -> _Grant:
+        """حجز مكان لطلب (ينتظر في الطابور حسب الأولوية حتى يتسع الحد)"""
+        return await self._limiter(provider).acquire(
+            prompt_tokens + self.EXPECTED_OUTPUT_TOKENS, self.priority_value(priority)
+        )
+
+    @asynccontextmanager
+    async def slot(self, provider: str, prompt_tokens: int, priority: str = "default"):
+        grant = await self.acquire(provider, prompt_tokens, priority)
+        try:
+            yield grant
+        finally:
+            grant.release()
+
+    def report_rate_limited(self, provider: str, retry_after: Optional[float] = None):
+        logger.warning(f"🚦 LLMScheduler: المزود '{provider}' رد بتجاوز الحد - إيقاف المنح مؤقتاً")
+        self._limiter(provider).pause(retry_after or self.RATE_LIMIT_PAUSE)
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = {}
+        for provider, limiter in self._limiters.items():
+            limiter._refill()
+            stats[provider] = {
+                **limiter.stats,
+                "wait_seconds": round(limiter.stats["wait_seconds"], 2),
+                "queued": sum(1 for *_, future in limiter._queue if not future.done()),
+                "in_flight": limiter.in_flight,
+                "rpm": limiter.rpm, "tpm": limiter.tpm,
+                "available_requests": round(limiter.request_tokens, 1),
+                "available_tokens": int(limiter.token_tokens),
+            }
+        return stats
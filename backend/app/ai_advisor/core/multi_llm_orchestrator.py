@@ -1,21 +1,38 @@
 import logging
-from typing import Dict, Any, Optional, AsyncGenerator
+from typing import Dict, Any, Optional, AsyncGenerator, Awaitable, Callable, List, Tuple
 import os
 import asyncio
+import math
+import time
 
 # استيراد مدير الكاش
 from .cache_manager import CacheManager
+from .llm_router import LLMRouter
+from .llm_scheduler import LLMScheduler, CHARS_PER_TOKEN, estimate_tokens
 
 logger = logging.getLogger(__name__)
 
 class MultiLLMOrchestrator:
     """
-    منسق محسّن مع دعم AWS Bedrock ومعالجة أخطاء الاستيراد
+    منسق محسّن مع دعم AWS Bedrock ومعالجة أخطاء الاستيراد.
+    كل طلب يمر عبر LLMRouter: أصح نموذج في نفس الفئة، طلب تحوطي عند التأخر،
+    وتحويل للنموذج التالي عند الفشل. وكل استدعاء يحجز مكاناً في LLMScheduler
+    (حدود المزود + الأولوية) قبل الإرسال، فالطلبات تنتظر بدلاً من أن ترجع 429.
     """
+
+    # مهلة الطلب الكامل، ومهلة أول جزء في البث (بالثواني)
+    REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "120"))
+    FIRST_CHUNK_TIMEOUT = float(os.getenv("LLM_FIRST_CHUNK_TIMEOUT", "60"))
+    # إعادة المحاولة (بعد الانتظار في الطابور) عندما يرد المزود بتجاوز الحد
+    RATE_LIMIT_RETRIES = int(os.getenv("LLM_RATE_LIMIT_RETRIES", "2"))
     
     def __init__(self, config: Dict[str, Any], cache_manager: Optional[CacheManager] = None):
         self.models: Dict[str, Any] = {}
+        self.model_names: Dict[str, str] = {}
         self.cache_manager = cache_manager
+        self.providers: Dict[str, str] = {}
+        self.router = LLMRouter()
+        self.scheduler = LLMScheduler(config.get("rate_limits"))
         self._initialize_models(config.get("models", {}))
 
     def _initialize_models(self, models_config: Dict[str, Any]):
@@ -37,6 +54,9 @@ class MultiLLMOrchestrator:
                 model = self._create_model(provider, model_name, api_keys)
                 if model:
                     self.models[key] = model
+                    self.model_names[key] = model_name
+                    self.providers[key] = provider
+                    self.router.register(key, LLMRouter.tier_for(key, conf))
                     logger.info(f"✅ تم تهيئة نموذج '{key}' ({provider} - {model_name})")
                 else:
                     logger.warning(f"⚠️ لم يتم تهيئة نموذج '{key}' - المزود غير مدعوم: {provider}")
@@ -182,44 +202,219 @@ class MultiLLMOrchestrator:
         
         return model
 
+    def get_model_name(self, model_key: str = "fast") -> Optional[str]:
+        """اسم النموذج الفعلي خلف المفتاح (لاختيار المُرمّز عند عدّ الـ tokens)"""
+        return self.model_names.get(model_key)
+
+    def _build_chain(self, model_key: str, system_prompt: str, context: Optional[str]):
+        """سلسلة LangChain (برومبت | نموذج | محلل نصي) لنموذج محدد"""
+        model = self.models[model_key]
+
+        if context:
+            full_system_prompt = f"{system_prompt}\n\nالسياق:\n{context}"
+        else:
+            full_system_prompt = system_prompt
+
+        from langchain_core.prompts import ChatPromptTemplate
+        from langchain_core.output_parsers import StrOutputParser
+
+        prompt_template = ChatPromptTemplate.from_messages([
+            ("system", full_system_prompt),
+            ("human", "{input}")
+        ])
+
+        return prompt_template | model | StrOutputParser()
+
+    def _route(self, model_key: str, first_chunk: bool = False) -> List[str]:
+        """النماذج المرشحة بالترتيب (مع نفس البديل القديم إذا لم يكن للفئة نماذج)"""
+        candidates = [key for key in self.router.route(model_key, first_chunk) if self.models.get(key)]
+        if candidates:
+            return candidates
+
+        logger.warning(f"⚠️ النموذج '{model_key}' غير موجود. جاري استخدام نموذج بديل.")
+        for key, available_model in self.models.items():
+            if available_model:
+                logger.info(f"🔁 استخدام النموذج '{key}' كبديل")
+                return [key]
+        raise RuntimeError("❌ لا توجد نماذج LLM متاحة. تأكد من تكوين المفاتيح والمكتبات.")
+
+    async def _tracked(self, model_key: str, call: Callable[[], Awaitable[Any]], first_chunk: bool = False) -> Any:
+        """تنفيذ استدعاء لنموذج واحد مع تسجيل زمنه ونتيجته في الـ Router"""
+        self.router.acquire(model_key)
+        started = time.monotonic()
+        try:
+            result = await call()
+        except asyncio.CancelledError:
+            self.router.record_cancelled(model_key)
+            raise
+        except Exception as e:
+            if self.scheduler.is_rate_limit_error(e):
+                # (تجاوز الحد يعالجه المجدول بالإيقاف المؤقت - ليس عطلاً في النموذج يفتح الدائرة)
+                self.router.record_cancelled(model_key)
+            else:
+                self.router.record_failure(model_key)
+            raise
+        self.router.record_success(model_key, time.monotonic() - started, first_chunk=first_chunk)
+        return result
+
+    async def _scheduled(self, model_key: str, prompt_tokens: int, priority: str,
+                         call: Callable[[Any], Awaitable[Any]]) -> Any:
+        """
+        حجز مكان في حدود المزود ثم تنفيذ call(grant). عند رد 429 يُوقف المنح للمزود مؤقتاً
+        ويُعاد الطلب للطابور (بدلاً من إرجاع خطأ للمستخدم).
+        call مسؤول عن تحرير الحجز عند النجاح (البث يحتفظ به حتى نهايته).
+        """
+        provider = self.providers.get(model_key, "default")
+        attempt = 0
+        while True:
+            grant = await self.scheduler.acquire(provider, prompt_tokens, priority)
+            try:
+                return await call(grant)
+            except Exception as e:
+                grant.release()
+                if not self.scheduler.is_rate_limit_error(e) or attempt >= self.RATE_LIMIT_RETRIES:
+                    raise
+                self.scheduler.report_rate_limited(provider)
+                attempt += 1
+                logger.info(f"🚦 إعادة طلب '{model_key}' بعد تجاوز الحد (محاولة {attempt}/{self.RATE_LIMIT_RETRIES})")
+            except BaseException:
+                grant.release()
+                raise
+
+    async def _race(self,
+                    candidates: List[str],
+                    attempt: Callable[[str], Awaitable[Any]],
+                    first_chunk: bool = False,
+                    discard: Optional[Callable[[Any], Awaitable[None]]] = None) -> Tuple[str, Any]:
+        """
+        تشغيل الطلب على المرشح الأول؛ إذا تأخر عن عتبة التحوط يُرسل نفس الطلب للمرشح التالي
+        ويُعتمد الأسرع ويُلغى الآخر. عند فشل الطلب يُحوّل للمرشح التالي.
+
+        Args:
+            attempt: دالة تنفذ الطلب على مفتاح نموذج.
+            discard: تنظيف نتيجة خاسرة اكتملت في نفس اللحظة (مثل إغلاق بث مفتوح).
+        """
+        try:
+            return await self._race_candidates(candidates, attempt, first_chunk, discard)
+        finally:
+            # (تحرير الطلبات التجريبية المحجوزة عند التوجيه لمرشحين انتهوا أو لم يُستخدموا)
+            for key in candidates:
+                self.router.record_cancelled(key)
+
+    async def _race_candidates(self,
+                               candidates: List[str],
+                               attempt: Callable[[str], Awaitable[Any]],
+                               first_chunk: bool,
+                               discard: Optional[Callable[[Any], Awaitable[None]]]) -> Tuple[str, Any]:
+        last_error: Optional[BaseException] = None
+        index = 0
+        while index < len(candidates):
+            primary = candidates[index]
+            backup = candidates[index + 1] if index + 1 < len(candidates) else None
+            tasks: Dict[asyncio.Task, str] = {asyncio.create_task(attempt(primary)): primary}
+            try:
+                delay = self.router.hedge_delay(primary, first_chunk) if backup else None
+                if delay is not None:
+                    done, _ = await asyncio.wait(set(tasks), timeout=delay)
+                    if not done:
+                        self.router.stats["hedges"] += 1
+                        logger.info(f"🏁 LLMRouter: '{primary}' تجاوز {delay:.1f}ث - إرسال طلب تحوطي إلى '{backup}'")
+                        tasks[asyncio.create_task(attempt(backup))] = backup
+                        index += 1
+
+                pending = set(tasks)
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    winners = [task for task in done if not task.cancelled() and task.exception() is None]
+                    for task in done:
+                        if task.cancelled() or task.exception() is not None:
+                            last_error = None if task.cancelled() else task.exception()
+                            logger.warning(f"⚠️ فشل طلب النموذج '{tasks[task]}': {last_error}")
+                    if winners:
+                        winner = winners[0]
+                        for extra in winners[1:]:
+                            if discard:
+                                await discard(extra.result())
+                        if tasks[winner] != primary:
+                            self.router.stats["hedge_wins"] += 1
+                        return tasks[winner], winner.result()
+            finally:
+                # إلغاء الخاسر (أو كل الطلبات إذا أُلغي المستدعي نفسه)
+                for task in tasks:
+                    if not task.done():
+                        task.cancel()
+
+            index += 1
+            if index < len(candidates):
+                self.router.stats["failovers"] += 1
+                logger.info(f"🔁 LLMRouter: تحويل الطلب إلى '{candidates[index]}'")
+
+        raise last_error or RuntimeError("❌ فشلت كل النماذج المتاحة في هذه الفئة")
+
     async def generate_response_stream(
         self, 
         system_prompt: str, 
         human_prompt: str, 
         context: Optional[str] = None, 
-        model_key: str = "fast"
+        model_key: str = "fast",
+        priority: str = "interactive"
     ) -> AsyncGenerator[str, None]:
         """
-        إنشاء رد متدفق مع التعامل مع الأخطاء
+        إنشاء رد متدفق مع التعامل مع الأخطاء.
+        التوجيه والتحوط والتحويل عند الفشل تتم حتى وصول أول جزء (بعده لا يمكن تبديل النموذج).
+        الحجز في حدود المزود يبقى حتى نهاية البث (يُحتسب ضمن الطلبات المتزامنة).
         """
+        model_used = None
+        prompt_tokens = estimate_tokens(system_prompt, human_prompt, context)
         try:
-            model = self.get_model(model_key)
-            
-            if context:
-                full_system_prompt = f"{system_prompt}\n\nالسياق:\n{context}"
-            else:
-                full_system_prompt = system_prompt
-            
-            # استخدام LangChain للبث
-            from langchain_core.prompts import ChatPromptTemplate
-            from langchain_core.output_parsers import StrOutputParser
-            
-            prompt_template = ChatPromptTemplate.from_messages([
-                ("system", full_system_prompt),
-                ("human", "{input}")
-            ])
-            
-            chain = prompt_template | model | StrOutputParser()
-            
-            logger.debug(f"بدء بث الاستجابة باستخدام نموذج '{model_key}'...")
-            
+            async def _open_stream(key: str):
+                async def _call(grant):
+                    chain = self._build_chain(key, system_prompt, context)
+                    stream = chain.astream({"input": human_prompt}).__aiter__()
+
+                    async def _first():
+                        try:
+                            return await asyncio.wait_for(stream.__anext__(), timeout=self.FIRST_CHUNK_TIMEOUT)
+                        except StopAsyncIteration:
+                            return None
+
+                    try:
+                        first = await self._tracked(key, _first, first_chunk=True)
+                    except BaseException:
+                        await stream.aclose()
+                        raise
+                    return stream, first, grant
+
+                return await self._scheduled(key, prompt_tokens, priority, _call)
+
+            async def _close(opened):
+                await opened[0].aclose()
+                opened[2].release()
+
+            model_used, (stream, first, grant) = await self._race(
+                self._route(model_key, first_chunk=True), _open_stream, first_chunk=True, discard=_close
+            )
+            logger.debug(f"بدء بث الاستجابة باستخدام نموذج '{model_used}'...")
+
             # البث المتدفق
-            async for chunk in chain.astream({"input": human_prompt}):
-                yield chunk
-                await asyncio.sleep(0)  # للسماح بمهام أخرى
+            streamed_chars = 0
+            try:
+                if first is not None:
+                    streamed_chars += len(first)
+                    yield first
+                    async for chunk in stream:
+                        streamed_chars += len(chunk)
+                        yield chunk
+                        await asyncio.sleep(0)  # للسماح بمهام أخرى
+            finally:
+                await stream.aclose()
+                grant.release(prompt_tokens + math.ceil(streamed_chars / CHARS_PER_TOKEN))
 
         except Exception as e:
             logger.error(f"❌ خطأ أثناء بث الاستجابة: {e}")
+            if model_used and not self.scheduler.is_rate_limit_error(e):
+                # (فشل بعد بدء البث - أخطاء ما قبل أول جزء سُجلت في _tracked)
+                self.router.record_failure(model_used)
             yield f"\n\n[حدث خطأ في النظام: {e}]"
 
     async def generate_response(
@@ -228,47 +423,40 @@ class MultiLLMOrchestrator:
         human_prompt: str, 
         context: Optional[str] = None, 
         model_key: str = "fast",
-        use_cache: bool = True
+        use_cache: bool = True,
+        priority: str = "default"
     ) -> str:
         """
-        إنشاء رد كامل مع دعم الكاش
+        إنشاء رد كامل مع دعم الكاش (والتوجيه/التحوط/التحويل عند الفشل عبر LLMRouter).
+
+        Args:
+            priority: فئة الأولوية في طابور المزود ("interactive" | "default" | "batch").
         """
+        prompt_tokens = estimate_tokens(system_prompt, human_prompt, context)
         
-        # التحقق من الكاش
-        cache_key = ""
-        if self.cache_manager and use_cache:
-            cache_key = f"llm_response:{model_key}:{system_prompt}:{human_prompt}:{context}"
-            cached_response = await self.cache_manager.get(cache_key)
-            if cached_response:
-                logger.debug("LLM response (non-stream) HIT from cache.")
-                return cached_response
-
-        try:
-            model = self.get_model(model_key)
-            
-            if context:
-                full_system_prompt = f"{system_prompt}\n\nالسياق:\n{context}"
-            else:
-                full_system_prompt = system_prompt
-                
-            from langchain_core.prompts import ChatPromptTemplate
-            from langchain_core.output_parsers import StrOutputParser
-            
-            prompt_template = ChatPromptTemplate.from_messages([
-                ("system", full_system_prompt),
-                ("human", "{input}")
-            ])
-            
-            chain = prompt_template | model | StrOutputParser()
-            
-            logger.debug(f"إنشاء استجابة كاملة باستخدام نموذج '{model_key}'...")
-            response = await chain.ainvoke({"input": human_prompt})
+        async def _generate() -> str:
+            async def _invoke(key: str) -> str:
+                async def _call(grant) -> str:
+                    chain = self._build_chain(key, system_prompt, context)
+                    logger.debug(f"إنشاء استجابة كاملة باستخدام نموذج '{key}'...")
+                    response = await self._tracked(
+                        key, lambda: asyncio.wait_for(chain.ainvoke({"input": human_prompt}), timeout=self.REQUEST_TIMEOUT)
+                    )
+                    grant.release(prompt_tokens + estimate_tokens(response))
+                    return response
 
-            # تخزين في الكاش
-            if self.cache_manager and use_cache:
-                await self.cache_manager.set(cache_key, response, ttl=7200)
+                return await self._scheduled(key, prompt_tokens, priority, _call)
 
+            _, response = await self._race(self._route(model_key), _invoke)
             return response
+
+        try:
+            if not (self.cache_manager and use_cache):
+                return await _generate()
+
+            # الكاش مع Single-Flight: الطلبات المتزامنة لنفس البرومبت تنتظر استدعاءً واحداً
+            cache_key = f"llm_response:{model_key}:{system_prompt}:{human_prompt}:{context}"
+            return await self.cache_manager.get_or_set(cache_key, _generate, ttl=7200)
             
         except Exception as e:
             logger.error(f"❌ خطأ أثناء إنشاء الاستجابة: {e}")
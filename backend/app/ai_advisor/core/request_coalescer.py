@@ -0,0 +1,382 @@
+import asyncio
+import logging
+import os
+import uuid
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from .cache_manager import CacheManager
+
+logger = logging.getLogger(__name__)
+
+# حذف القفل فقط إذا كان ما زال مملوكاً لنفس العملية (token)
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+class _StreamFanout:
+    """
+    بث واحد من المصدر (مثل بث الـ LLM) يُوزع على عدة مشتركين.
+    المصدر يعمل في مهمة مستقلة، فانقطاع أحد العملاء لا يوقف البث للآخرين،
+    والمشترك المتأخر يستلم كل ما سبق من العناصر أولاً.
+    """
+
+    def __init__(self, source: AsyncIterator[Any]):
+        self.source = source
+        self.items: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self._condition = asyncio.Condition()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, on_done: Callable[[], None]):
+        async def _pump():
+            try:
+                async for item in self.source:
+                    async with self._condition:
+                        self.items.append(item)
+                        self._condition.notify_all()
+            except Exception as e:
+                self.error = e
+            finally:
+                async with self._condition:
+                    self.done = True
+                    self._condition.notify_all()
+                on_done()
+
+        self._task = asyncio.create_task(_pump())
+
+    async def subscribe(self) -> AsyncIterator[Any]:
+        self.subscribers += 1
+        position = 0
+        while True:
+            async with self._condition:
+                await self._condition.wait_for(lambda: position < len(self.items) or self.done)
+                pending = self.items[position:]
+                position = len(self.items)
+                finished = self.done
+
+            for item in pending:
+                yield item
+
+            if finished:
+                if self.error:
+                    raise self.error
+                return
+
+class _ChannelListener:
+    """
+    مشترك pub/sub واحد لكل عميل Redis في العملية (اتصال واحد من الـ pool) يوزع إعلانات
+    الانتهاء على المنتظرين المحليين حسب القناة، بدلاً من اتصال pub/sub لكل منتظر.
+    """
+
+    _instances: Dict[int, "_ChannelListener"] = {}
+
+    def __init__(self, client):
+        self.client = client
+        self.loop = asyncio.get_running_loop()
+        self.pubsub = None
+        self.waiters: Dict[str, List[asyncio.Future]] = {}
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def for_client(cls, client) -> "_ChannelListener":
+        listener = cls._instances.get(id(client))
+        if listener is None or listener.client is not client or listener.loop is not asyncio.get_running_loop():
+            listener = cls._instances[id(client)] = cls(client)
+        return listener
+
+    async def wait_for(self, channel: str) -> asyncio.Future:
+        """تسجيل منتظر للقناة: Future يكتمل عند إعلان الانتهاء"""
+        future = self.loop.create_future()
+        async with self._lock:
+            if self.pubsub is None:
+                pubsub = self.client.pubsub()
+                # (بعد انقطاع سابق: إعادة الاشتراك في قنوات المنتظرين الحاليين أيضاً)
+                await pubsub.subscribe(*{*self.waiters, channel})
+                self.pubsub = pubsub
+            elif channel not in self.waiters:
+                await self.pubsub.subscribe(channel)
+            self.waiters.setdefault(channel, []).append(future)
+            if self._task is None:
+                self._task = asyncio.create_task(self._listen(self.pubsub))
+        return future
+
+    async def discard(self, channel: str, future: asyncio.Future):
+        async with self._lock:
+            waiters = self.waiters.get(channel)
+            if waiters is None or future not in waiters:
+                return
+            waiters.remove(future)
+            if not waiters:
+                del self.waiters[channel]
+                await self._unsubscribe(channel)
+
+    async def _unsubscribe(self, channel: str):
+        if self.pubsub is None:
+            return
+        try:
+            await self.pubsub.unsubscribe(channel)
+        except Exception as e:
+            logger.debug(f"RequestCoalescer: تعذر إلغاء الاشتراك في {channel}: {e}")
+
+    async def _listen(self, pubsub):
+        try:
+            while True:
+                async with self._lock:
+                    if not self.waiters:
+                        self._detach(pubsub)
+                        break
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None:
+                    continue
+                channel = message["channel"]
+                if isinstance(channel, bytes):
+                    channel = channel.decode()
+                async with self._lock:
+                    for future in self.waiters.pop(channel, []):
+                        if not future.done():
+                            future.set_result(True)
+                    await self._unsubscribe(channel)
+        except Exception as e:
+            # (المنتظرون الحاليون يكملون بفحص القفل دورياً، والمنتظر التالي يعيد الاتصال)
+            logger.warning(f"⚠️ RequestCoalescer: انقطع مشترك pub/sub: {e}")
+            async with self._lock:
+                self._detach(pubsub)
+        try:
+            await pubsub.close()
+        except Exception:
+            pass
+
+    def _detach(self, pubsub):
+        """فك الاتصال المنتهي (المنتظر التالي ينشئ اتصالاً ومهمة استماع جديدين)"""
+        if self.pubsub is pubsub:
+            self.pubsub = None
+            self._task = None
+
+
+class RequestCoalescer:
+    """
+    دمج الطلبات المتطابقة الجارية (Single-Flight) على مستويين:
+
+    - داخل العملية: الطلبات المتزامنة لنفس المفتاح تنتظر حساباً واحداً،
+      والبث المتدفق يُوزع من بث واحد للـ LLM على كل المشتركين.
+    - بين العمليات (عبر Redis): أول عامل يأخذ قفلاً (SET NX PX)، والباقون
+      ينتظرون إعلان الانتهاء على قناة pub/sub (عبر مشترك واحد مشترك للعملية كلها)
+      ثم يقرؤون النتيجة من الكاش.
+      إذا انتهت صلاحية القفل أو المهلة دون نتيجة، يحسب العامل المنتظر بنفسه.
+    """
+
+    LOCK_PREFIX = "coalesce:lock:"
+    CHANNEL_PREFIX = "coalesce:done:"
+
+    LOCK_TTL_MS = int(os.getenv("COALESCE_LOCK_TTL_MS", "120000"))
+    WAIT_TIMEOUT = float(os.getenv("COALESCE_WAIT_TIMEOUT", "120"))
+    # فترة فحص القفل أثناء الانتظار (إذا توقف صاحبه دون إعلان)
+    POLL_INTERVAL = float(os.getenv("COALESCE_POLL_INTERVAL", "1.0"))
+
+    def __init__(self, cache_manager: Optional[CacheManager] = None,
+                 lock_ttl_ms: int = LOCK_TTL_MS, wait_timeout: float = WAIT_TIMEOUT):
+        self.cache_manager = cache_manager
+        self.lock_ttl_ms = lock_ttl_ms
+        self.wait_timeout = wait_timeout
+        # key -> [Task الحساب الجاري، عدد المنتظرين]
+        self._inflight: Dict[str, List[Any]] = {}
+        self._streams: Dict[str, _StreamFanout] = {}
+        self.stats = {
+            "leaders": 0, "local_followers": 0, "stream_followers": 0,
+            "remote_waits": 0, "remote_hits": 0, "remote_timeouts": 0, "remote_polls": 0,
+        }
+
+    # ------------------------------------------------------------------
+    # القفل بين العمليات
+    # ------------------------------------------------------------------
+    async def _redis(self):
+        if not self.cache_manager:
+            return None
+        return await self.cache_manager.get_redis()
+
+    async def _acquire(self, key: str) -> Optional[str]:
+        """
+        محاولة أخذ القفل. Returns:
+            token عند النجاح، "" إذا كان القفل مع عامل آخر، None إذا لم يتوفر Redis.
+        """
+        client = await self._redis()
+        if client is None:
+            return None
+        token = uuid.uuid4().hex
+        try:
+            acquired = await client.set(self.LOCK_PREFIX + key, token, nx=True, px=self.lock_ttl_ms)
+            return token if acquired else ""
+        except Exception as e:
+            logger.debug(f"RequestCoalescer: تعذر أخذ القفل: {e}")
+            return None
+
+    async def _release(self, key: str, token: Optional[str]):
+        if not token:
+            return
+        client = await self._redis()
+        if client is None:
+            return
+        try:
+            await client.eval(_RELEASE_LOCK_SCRIPT, 1, self.LOCK_PREFIX + key, token)
+            await client.publish(self.CHANNEL_PREFIX + key, b"1")
+        except Exception as e:
+            logger.debug(f"RequestCoalescer: تعذر تحرير القفل: {e}")
+
+    async def _wait_remote(self, key: str, result_fn: Callable[[], Awaitable[Any]]) -> Any:
+        """انتظار انتهاء العامل صاحب القفل ثم قراءة النتيجة من الكاش (None عند الفشل)"""
+        client = await self._redis()
+        if client is None:
+            return None
+
+        self.stats["remote_waits"] += 1
+        channel = self.CHANNEL_PREFIX + key
+        listener = _ChannelListener.for_client(client)
+        done: Optional[asyncio.Future] = None
+        try:
+            try:
+                done = await listener.wait_for(channel)
+            except Exception as e:
+                # (بدون اشتراك: الانتظار بفحص القفل دورياً فقط)
+                self.stats["remote_polls"] += 1
+                logger.debug(f"RequestCoalescer: تعذر الاشتراك في {channel} - انتظار بالفحص الدوري: {e}")
+
+            # ربما انتهى صاحب القفل قبل الاشتراك
+            value = await result_fn()
+            if value is not None:
+                self.stats["remote_hits"] += 1
+                return value
+
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.wait_timeout
+            while loop.time() < deadline:
+                if done is None:
+                    await asyncio.sleep(self.POLL_INTERVAL)
+                else:
+                    try:
+                        await asyncio.wait_for(asyncio.shield(done), timeout=self.POLL_INTERVAL)
+                        break
+                    except asyncio.TimeoutError:
+                        pass
+                # (صاحب القفل توقف دون إعلان - انتهت صلاحية القفل)
+                if not await client.exists(self.LOCK_PREFIX + key):
+                    break
+            else:
+                self.stats["remote_timeouts"] += 1
+
+            value = await result_fn()
+            if value is not None:
+                self.stats["remote_hits"] += 1
+            return value
+
+        except Exception as e:
+            logger.debug(f"RequestCoalescer: فشل انتظار العامل الآخر: {e}")
+            return None
+        finally:
+            if done is not None:
+                try:
+                    await listener.discard(channel, done)
+                except Exception:
+                    pass
+
+    # ------------------------------------------------------------------
+    # الواجهة العامة
+    # ------------------------------------------------------------------
+    async def run(self, key: str,
+                  factory: Callable[[], Awaitable[Any]],
+                  result_fn: Optional[Callable[[], Awaitable[Any]]] = None) -> Any:
+        """
+        تنفيذ factory مرة واحدة لكل المستدعين المتزامنين بنفس المفتاح.
+
+        Args:
+            factory: الحساب الفعلي (يجب أن يخزن نتيجته في الكاش قبل الانتهاء).
+            result_fn: قراءة النتيجة من الكاش المشترك (يفعّل الدمج بين العمليات).
+
+        الحساب يعمل في مهمة مستقلة (مثل البث المتدفق)، فانقطاع أحد العملاء لا يلغيه
+        للباقين؛ يُلغى فقط إذا أُلغي كل من ينتظره.
+        """
+        entry = self._inflight.get(key)
+        if entry is None:
+            task = asyncio.create_task(self._lead(key, factory, result_fn))
+            entry = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda _, entry=entry: self._release_inflight(key, entry))
+        else:
+            self.stats["local_followers"] += 1
+
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done():
+                self._release_inflight(key, entry)
+                task.cancel()
+
+    async def _lead(self, key: str,
+                    factory: Callable[[], Awaitable[Any]],
+                    result_fn: Optional[Callable[[], Awaitable[Any]]]) -> Any:
+        token = None
+        try:
+            if result_fn:
+                token = await self._acquire(key)
+                if token == "":
+                    value = await self._wait_remote(key, result_fn)
+                    if value is not None:
+                        return value
+
+            self.stats["leaders"] += 1
+            return await factory()
+        finally:
+            await self._release(key, token)
+
+    def _release_inflight(self, key: str, entry: List[Any]):
+        if self._inflight.get(key) is entry:
+            del self._inflight[key]
+
+    async def stream(self, key: str,
+                     source_factory: Callable[[], AsyncIterator[Any]],
+                     result_fn: Optional[Callable[[], Awaitable[Any]]] = None,
+                     replay_fn: Optional[Callable[[Any], AsyncIterator[Any]]] = None) -> AsyncIterator[Any]:
+        """
+        بث متدفق مدمج: أول مشترك يبدأ المصدر، والباقون يستلمون نفس العناصر.
+
+        بين العمليات: إذا كان عامل آخر يبث نفس السؤال، ننتظر انتهاءه ثم نعيد بث
+        النتيجة المخزنة عبر replay_fn بدلاً من استدعاء الـ LLM مرة ثانية.
+        """
+        fanout = self._streams.get(key)
+        if fanout is not None:
+            self.stats["stream_followers"] += 1
+        else:
+            async def _upstream():
+                token = None
+                try:
+                    if result_fn and replay_fn:
+                        token = await self._acquire(key)
+                        if token == "":
+                            value = await self._wait_remote(key, result_fn)
+                            if value is not None:
+                                async for item in replay_fn(value):
+                                    yield item
+                                return
+
+                    self.stats["leaders"] += 1
+                    async for item in source_factory():
+                        yield item
+                finally:
+                    await self._release(key, token)
+
+            fanout = _StreamFanout(_upstream())
+            self._streams[key] = fanout
+            fanout.start(on_done=lambda: self._streams.pop(key, None))
+
+        async for item in fanout.subscribe():
+            yield item
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "inflight": len(self._inflight), "active_streams": len(self._streams)}
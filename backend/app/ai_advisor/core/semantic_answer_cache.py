@@ -0,0 +1,329 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, List, Optional
+
+import numpy as np
+
+from .cache_manager import CacheManager
+
+logger = logging.getLogger(__name__)
+
+# المراجع القانونية في السؤال (بعد تحويل الأرقام العربية/الفارسية للاتينية):
+# رقم المادة، رقم/سنة القانون، اسم القانون ("قانون العمل")، وأي رقم آخر
+_DIGITS_TABLE = str.maketrans('٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹', '01234567890123456789')
+_NUMBER_REF_RE = re.compile(
+    r'(?:((?:ال)?ماد[ةه]|(?:ال)?قانون|(?:ل)?سن[ةه]|article|art\.?|law|year)\s*(?:رقم\s*)?)?(\d+)',
+    re.IGNORECASE
+)
+_LAW_NAME_RE = re.compile(r'قانون\s+(?!رقم)(ال[^\s\d،,.؟?:]+)')
+
+def legal_references(query: str) -> FrozenSet[str]:
+    """
+    المراجع القانونية المذكورة في السؤال. سؤالان عن مادتين أو قانونين مختلفين
+    متقاربان جداً في فضاء التضمين، لذلك لا يُقبل التطابق الدلالي إلا بنفس المراجع.
+    """
+    text = (query or '').translate(_DIGITS_TABLE)
+    references = set()
+    for keyword, number in _NUMBER_REF_RE.findall(text):
+        keyword = keyword.lower()
+        if 'ماد' in keyword or keyword.startswith('art'):
+            kind = 'article'
+        elif 'قانون' in keyword or keyword == 'law':
+            kind = 'law'
+        elif 'سن' in keyword or keyword == 'year':
+            kind = 'year'
+        else:
+            kind = 'number'
+        references.add(f"{kind}:{int(number)}")
+    for name in _LAW_NAME_RE.findall(text):
+        references.add(f"law_name:{name.replace('ة', 'ه')}")
+    return frozenset(references)
+
+@dataclass
+class _CacheEntry:
+    entry_id: str
+    query: str
+    embedding: np.ndarray
+    expires_at: float
+
+class SemanticAnswerCache:
+    """
+    كاش دلالي للإجابات: يعيد إجابة سؤال سابق عندما يكون السؤال الجديد
+    صياغة أخرى له (تشابه Cosine فوق الحد) وبنفس الفلاتر والمراجع القانونية تماماً.
+
+    - الفهرس (تضمينات الأسئلة المُجاب عنها) في الذاكرة، مقسم حسب بصمة الفلاتر
+      والمراجع (رقم المادة/القانون/السنة)، ومحدود الحجم (LRU)، والبحث فيه ضرب مصفوفة واحد.
+    - الفهرس مشترك بين العمليات عبر Redis (Hash لكل مجموعة) ويُزامن كل SYNC_INTERVAL.
+    - نص الإجابة والمصادر في CacheManager تحت rag_answer:sem:<id> بنفس الـ TTL.
+    - عند تغير نسخة المستندات (version_fn) يُفرغ الفهرس بالكامل.
+
+    الحد الافتراضي (0.97) متحفظ: نماذج e5 تعطي 0.9+ لأسئلة قانونية مختلفة المعنى،
+    ولا يُخفض إلا بعد معايرته على أزواج أسئلة حقيقية.
+    """
+
+    KEY_PREFIX = "rag_answer:sem:"
+    INDEX_PREFIX = "rag_answer:semidx:"
+
+    ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+    DEFAULT_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.97"))
+    DEFAULT_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+    DEFAULT_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "5000"))
+    VERSION_CHECK_INTERVAL = float(os.getenv("SEMANTIC_CACHE_VERSION_CHECK_SECONDS", "30"))
+    SYNC_INTERVAL = float(os.getenv("SEMANTIC_CACHE_SYNC_SECONDS", "10"))
+
+    def __init__(self,
+                 embedder,
+                 cache_manager: CacheManager,
+                 threshold: float = DEFAULT_THRESHOLD,
+                 ttl: int = DEFAULT_TTL,
+                 max_entries: int = DEFAULT_MAX_ENTRIES,
+                 version_fn: Optional[Callable[[], Awaitable[Any]]] = None):
+        """
+        Args:
+            embedder: كائن HybridEmbedder (تضمين الاستعلام يمر بنفس كاش التضمينات).
+            cache_manager: مخزن الإجابات نفسها.
+            threshold: أقل تشابه Cosine لاعتبار السؤالين متطابقين.
+            ttl: مدة صلاحية الإجابة بالثواني.
+            max_entries: أقصى عدد أسئلة في الفهرس (الأقدم استخداماً يُحذف أولاً).
+            version_fn: دالة async ترجع نسخة المستندات الحالية (تغيرها يبطل الكاش).
+        """
+        self.embedder = embedder
+        self.cache_manager = cache_manager
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.version_fn = version_fn
+
+        self._buckets: Dict[str, "OrderedDict[str, _CacheEntry]"] = {}
+        self._matrices: Dict[str, Optional[np.ndarray]] = {}
+        self._corpus_version: Any = None
+        self._version_checked_at = 0.0
+        self._synced_at: Dict[str, float] = {}
+
+        self.stats = {"lookups": 0, "hits": 0, "misses": 0, "stores": 0, "invalidations": 0}
+
+    # ------------------------------------------------------------------
+    # أدوات داخلية
+    # ------------------------------------------------------------------
+    @staticmethod
+    def filters_key(filters: Optional[Dict[str, Any]], references: FrozenSet[str] = frozenset()) -> str:
+        """بصمة الفلاتر والمراجع (الكاش لا يخلط بين إجابات بفلاتر أو مواد مختلفة)"""
+        payload = json.dumps([filters or {}, sorted(references)], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+    def _version_tag(self) -> str:
+        return hashlib.sha256(repr(self._corpus_version).encode('utf-8')).hexdigest()[:12]
+
+    def _index_key(self, bucket_key: str) -> str:
+        """مفتاح الفهرس المشترك (يتضمن نسخة المستندات: تغيرها يترك الفهرس القديم ينتهي بالـ TTL)"""
+        return f"{self.INDEX_PREFIX}{self._version_tag()}:{bucket_key}"
+
+    def _size(self) -> int:
+        return sum(len(bucket) for bucket in self._buckets.values())
+
+    def _matrix(self, bucket_key: str) -> Optional[np.ndarray]:
+        """مصفوفة التضمينات للمجموعة (تُبنى عند أول بحث بعد أي تعديل)"""
+        matrix = self._matrices.get(bucket_key)
+        if matrix is None:
+            bucket = self._buckets.get(bucket_key)
+            if not bucket:
+                return None
+            matrix = np.stack([entry.embedding for entry in bucket.values()])
+            self._matrices[bucket_key] = matrix
+        return matrix
+
+    def _remove(self, bucket_key: str, entry_id: str):
+        bucket = self._buckets.get(bucket_key)
+        if bucket and bucket.pop(entry_id, None) is not None:
+            self._matrices[bucket_key] = None
+
+    def _add(self, bucket_key: str, entry: _CacheEntry):
+        bucket = self._buckets.setdefault(bucket_key, OrderedDict())
+        bucket[entry.entry_id] = entry
+        self._matrices[bucket_key] = None
+
+        # حذف الأقدم استخداماً عند تجاوز الحد (من أكبر مجموعة)
+        while self._size() > self.max_entries:
+            largest_key = max(self._buckets, key=lambda k: len(self._buckets[k]))
+            oldest_id = next(iter(self._buckets[largest_key]))
+            self._remove(largest_key, oldest_id)
+
+    def _prune_expired(self, bucket_key: str):
+        """حذف كل المدخلات المنتهية من المجموعة (وليس أفضل تطابق فقط)"""
+        bucket = self._buckets.get(bucket_key)
+        if not bucket:
+            return
+        now = time.time()
+        for entry_id in [entry.entry_id for entry in bucket.values() if entry.expires_at < now]:
+            self._remove(bucket_key, entry_id)
+
+    async def _sync_bucket(self, bucket_key: str):
+        """دمج ما سجلته العمليات الأخرى في الفهرس المشترك (بحد أقصى مرة كل SYNC_INTERVAL)"""
+        if time.monotonic() - self._synced_at.get(bucket_key, 0.0) < self.SYNC_INTERVAL:
+            return
+        self._synced_at[bucket_key] = time.monotonic()
+        client = await self.cache_manager.get_redis()
+        if client is None:
+            return
+        index_key = self._index_key(bucket_key)
+        try:
+            shared = await client.hgetall(index_key)
+        except Exception as e:
+            logger.warning(f"⚠️ SemanticAnswerCache: تعذر قراءة الفهرس المشترك: {e}")
+            return
+
+        known = self._buckets.get(bucket_key, {})
+        now = time.time()
+        expired: List[bytes] = []
+        for field, data in shared.items():
+            entry_id = field.decode('utf-8') if isinstance(field, bytes) else field
+            if entry_id in known:
+                continue
+            try:
+                record = self.cache_manager.codec.decode(data)
+                if record["expires_at"] < now:
+                    expired.append(field)
+                    continue
+                embedding = np.frombuffer(base64.b64decode(record["embedding"]), dtype=np.float32)
+                self._add(bucket_key, _CacheEntry(entry_id, record["query"], embedding, record["expires_at"]))
+            except Exception as e:
+                logger.debug(f"SemanticAnswerCache: تجاهل مدخل غير قابل للفك في الفهرس المشترك: {e}")
+                expired.append(field)
+        if expired:
+            try:
+                await client.hdel(index_key, *expired)
+            except Exception:
+                pass
+
+    async def _publish(self, bucket_key: str, entry: _CacheEntry):
+        """إضافة المدخل للفهرس المشترك (كل مدخل حقل مستقل في Hash: لا تضيع كتابات متزامنة)"""
+        client = await self.cache_manager.get_redis()
+        if client is None:
+            return
+        record = {
+            "query": entry.query,
+            "embedding": base64.b64encode(entry.embedding.astype(np.float32).tobytes()).decode('ascii'),
+            "expires_at": entry.expires_at,
+        }
+        index_key = self._index_key(bucket_key)
+        try:
+            async with client.pipeline(transaction=False) as pipe:
+                pipe.hset(index_key, entry.entry_id, self.cache_manager.codec.encode(record))
+                pipe.expire(index_key, self.ttl)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"⚠️ SemanticAnswerCache: تعذر تحديث الفهرس المشترك: {e}")
+
+    async def _embed(self, query: str) -> np.ndarray:
+        vector = np.asarray(await self.embedder.get_embedding(query), dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    async def _check_version(self):
+        """إبطال الفهرس كاملاً إذا تغيرت نسخة المستندات (بحد أقصى فحص كل VERSION_CHECK_INTERVAL)"""
+        if not self.version_fn or time.monotonic() - self._version_checked_at < self.VERSION_CHECK_INTERVAL:
+            return
+        self._version_checked_at = time.monotonic()
+        try:
+            version = await self.version_fn()
+        except Exception as e:
+            logger.warning(f"⚠️ SemanticAnswerCache: تعذر قراءة نسخة المستندات: {e}")
+            return
+        if self._corpus_version is not None and version != self._corpus_version:
+            logger.info("♻️ SemanticAnswerCache: تغيرت المستندات - إبطال الإجابات المخزنة")
+            self.invalidate_all()
+        self._corpus_version = version
+
+    # ------------------------------------------------------------------
+    # الواجهة العامة
+    # ------------------------------------------------------------------
+    async def corpus_tag(self) -> str:
+        """
+        بصمة نسخة المستندات الحالية (لمفاتيح الكاش الدقيق أيضاً: تغير المستندات
+        يجعل كل الإجابات المخزنة قبلها غير قابلة للوصول، لا الدلالية فقط).
+        """
+        await self._check_version()
+        return self._version_tag()
+
+    async def lookup(self, query: str, filters: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """إرجاع إجابة مخزنة لسؤال مشابه دلالياً (أو None)"""
+        if not self.ENABLED:
+            return None
+        self.stats["lookups"] += 1
+        await self._check_version()
+
+        bucket_key = self.filters_key(filters, legal_references(query))
+        await self._sync_bucket(bucket_key)
+        self._prune_expired(bucket_key)
+        matrix = self._matrix(bucket_key)
+        if matrix is None:
+            self.stats["misses"] += 1
+            return None
+
+        query_vector = await self._embed(query)
+        similarities = matrix @ query_vector
+        entries = list(self._buckets[bucket_key].values())
+
+        # المرشحون فوق الحد بالترتيب: إذا حُذفت إجابة الأفضل من المخزن نجرب التالي
+        for index in np.argsort(-similarities):
+            similarity = float(similarities[index])
+            if similarity < self.threshold:
+                break
+            entry = entries[int(index)]
+            payload = await self.cache_manager.get(self.KEY_PREFIX + entry.entry_id)
+            if payload is None:
+                # (انتهت صلاحيتها أو حُذفت من المخزن)
+                self._remove(bucket_key, entry.entry_id)
+                continue
+
+            self._buckets[bucket_key].move_to_end(entry.entry_id)
+            self._matrices[bucket_key] = None
+            self.stats["hits"] += 1
+            logger.debug(f"🧠 SemanticAnswerCache HIT ({similarity:.3f}): '{query[:40]}' ~ '{entry.query[:40]}'")
+            return payload
+
+        self.stats["misses"] += 1
+        return None
+
+    async def store(self, query: str, filters: Optional[Dict[str, Any]], payload: Dict[str, Any]):
+        """تسجيل إجابة سؤال جديد في الفهرس (المحلي والمشترك) والمخزن"""
+        if not self.ENABLED:
+            return
+        bucket_key = self.filters_key(filters, legal_references(query))
+        entry = _CacheEntry(
+            entry_id=uuid.uuid4().hex,
+            query=query,
+            embedding=await self._embed(query),
+            expires_at=time.time() + self.ttl
+        )
+        await self.cache_manager.set(self.KEY_PREFIX + entry.entry_id, payload, ttl=self.ttl)
+
+        self._add(bucket_key, entry)
+        self.stats["stores"] += 1
+        await self._publish(bucket_key, entry)
+
+    def invalidate_all(self):
+        """إفراغ الفهرس (الإجابات في المخزن تنتهي بالـ TTL ولا يمكن الوصول إليها بعد ذلك)"""
+        self._buckets.clear()
+        self._matrices.clear()
+        self._synced_at.clear()
+        self.stats["invalidations"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.stats["lookups"] or 1
+        return {
+            **self.stats,
+            "hit_rate": round(self.stats["hits"] / lookups, 3),
+            "entries": self._size(),
+            "enabled": self.ENABLED,
+            "threshold": self.threshold,
+            "ttl": self.ttl,
+        }
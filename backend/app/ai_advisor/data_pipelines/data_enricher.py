@@ -50,7 +50,8 @@ class DataEnricher:
                 system_prompt=self.ENRICHMENT_PROMPT.format(text_sample=text_sample[:1500]), # عينة 1500 حرف
                 human_prompt="", # البرومبت مدمج بالكامل في النظام
                 model_key="fast",
-                use_cache=True # (الكاش هنا مفيد إذا تكررت العينات)
+                use_cache=True, # (الكاش هنا مفيد إذا تكررت العينات)
+                priority="batch" # (الإثراء أثناء الابتلاع ينتظر خلف طلبات المستخدمين)
             )
             
             # 2. استخراج قائمة JSON
@@ -98,22 +98,17 @@ class ExcelIngestionPipeline:
             texts = [c["text"] for c in chunks_data]
             embeddings = await self.embedder.get_embeddings(texts)
             
-            # (سنقوم باستدعاء الدالة الداخلية لـ pgvector مباشرة)
-            async with self.db_manager.pool.acquire() as conn:
-                async with conn.transaction():
-                    for i, (chunk, embedding) in enumerate(zip(chunks_data, embeddings)):
-                        await conn.execute('''
-                            INSERT INTO ai_document_chunks 
-                            (document_id, chunk_text, chunk_index, embedding, metadata, token_count)
-                            VALUES ($1, $2, $3, $4, $5, $6)
-                        ''', 
-                            document_id,
-                            chunk["text"],
-                            i,
-                            embedding.tolist(),
-                            json.dumps(chunk["metadata"]),
-                            len(chunk["text"].split()) # (تقدير تقريبي للتوكنز)
-                        )
+            # (كتابة جماعية عبر COPY؛ المتجهات تُرسل كـ float32 ثنائي عبر codec الـ pool)
+            rows = [
+                (chunk["text"], embedding, chunk["metadata"], None)
+                for chunk, embedding in zip(chunks_data, embeddings)
+            ]
+            await self.db_manager.bulk_insert_chunks(
+                document_id,
+                rows,
+                chunk_indexes=list(range(len(rows))),
+                token_counts=[len(chunk["text"].split()) for chunk in chunks_data]  # (تقدير تقريبي للتوكنز)
+            )
             
             logger.info(f"✅ تم ابتلاع {len(chunks_data)} مصطلح من ملف Excel.")
 
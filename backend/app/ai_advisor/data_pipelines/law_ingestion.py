@@ -1,8 +1,9 @@
 import logging
+import argparse
 import asyncio
 import os
 import sys
-from typing import Set, Dict, Any, List, Tuple
+from typing import Set, Dict, Any, List, Optional, Tuple
 from pathlib import Path
 
 # --- إعداد المسارات (مهم للتشغيل كسكريبت) ---
@@ -13,6 +14,8 @@ sys.path.insert(0, str(backend_dir))
 from app.ai_advisor.rag.semantic_retriever import SemanticRetriever
 from app.ai_advisor.rag.pgvector_manager import PgVectorManager
 from app.ai_advisor.rag.advanced_pdf_processor import AdvancedPDFProcessor  # تأكد من استيراد هذا
+from app.ai_advisor.data_pipelines.parallel_ingest import ParallelIngestEngine
+from app.ai_advisor.rag.ingest_manifest import FileChange, IngestPlan
 
 # --- إعدادات السكريبت ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -67,20 +70,38 @@ class LawIngestionPipeline:
         await self.retriever.initialize()
         logger.info("✅ تم تهيئة المسترجع الدلالي بنجاح")
     
-    async def get_processed_files(self) -> Set[str]:
-        """جلب قائمة الملفات المعالجة مسبقاً"""
-        logger.info("جاري جلب قائمة الملفات المعالجة مسبقاً...")
-        processed_files = set()
+    async def get_changed_files(self, all_files: List[Tuple[Path, str, str]],
+                                gc: bool = False) -> Optional[IngestPlan]:
+        """
+        مقارنة الملفات بسجل الابتلاع (البصمة + الحجم + mtime) وتطبيق ما لا يحتاج ابتلاعاً:
+        المسارات المنقولة، النسخ المكررة، وحذف مستندات الملفات المحذوفة.
+
+        Args:
+            gc: حذف مستندات الملفات المفقودة حتى لو تجاوزت حد الأمان (IngestManifest.GC_MAX_RATIO).
+
+        Returns:
+            الخطة (plan.to_ingest = الملفات الجديدة والمعدلة فقط)، أو None عند الفشل.
+        """
+        logger.info("جاري مقارنة الملفات بسجل الابتلاع...")
+        manifest = self.retriever.vector_db.ingest_manifest
+        # (مجلدات التصنيف المعروفة والموجودة حالياً فقط: ملفات خارجها ليست من مسؤولية هذا الخط،
+        #  ومجلد غير موجود - مثلاً وحدة بيانات غير مركّبة - لا يعني أن ملفاته حُذفت)
+        scope = [
+            str(path.resolve())
+            for country in COUNTRIES for category_folder in DOCUMENT_CATEGORIES
+            for path in [DATA_ROOT / "countries" / country / category_folder]
+            if os.path.isdir(path)
+        ]
         try:
-            async with self.retriever.vector_db.pool.acquire() as conn:
-                rows = await conn.fetch("SELECT file_path FROM ai_legal_documents WHERE file_path IS NOT NULL")
-                for row in rows:
-                    processed_files.add(str(Path(row['file_path']).resolve()))
-            logger.info(f"تم العثور على {len(processed_files)} ملف تمت معالجته.")
-            return processed_files
+            plan = await manifest.plan(
+                [str(file_path.resolve()) for file_path, _, _ in all_files],
+                scope=scope, extensions=SUPPORTED_FILE_TYPES
+            )
+            await manifest.sync(plan, force_gc=gc)
+            return plan
         except Exception as e:
-            logger.error(f"❌ فشل في جلب الملفات المعالجة: {e}")
-            return processed_files
+            logger.error(f"❌ فشل في مقارنة الملفات بسجل الابتلاع: {e}")
+            return None
 
     async def find_all_files(self) -> List[Tuple[Path, str, str]]:
         """البحث عن جميع الملفات المدعومة في هيكل المجلدات"""
@@ -107,29 +128,38 @@ class LawIngestionPipeline:
                     
         return files_to_process
 
-    async def process_file(self, file_path: Path, doc_type: str, country: str) -> bool:
-        """معالجة ملف فردي"""
+    @staticmethod
+    def build_metadata(file_path: Path, doc_type: str, country: str) -> Dict[str, Any]:
+        """البيانات الوصفية الأساسية للملف"""
+        return {
+            "title": file_path.stem,
+            "file_path": str(file_path.resolve()),
+            "file_size": file_path.stat().st_size,
+            "document_type": doc_type,
+            "country": country,
+            "source_folder": file_path.parent.name,
+            "file_extension": file_path.suffix.lower()
+        }
+
+    async def process_file(self, file_path: Path, doc_type: str, country: str,
+                           change: Optional[FileChange] = None) -> bool:
+        """معالجة ملف فردي (change: سجله في خطة الابتلاع، لإعادة ابتلاع مستند موجود وتسجيله بعد النجاح)"""
         try:
             logger.info(f"--- بدء معالجة: {file_path.name} (البلد: {country}, النوع: {doc_type}) ---")
             
             # البيانات الوصفية الأساسية
-            metadata = {
-                "title": file_path.stem,
-                "file_path": str(file_path.resolve()),
-                "file_size": file_path.stat().st_size,
-                "document_type": doc_type,
-                "country": country,
-                "source_folder": file_path.parent.name,
-                "file_extension": file_path.suffix.lower()
-            }
+            metadata = self.build_metadata(file_path, doc_type, country)
 
             # استدعاء الخدمة الرئيسية للابتلاع
             result = await self.retriever.ingest_legal_document(
                 pdf_path=str(file_path),
-                metadata=metadata
+                metadata=metadata,
+                document_id=change.document_id if change else None
             )
             
             if result.get("success"):
+                if change:
+                    await self.retriever.vector_db.ingest_manifest.record(change, result.get('document_id'))
                 logger.info(f"✅ تم ابتلاع {file_path.name} بنجاح.")
                 logger.info(f"   (ID: {result.get('document_id')}, المواد: {result.get('articles_processed')}, الأجزاء: {result.get('chunks_created')})")
                 return True
@@ -141,53 +171,106 @@ class LawIngestionPipeline:
             logger.error(f"❌ فشل كارثي أثناء معالجة {file_path.name}: {e}", exc_info=True)
             return False
 
-    async def run_pipeline(self):
-        """تشغيل خط الأنابيب الرئيسي"""
+    async def run_pipeline(self, workers: Optional[int] = None, gc: bool = False, **engine_options):
+        """
+        تشغيل خط الأنابيب الرئيسي.
+
+        Args:
+            workers: عدد عمليات التحليل المتوازي (None = عدد الأنوية - 1،
+                     0 = المسار التسلسلي القديم ملفاً بملف، مع تجربة AWS Textract أولاً).
+            gc: تأكيد حذف مستندات الملفات المفقودة حتى لو تجاوزت حد الأمان.
+            engine_options: queue_size / embed_batch_size / writers لـ ParallelIngestEngine.
+        """
         logger.info("🚀 بدء تشغيل خط أنابيب ابتلاع المستندات...")
         
         # 1. تهيئة الخدمات
         await self.initialize()
 
-        # 2. جلب الملفات الموجودة
-        processed_files = await self.get_processed_files()
-
-        # 3. البحث عن ملفات جديدة
+        # 2. البحث عن الملفات
         logger.info(f"البحث عن ملفات جديدة في: {DATA_ROOT}")
         all_files = await self.find_all_files()
-        
+
+        # 3. مقارنتها بسجل الابتلاع (الجديد والمعدل فقط يُبتلع)
+        plan = await self.get_changed_files(all_files, gc=gc)
+        if plan is None:
+            return
+        changes = {change.file_path: change for change in plan.to_ingest}
+
         files_to_process = []
         for file_path, doc_type, country in all_files:
-            resolved_path_str = str(file_path.resolve())
-            if resolved_path_str not in processed_files:
-                files_to_process.append((file_path, doc_type, country))
+            change = changes.get(str(file_path.resolve()))
+            if change:
+                files_to_process.append((file_path, doc_type, country, change))
             else:
-                logger.debug(f"تخطي ملف موجود: {file_path.name}")
+                logger.debug(f"تخطي ملف بدون تغيير: {file_path.name}")
 
         if not files_to_process:
-            logger.info("✅ لا توجد ملفات جديدة للمعالجة. النظام محدث.")
+            logger.info("✅ لا توجد ملفات جديدة أو معدلة للمعالجة. النظام محدث.")
             return
 
-        logger.info(f"تم العثور على {len(files_to_process)} ملف جديد للمعالجة...")
+        logger.info(f"تم العثور على {len(files_to_process)} ملف جديد أو معدل للمعالجة...")
 
         # 4. معالجة الملفات الجديدة
         successful_ingests = 0
         failed_ingests = 0
 
-        for file_path, doc_type, country in files_to_process:
-            success = await self.process_file(file_path, doc_type, country)
-            if success:
-                successful_ingests += 1
-            else:
-                failed_ingests += 1
-            logger.info("--- انتهاء معالجة الملف ---")
+        if workers == 0:
+            for file_path, doc_type, country, change in files_to_process:
+                success = await self.process_file(file_path, doc_type, country, change)
+                if success:
+                    successful_ingests += 1
+                else:
+                    failed_ingests += 1
+                logger.info("--- انتهاء معالجة الملف ---")
+        else:
+            # تحليل متوازٍ (Process Pool) -> تضمين دفعي -> كتابة async
+            engine = ParallelIngestEngine(self.retriever, workers=workers, **engine_options)
+            summary = await engine.run(
+                [
+                    (str(file_path), self.build_metadata(file_path, doc_type, country))
+                    for file_path, doc_type, country, _ in files_to_process
+                ],
+                replace={path: change.document_id for path, change in changes.items() if change.document_id is not None}
+            )
+            for result in summary["results"]:
+                if result["success"]:
+                    await self.retriever.vector_db.ingest_manifest.record(changes[result["file_path"]], result["document_id"])
+            successful_ingests = summary["successful"]
+            failed_ingests = summary["failed"]
+            logger.info(f"⏱️ الزمن الكلي: {summary['wall_seconds']}ث")
 
         logger.info("🏁 اكتمل خط الأنابيب.")
         logger.info(f"ملخص: {successful_ingests} نجاح، {failed_ingests} فشل.")
 
+        # 5. إعادة بناء فهرس المتجهات (CONCURRENTLY) إذا نمت البيانات بشكل كبير
+        if successful_ingests:
+            await self.retriever.vector_db.index_manager.maybe_rebuild()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="ابتلاع المستندات القانونية في قاعدة المعرفة")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="عدد عمليات التحليل المتوازي (الافتراضي: عدد الأنوية - 1، 0 = تسلسلي)")
+    parser.add_argument("--queue-size", type=int, default=ParallelIngestEngine.DEFAULT_QUEUE_SIZE,
+                        help="سعة الطوابير بين المراحل (بالمستندات)")
+    parser.add_argument("--embed-batch", type=int, default=ParallelIngestEngine.DEFAULT_EMBED_BATCH,
+                        help="أقصى عدد أجزاء في دفعة التضمين الواحدة")
+    parser.add_argument("--writers", type=int, default=ParallelIngestEngine.DEFAULT_WRITERS,
+                        help="عدد الكتابات المتزامنة في قاعدة البيانات")
+    parser.add_argument("--gc", action="store_true",
+                        help="حذف مستندات الملفات المفقودة حتى لو تجاوزت نسبة الأمان من السجل")
+    return parser.parse_args()
+
 async def main():
     """الوظيفة الرئيسية"""
+    args = parse_args()
     pipeline = LawIngestionPipeline(database_url=AI_DATABASE_URL)
-    await pipeline.run_pipeline()
+    await pipeline.run_pipeline(
+        workers=args.workers,
+        gc=args.gc,
+        queue_size=args.queue_size,
+        embed_batch_size=args.embed_batch,
+        writers=args.writers
+    )
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
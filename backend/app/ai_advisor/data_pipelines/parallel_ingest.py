@@ -0,0 +1,290 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from ..rag.advanced_pdf_processor import AdvancedPDFProcessor, ProcessingResult
+from ..rag.smart_chunker import SmartChunker
+from ..rag.semantic_retriever import SemanticRetriever
+
+logger = logging.getLogger(__name__)
+
+# --- عمليات التحليل (Process Pool) ---
+# كل عملية تنشئ معالج PDF ومقسّماً مرة واحدة عند بدئها (كشف المعالجات مكلف)
+_PROCESSOR: Optional[AdvancedPDFProcessor] = None
+_CHUNKER: Optional[SmartChunker] = None
+
+def _init_parse_worker():
+    global _PROCESSOR, _CHUNKER
+    logging.getLogger().setLevel(logging.WARNING)  # (لا نغرق السجل بسجلات كل عملية)
+    # (المستندات موزعة على العمليات أصلاً: لا عمليات إضافية لصفحات المستند الواحد)
+    _PROCESSOR = AdvancedPDFProcessor(page_workers=1)
+    _CHUNKER = SmartChunker()
+
+@dataclass
+class ParsedDocument:
+    """مستند بعد التحليل والتقسيم (يُنقل بين العمليات، فيجب أن يكون قابلاً للـ pickle)"""
+    metadata: Dict[str, Any]
+    result: Optional[ProcessingResult] = None
+    texts: List[str] = field(default_factory=list)
+    row_meta: List[Dict[str, Any]] = field(default_factory=list)
+    article_numbers: List[Optional[str]] = field(default_factory=list)
+    parse_seconds: float = 0.0
+    error: Optional[str] = None
+
+def _parse_file(file_path: str, metadata: Dict[str, Any]) -> ParsedDocument:
+    """يعمل داخل عملية منفصلة: تحليل الملف واستخراج المواد وتقسيمه إلى أجزاء"""
+    started = time.perf_counter()
+    try:
+        result = _PROCESSOR.process_legal_document(file_path)
+        texts, row_meta, article_numbers = SemanticRetriever.build_chunk_rows(result, metadata, _CHUNKER)
+        return ParsedDocument(metadata, result, texts, row_meta, article_numbers,
+                              parse_seconds=time.perf_counter() - started)
+    except Exception as e:
+        return ParsedDocument(metadata, parse_seconds=time.perf_counter() - started, error=str(e))
+
+@dataclass
+class StageStats:
+    """إحصائيات مرحلة واحدة (الزمن الفعلي المشغول وليس زمن الانتظار في الطوابير)"""
+    name: str
+    documents: int = 0
+    chunks: int = 0
+    failed: int = 0
+    busy_seconds: float = 0.0
+
+    def report(self, wall_seconds: float) -> Dict[str, Any]:
+        return {
+            "documents": self.documents,
+            "chunks": self.chunks,
+            "failed": self.failed,
+            "busy_seconds": round(self.busy_seconds, 2),
+            "docs_per_sec": round(self.documents / wall_seconds, 2) if wall_seconds > 0 else 0.0,
+            "chunks_per_sec": round(self.chunks / wall_seconds, 1) if wall_seconds > 0 else 0.0,
+        }
+
+_DONE = object()
+
+class ParallelIngestEngine:
+    """
+    ابتلاع متوازٍ على ثلاث مراحل بينها طوابير محدودة (Backpressure):
+
+        [Process Pool: تحليل PDF + استخراج المواد + تقسيم]
+            -> parsed_queue ->
+        [عامل تضمين واحد: يجمع أجزاء عدة مستندات في دفعة واحدة]
+            -> write_queue ->
+        [كتّاب async: سجل المستند + COPY للأجزاء]
+
+    التحليل (CPU) لا يعمل داخل الـ Event Loop، والتضمين يبقى في عامل واحد
+    (النموذج محمل مرة واحدة)، وقاعدة البيانات تستقبل كتابات جماعية متوازية.
+    المستندات المعدلة (replace) لا تُضمَّن في الدفعة: الكاتب يحدّثها بالفرق فقط
+    (SemanticRetriever.diff_chunks) فيُضمَّن ما تغير من المواد وحده.
+    """
+
+    DEFAULT_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "16"))
+    DEFAULT_EMBED_BATCH = int(os.getenv("INGEST_EMBED_BATCH", "256"))
+    DEFAULT_WRITERS = int(os.getenv("INGEST_WRITERS", "2"))
+    # عمليات التحليل تبدأ نظيفة (spawn/forkserver): fork من عملية فيها Event Loop
+    # وثريدات torch/العامل المخصص للتضمين قد يرث أقفالاً مقفلة فتتجمد العملية الفرعية
+    START_METHOD = os.getenv("INGEST_START_METHOD", "spawn")
+
+    def __init__(self,
+                 retriever: SemanticRetriever,
+                 workers: Optional[int] = None,
+                 queue_size: int = DEFAULT_QUEUE_SIZE,
+                 embed_batch_size: int = DEFAULT_EMBED_BATCH,
+                 writers: int = DEFAULT_WRITERS):
+        """
+        Args:
+            retriever: مسترجع مهيأ (قاعدة البيانات + نموذج التضمين).
+            workers: عدد عمليات التحليل (الافتراضي: عدد الأنوية - 1).
+            queue_size: سعة كل طابور بين المراحل (بالمستندات).
+            embed_batch_size: أقصى عدد أجزاء في استدعاء تضمين واحد.
+            writers: عدد مهام الكتابة المتزامنة في قاعدة البيانات.
+        """
+        self.retriever = retriever
+        self.workers = workers or max((os.cpu_count() or 2) - 1, 1)
+        self.queue_size = queue_size
+        self.embed_batch_size = embed_batch_size
+        self.writers = max(writers, 1)
+
+        self.parse_stats = StageStats("parse")
+        self.embed_stats = StageStats("embed")
+        self.write_stats = StageStats("write")
+        self._replace: Dict[str, int] = {}
+
+    # ------------------------------------------------------------------
+    # المراحل
+    # ------------------------------------------------------------------
+    async def _parse_stage(self, files: List[Tuple[str, Dict[str, Any]]], parsed_queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        # المستندات قيد التحليل أو المنتظرة لمكان في الطابور التالي محدودة،
+        # فإذا تباطأ التضمين يتوقف إرسال ملفات جديدة للـ Pool (ولا تتراكم في الذاكرة)
+        in_flight = asyncio.Semaphore(self.workers * 2)
+
+        async def _parse_one(pool: ProcessPoolExecutor, file_path: str, metadata: Dict[str, Any]):
+            try:
+                try:
+                    parsed = await loop.run_in_executor(pool, _parse_file, file_path, metadata)
+                except Exception as e:
+                    parsed = ParsedDocument(metadata, error=str(e))
+
+                self.parse_stats.busy_seconds += parsed.parse_seconds
+                if parsed.error or not parsed.texts:
+                    self.parse_stats.failed += 1
+                    logger.error(f"❌ فشل تحليل {os.path.basename(file_path)}: {parsed.error or 'لا توجد أجزاء صالحة'}")
+                    return
+                self.parse_stats.documents += 1
+                self.parse_stats.chunks += len(parsed.texts)
+                await parsed_queue.put(parsed)
+            finally:
+                in_flight.release()
+
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_parse_worker,
+                                     mp_context=multiprocessing.get_context(self.START_METHOD)) as pool:
+                tasks = []
+                for file_path, metadata in files:
+                    await in_flight.acquire()
+                    tasks.append(asyncio.create_task(_parse_one(pool, file_path, metadata)))
+                await asyncio.gather(*tasks)
+        finally:
+            await parsed_queue.put(_DONE)
+
+    async def _embed_stage(self, parsed_queue: asyncio.Queue, write_queue: asyncio.Queue):
+        try:
+            await self._embed_loop(parsed_queue, write_queue)
+        finally:
+            for _ in range(self.writers):
+                await write_queue.put(_DONE)
+
+    async def _embed_loop(self, parsed_queue: asyncio.Queue, write_queue: asyncio.Queue):
+        finished = False
+        while not finished:
+            batch: List[ParsedDocument] = []
+            item = await parsed_queue.get()
+            if item is _DONE:
+                break
+            batch.append(item)
+
+            # تجميع ما هو جاهز حالياً من مستندات حتى حجم الدفعة (بدون انتظار)
+            total = len(item.texts)
+            while total < self.embed_batch_size and not parsed_queue.empty():
+                item = parsed_queue.get_nowait()
+                if item is _DONE:
+                    finished = True
+                    break
+                batch.append(item)
+                total += len(item.texts)
+
+            # (المستندات المعدلة تُمرر للكاتب بدون تضمين: يضمّن الأجزاء المتغيرة فقط)
+            updates = [document for document in batch if document.metadata.get('file_path') in self._replace]
+            batch = [document for document in batch if document.metadata.get('file_path') not in self._replace]
+            for document in updates:
+                await write_queue.put((document, None))
+            if not batch:
+                continue
+
+            texts = [text for document in batch for text in document.texts]
+            started = time.perf_counter()
+            embeddings = await self.retriever.embedder.get_embeddings(texts)
+            self.embed_stats.busy_seconds += time.perf_counter() - started
+
+            if len(embeddings) != len(texts):
+                self.embed_stats.failed += len(batch)
+                logger.error(f"❌ فشل تضمين دفعة من {len(batch)} مستند ({len(texts)} جزء)")
+                continue
+
+            offset = 0
+            for document in batch:
+                count = len(document.texts)
+                await write_queue.put((document, embeddings[offset:offset + count]))
+                offset += count
+                self.embed_stats.documents += 1
+                self.embed_stats.chunks += count
+
+    async def _write_stage(self, write_queue: asyncio.Queue, results: List[Dict[str, Any]]):
+        while True:
+            item = await write_queue.get()
+            if item is _DONE:
+                return
+            document, embeddings = item
+            title = document.metadata.get('title')
+            file_path = document.metadata.get('file_path')
+            existing_id = self._replace.get(file_path)
+            started = time.perf_counter()
+            try:
+                document_id = await self.retriever._save_document_to_db(document.result, document.metadata, existing_id)
+                if embeddings is None:
+                    diff = await self.retriever.diff_chunks(
+                        document.result, document_id, document.texts,
+                        document.row_meta, document.article_numbers
+                    )
+                    chunks = diff["embedded"]
+                else:
+                    chunks = await self.retriever.write_chunks(
+                        document.result, document_id, document.texts, embeddings,
+                        document.row_meta, document.article_numbers
+                    )
+                self.write_stats.documents += 1
+                self.write_stats.chunks += chunks
+                results.append({"success": True, "title": title, "file_path": file_path, "document_id": document_id,
+                                "articles_processed": len(document.result.articles), "chunks_created": chunks})
+                logger.info(f"✅ تم ابتلاع {title} (ID: {document_id}, الأجزاء: {chunks})")
+            except Exception as e:
+                self.write_stats.failed += 1
+                results.append({"success": False, "title": title, "file_path": file_path, "error": str(e)})
+                logger.error(f"❌ فشل حفظ {title}: {e}")
+            finally:
+                self.write_stats.busy_seconds += time.perf_counter() - started
+
+    # ------------------------------------------------------------------
+    # التشغيل
+    # ------------------------------------------------------------------
+    async def run(self, files: List[Tuple[str, Dict[str, Any]]],
+                  replace: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+        """
+        ابتلاع قائمة ملفات [(المسار، البيانات الوصفية)].
+
+        Args:
+            replace: {metadata['file_path']: document_id} للملفات المعدلة - يُحدَّث المستند
+                     الموجود وأجزاؤه المتغيرة فقط بدلاً من إنشاء مستند جديد.
+
+        Returns:
+            ملخص بعدد النجاح/الفشل وإنتاجية كل مرحلة.
+        """
+        started = time.perf_counter()
+        parsed_queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        write_queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        results: List[Dict[str, Any]] = []
+        self._replace = dict(replace or {})
+
+        logger.info(
+            f"🚀 ابتلاع متوازٍ: {len(files)} ملف، {self.workers} عملية تحليل، "
+            f"دفعة تضمين {self.embed_batch_size}، {self.writers} كاتب"
+        )
+        await asyncio.gather(
+            self._parse_stage(files, parsed_queue),
+            self._embed_stage(parsed_queue, write_queue),
+            *(self._write_stage(write_queue, results) for _ in range(self.writers)),
+        )
+
+        wall = time.perf_counter() - started
+        summary = {
+            "files": len(files),
+            "successful": sum(1 for r in results if r["success"]),
+            "failed": len(files) - sum(1 for r in results if r["success"]),
+            "wall_seconds": round(wall, 2),
+            "stages": {stats.name: stats.report(wall) for stats in (self.parse_stats, self.embed_stats, self.write_stats)},
+            "results": results,
+        }
+        for name, report in summary["stages"].items():
+            logger.info(
+                f"📊 مرحلة {name}: {report['documents']} مستند، {report['chunks']} جزء، "
+                f"{report['failed']} فشل - {report['docs_per_sec']} مستند/ث، {report['chunks_per_sec']} جزء/ث "
+                f"(مشغولة {report['busy_seconds']}ث)"
+            )
+        return summary
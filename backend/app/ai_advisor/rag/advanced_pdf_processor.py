@@ -1,15 +1,42 @@
 # backend/app/ai_advisor/rag/advanced_pdf_processor.py
 import os
 import logging
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 import requests
 import json
 from dataclasses import dataclass
-from typing import List, Dict, Any, Optional
+from typing import Callable, Iterator, List, Dict, Any, Optional, Tuple
 import re
 
 logger = logging.getLogger(__name__)
 
+# --- كشف المواد: تعبير واحد مُجمّع لكل صيغ رأس المادة ---
+# (المادة 12 / مادة (١٢) / المادة 12 مكرر / Article 12) - الرقم بالأرقام العربية أو الهندية
+_ARTICLE_HEADER = (
+    r'(?:(?:ال)?مادة|Article|ARTICLE)\s*[\(\[]?\s*(?P<number>[0-9٠-٩۰-۹]+)\s*[\)\]]?'
+    r'(?P<bis>\s*مكرر(?:اً|ا)?)?\s*[:\-–.]?'
+)
+# الرأس في بداية سطر (مع رموز markdown/تعداد اختيارية): لا تُقطع المادة عند "وفقاً للمادة 5"
+_LINE_HEADER_RE = re.compile(r'^[ \t#*>•\-–]*' + _ARTICLE_HEADER, re.MULTILINE)
+# للنصوص المستخرجة بلا أسطر: الرأس بعد مسافة أو علامة ترقيم
+_INLINE_HEADER_RE = re.compile(r'(?:^|(?<=[\s.:؛]))' + _ARTICLE_HEADER)
+# رأس مقطوع في آخر الصفحة (الرقم في الصفحة التالية) - في بداية سطر فقط مثل _LINE_HEADER_RE
+# (وإلا صارت "وفقاً للمادة" + "5 من قانون..." رأس مادة وهمية في الصفحة التالية)
+_PARTIAL_HEADER_RE = re.compile(
+    r'^[ \t#*>•\-–]*(?:(?:ال)?مادة|Article|ARTICLE)[ \t]*[\(\[]?\s*\Z', re.MULTILINE
+)
+_PAGE_MARKER_RE = re.compile(r'\n--- الصفحة (\d+) ---\n')
+_DIGITS = str.maketrans('٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹', '01234567890123456789')
+
+# أقصى حجم لمحتوى المادة (يُقص عند 2000 حرف بعد التنظيف، فلا داعي لتجميع أكثر)
+MAX_ARTICLE_CHARS = 2000
+_MAX_ARTICLE_BUFFER = MAX_ARTICLE_CHARS * 2
+
 @dataclass
 class LegalArticle:
     number: str
@@ -28,10 +55,158 @@ class ProcessingResult:
     stats: Dict[str, Any]
     metadata: Dict[str, Any]
 
+class ArticleScanner:
+    """
+    كشف المواد على دفعات (صفحة بصفحة) بمرور واحد لتعبير منتظم مُجمّع:
+
+    - كل رأس مادة يغلق المادة السابقة ويبدأ مادة جديدة برقم الصفحة الفعلي.
+    - الذاكرة محدودة: المادة المفتوحة فقط في المخزن (حتى _MAX_ARTICLE_BUFFER حرف).
+    - المواد المكررة بنفس الرقم (ومكرر) تُدمج: يبقى المحتوى الأطول في موضع أول ظهور.
+    """
+
+    def __init__(self, inline: bool = False):
+        self._header_re = _INLINE_HEADER_RE if inline else _LINE_HEADER_RE
+        # (النقل بين الصفحات في وضع الأسطر فقط: بدون أسطر لا يمكن تمييز الرأس من الإحالة)
+        self._carry_partial = not inline
+        self._articles: Dict[str, LegalArticle] = {}
+        self._current: Optional[Tuple[str, int]] = None
+        self._parts: List[str] = []
+        self._size = 0
+        self._carry = ""
+        self.duplicates = 0
+
+    @staticmethod
+    def _article_number(match) -> str:
+        number = str(int(match.group('number').translate(_DIGITS)))
+        return f"{number} مكرر" if match.group('bis') else number
+
+    def _append(self, fragment: str):
+        if self._current is None or self._size >= _MAX_ARTICLE_BUFFER:
+            return
+        fragment = fragment[:_MAX_ARTICLE_BUFFER - self._size]
+        self._parts.append(fragment)
+        self._size += len(fragment)
+
+    def _close(self):
+        if self._current is None:
+            return
+        number, page = self._current
+        content = AdvancedPDFProcessor._clean_article_content("".join(self._parts))
+        self._current, self._parts, self._size = None, [], 0
+        if len(content) <= 10:  # تأكد أن المحتوى ليس قصيراً جداً
+            return
+        existing = self._articles.get(number)
+        if existing is not None:
+            self.duplicates += 1
+            if len(existing.content) >= len(content):
+                return
+        self._articles[number] = LegalArticle(
+            number=number,
+            content=content,
+            page=page,
+            full_text=f"المادة {number}: {content}",
+            tokens=len(content.split())
+        )
+
+    def feed(self, text: str, page: int):
+        if self._parts and not self._carry:
+            self._append("\n")  # (حد الصفحة داخل المادة المفتوحة)
+        text = self._carry + text
+        self._carry = ""
+        partial = _PARTIAL_HEADER_RE.search(text) if self._carry_partial else None
+        if partial:
+            text, self._carry = text[:partial.start()], text[partial.start():]
+
+        position = 0
+        for match in self._header_re.finditer(text):
+            self._append(text[position:match.start()])
+            self._close()
+            self._current = (self._article_number(match), page)
+            position = match.end()
+        self._append(text[position:])
+
+    def finish(self) -> List[LegalArticle]:
+        self._append(self._carry)
+        self._carry = ""
+        self._close()
+        return list(self._articles.values())
+
+def _ordered_map(executor: Executor, fn: Callable, tasks: List[Tuple], window: int) -> Iterator[Any]:
+    """
+    تنفيذ المهام بالتوازي مع إرجاع النتائج بترتيبها، وبحد أقصى window مهمة قيد التنفيذ
+    (النتائج المنتهية لا تتراكم في الذاكرة أمام مستهلك بطيء).
+    """
+    pending: deque = deque()
+    remaining = iter(tasks)
+    for task in remaining:
+        pending.append(executor.submit(fn, *task))
+        if len(pending) >= window:
+            break
+    try:
+        while pending:
+            result = pending.popleft().result()
+            task = next(remaining, None)
+            if task is not None:
+                pending.append(executor.submit(fn, *task))
+            yield result
+    finally:
+        # (المستهلك توقف أو فشلت مهمة: لا نترك مهاماً معلقة في Pool مشترك)
+        for future in pending:
+            future.cancel()
+
+def _extract_pages_pymupdf(pdf_path: str, start: int, stop: int) -> List[Tuple[int, str]]:
+    """نص مجموعة صفحات [start, stop) - يعمل في عملية منفصلة (fitz ليس آمناً للخيوط)"""
+    import fitz
+    with fitz.open(pdf_path) as doc:
+        return [(number + 1, doc[number].get_text()) for number in range(start, stop)]
+
+def _ocr_pages(pdf_path: str, first: int, last: int, dpi: int) -> List[Tuple[int, str]]:
+    """OCR لمجموعة صفحات [first, last] (tesseract يعمل كعملية خارجية، فالخيوط تكفي)"""
+    import pytesseract
+    import pdf2image
+    images = pdf2image.convert_from_path(pdf_path, dpi=dpi, first_page=first, last_page=last)
+    return [(first + i, pytesseract.image_to_string(image, lang='ara+eng')) for i, image in enumerate(images)]
+
+# Pool عمليات الصفحات مشترك على مستوى العملية (لكل عدد عمال): المعالج يُنشأ لكل
+# مستند، وبدء عمليات spawn جديدة لكل مستند يستهلك أكثر مما يوفره التوازي
+_PAGE_POOLS: Dict[int, ProcessPoolExecutor] = {}
+_PAGE_POOLS_LOCK = threading.Lock()
+
+def _page_pool(workers: int, start_method: str) -> ProcessPoolExecutor:
+    with _PAGE_POOLS_LOCK:
+        pool = _PAGE_POOLS.get(workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method))
+            _PAGE_POOLS[workers] = pool
+        return pool
+
+def _discard_page_pool(workers: int, pool: ProcessPoolExecutor):
+    """إزالة Pool معطل (ماتت إحدى عملياته) ليُنشأ بديل عند المستند التالي"""
+    with _PAGE_POOLS_LOCK:
+        if _PAGE_POOLS.get(workers) is pool:
+            del _PAGE_POOLS[workers]
+    pool.shutdown(wait=False, cancel_futures=True)
+
 class AdvancedPDFProcessor:
     """معالج PDF متعدد الخيارات - Unstructured OSS / Docling / Marker / pymupdf / OCR"""
+
+    # عدد عمليات استخراج الصفحات للمستند الواحد (0 = حتى 4 حسب الأنوية)
+    PAGE_WORKERS = int(os.getenv("PDF_PAGE_WORKERS", "0"))
+    # المستندات الأقصر تُستخرج تسلسلياً (تكلفة بدء العمليات أكبر من الفائدة)
+    PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "64"))
+    PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "32"))
+    OCR_PAGES_PER_TASK = int(os.getenv("PDF_OCR_PAGES_PER_TASK", "4"))
+    OCR_DPI = 300
+    # عمليات الصفحات تبدأ نظيفة: fork من عملية فيها Event Loop وثريدات torch قد يتجمد
+    START_METHOD = os.getenv("PDF_PAGE_START_METHOD", "spawn")
     
-    def __init__(self):
+    def __init__(self, page_workers: Optional[int] = None):
+        """
+        Args:
+            page_workers: عدد عمليات استخراج الصفحات بالتوازي (1 = تسلسلي، مثلاً داخل
+                          عمليات الابتلاع المتوازي التي توزع المستندات على الأنوية أصلاً).
+        """
+        self.page_workers = page_workers or self.PAGE_WORKERS or min(os.cpu_count() or 1, 4)
         self.processors = self._detect_available_processors()
         logger.info(f"🛠️ ترتيب المعالجات: {[p[0] for p in self.processors]}")
         
@@ -80,32 +255,47 @@ class AdvancedPDFProcessor:
             
             logger.info("🔍 استخدام OCR لمعالجة مستند ممسوح...")
             
-            full_text = ""
-            images = pdf2image.convert_from_path(pdf_path, dpi=300)
-            
-            for i, image in enumerate(images):
-                page_text = pytesseract.image_to_string(image, lang='ara+eng')
-                full_text += f"\n--- الصفحة {i+1} ---\n{page_text}"
-            
+            scanner = ArticleScanner()
+            parts: List[str] = []
+            if Path(pdf_path).suffix.lower() == '.pdf':
+                # صفحات قليلة في كل مهمة: صور 300dpi كبيرة، فلا نحوّل المستند كله دفعة واحدة
+                total_pages = pdf2image.pdfinfo_from_path(pdf_path)["Pages"]
+                step = self.OCR_PAGES_PER_TASK
+                tasks = [(pdf_path, first, min(first + step - 1, total_pages), self.OCR_DPI)
+                         for first in range(1, total_pages + 1, step)]
+                with ThreadPoolExecutor(max_workers=self.page_workers) as pool:
+                    for pages in _ordered_map(pool, _ocr_pages, tasks, window=self.page_workers):
+                        for page_number, page_text in pages:
+                            parts.append(f"\n--- الصفحة {page_number} ---\n{page_text}")
+                            scanner.feed(page_text, page_number)
+            else:
+                total_pages = 1
+                page_text = pytesseract.image_to_string(Image.open(pdf_path), lang='ara+eng')
+                parts.append(f"\n--- الصفحة 1 ---\n{page_text}")
+                scanner.feed(page_text, 1)
+            
+            full_text = "".join(parts)
             if not full_text.strip():
                 raise Exception("لم يتم استخراج أي نص باستخدام OCR")
             
-            articles = self._extract_articles_enhanced(full_text)
+            articles = scanner.finish() or self._extract_articles_enhanced(full_text)
             
             return ProcessingResult(
                 articles=articles,
                 sections=self._extract_sections(full_text),
                 full_text=full_text,
-                total_pages=len(images),
+                total_pages=total_pages,
                 stats={
                     "total_articles": len(articles),
+                    "duplicate_articles": scanner.duplicates,
                     "processing_engine": "ocr_tesseract",
-                    "pages_processed": len(images)
+                    "pages_processed": total_pages,
+                    "page_workers": self.page_workers
                 },
                 metadata={
                     "file_size": os.path.getsize(pdf_path),
                     "ocr_used": True,
-                    "dpi": 300
+                    "dpi": self.OCR_DPI
                 }
             )
             
@@ -206,15 +396,18 @@ class AdvancedPDFProcessor:
                 include_page_breaks=True
             )
             
-            # تجميع النص والبيانات
-            full_text = ""
+            # تجميع النص والبيانات (كشف المواد عنصراً بعنصر مع رقم صفحته)
+            parts: List[str] = []
             tables_data = []
             sections = []
+            scanner = ArticleScanner()
             
             for element in elements:
                 element_text = getattr(element, 'text', '')
                 if element_text:
-                    full_text += element_text + "\n\n"
+                    parts.append(element_text + "\n\n")
+                    page_number = getattr(getattr(element, 'metadata', None), 'page_number', None) or 1
+                    scanner.feed(element_text + "\n", page_number)
                 
                 # استخراج الأقسام
                 if hasattr(element, 'category') and element.category == "Title":
@@ -236,7 +429,8 @@ class AdvancedPDFProcessor:
             total_pages = max(page_numbers) if page_numbers else 1
             
             # استخراج المواد
-            articles = self._extract_articles_enhanced(full_text)
+            full_text = "".join(parts)
+            articles = scanner.finish() or self._extract_articles_enhanced(full_text)
             
             return ProcessingResult(
                 articles=articles,
@@ -350,26 +544,52 @@ class AdvancedPDFProcessor:
             return False
 
     # ================== الخيار 4: pymupdf ==================
+    def _iter_pages_pymupdf(self, pdf_path: str, total_pages: int) -> Iterator[Tuple[int, str]]:
+        """(رقم الصفحة، نصها) بالترتيب - نطاقات صفحات بالتوازي للمستندات الكبيرة"""
+        if self.page_workers <= 1 or total_pages < self.PARALLEL_MIN_PAGES:
+            yield from _extract_pages_pymupdf(pdf_path, 0, total_pages)
+            return
+
+        step = self.PAGES_PER_TASK
+        tasks = [(pdf_path, start, min(start + step, total_pages)) for start in range(0, total_pages, step)]
+        pool = _page_pool(self.page_workers, self.START_METHOD)
+        try:
+            for pages in _ordered_map(pool, _extract_pages_pymupdf, tasks, window=self.page_workers * 2):
+                yield from pages
+        except BrokenProcessPool:
+            _discard_page_pool(self.page_workers, pool)
+            raise
+
     def _process_with_pymupdf(self, pdf_path: str) -> ProcessingResult:
-        """المعالجة باستخدام pymupdf"""
+        """
+        المعالجة باستخدام pymupdf: الصفحات تُستخرج على نطاقات متوازية وتُمرر بالترتيب
+        لماسح المواد (رقم الصفحة الفعلي لكل مادة)، والنص الكامل يُجمع مرة واحدة في النهاية.
+        """
         try:
             import fitz
-            doc = fitz.open(pdf_path)
-            full_text = ""
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                full_text += page.get_text() + "\n\n"
+            with fitz.open(pdf_path) as doc:
+                total_pages = len(doc)
             
-            articles = self._extract_articles_enhanced(full_text)
+            scanner = ArticleScanner()
+            parts: List[str] = []
+            for page_number, page_text in self._iter_pages_pymupdf(pdf_path, total_pages):
+                parts.append(page_text)
+                parts.append("\n\n")
+                scanner.feed(page_text, page_number)
+            full_text = "".join(parts)
+            
+            articles = scanner.finish() or self._extract_articles_enhanced(full_text)
             
             return ProcessingResult(
                 articles=articles,
                 sections=self._extract_sections(full_text),
                 full_text=full_text,
-                total_pages=len(doc),
+                total_pages=total_pages,
                 stats={
                     "total_articles": len(articles),
-                    "processing_engine": "pymupdf"
+                    "duplicate_articles": scanner.duplicates,
+                    "processing_engine": "pymupdf",
+                    "page_workers": self.page_workers if total_pages >= self.PARALLEL_MIN_PAGES else 1
                 },
                 metadata={
                     "file_size": os.path.getsize(pdf_path)
@@ -387,45 +607,33 @@ class AdvancedPDFProcessor:
             return False
 
     # ================== استخراج محسّن للمواد القانونية ==================
+    @staticmethod
+    def _iter_page_segments(text: str) -> Iterator[Tuple[int, str]]:
+        """(رقم الصفحة، نصها) حسب علامات "--- الصفحة N ---" (بدونها: النص كله صفحة 1)"""
+        page, position = 1, 0
+        for marker in _PAGE_MARKER_RE.finditer(text):
+            yield page, text[position:marker.start()]
+            page, position = int(marker.group(1)), marker.end()
+        yield page, text[position:]
+
+    def _scan_articles(self, text: str, inline: bool = False) -> List[LegalArticle]:
+        """تمرير النص لماسح المواد صفحة بصفحة"""
+        scanner = ArticleScanner(inline=inline)
+        for page, segment in self._iter_page_segments(text):
+            scanner.feed(segment, page)
+        return scanner.finish()
+
     def _extract_articles_enhanced(self, text: str) -> List[LegalArticle]:
         """استخراج مواد قانونية محسّن بشدة"""
-        articles = []
-        
-        # تنظيف النص
-        cleaned_text = self._clean_text(text)
-        
-        # أنماط متقدمة للمواد القانونية العربية
-        patterns = [
-            # النمط 1: "المادة 1: النص..."
-            r'المادة\s+(\d+)[:\-\s]+\s*([^\.]+\.(?:\s+[^\.]+\.)*)(?=\s*المادة\s+\d+|\s*$|\s*مادة\s+\d+)',
-            # النمط 2: "مادة 1 النص..."
-            r'مادة\s+(\d+)[\s]+([^\.]+\.(?:\s+[^\.]+\.)*)(?=\s*مادة\s+\d+|\s*$|\s*المادة\s+\d+)',
-            # النمط 3: "Article 1: النص..."
-            r'Article\s+(\d+)[:\-\s]+\s*([^\.]+\.(?:\s+[^\.]+\.)*)(?=\s*Article\s+\d+|\s*$)',
-            # النمط 4: مع نقطة نهاية واضحة
-            r'المادة\s+(\d+)[\s\-\:]*([^\.]+\.[^\.]*(?:\.[^\.]*)*)(?=\s*المادة\s+\d+|\s*$)',
-        ]
-        
-        for pattern in patterns:
-            for match in re.finditer(pattern, cleaned_text, re.DOTALL | re.MULTILINE):
-                article_number = match.group(1).strip()
-                article_content = match.group(2).strip()
-                
-                # تنظيف المحتوى
-                article_content = self._clean_article_content(article_content)
-                
-                if len(article_content) > 10:  # تأكد أن المحتوى ليس قصيراً جداً
-                    articles.append(LegalArticle(
-                        number=article_number,
-                        content=article_content,
-                        page=1,  # سيتم تحسينه لاحقاً
-                        full_text=f"المادة {article_number}: {article_content}",
-                        tokens=len(article_content.split())
-                    ))
+        # رؤوس المواد في بدايات الأسطر أولاً، ثم في أي موضع للنصوص المستخرجة بلا أسطر
+        articles = self._scan_articles(text)
+        if not articles:
+            articles = self._scan_articles(text, inline=True)
         
         # إذا لم نجد مواد، نحاول استخراج فقرات طويلة
+        # (من النص الخام: التنظيف يدمج الأسطر الفارغة فيصير المستند كله فقرة واحدة)
         if not articles:
-            articles = self._extract_fallback_articles(cleaned_text)
+            articles = self._extract_fallback_articles(text)
         
         # تسجيل النتائج
         if articles:
@@ -434,29 +642,38 @@ class AdvancedPDFProcessor:
                 logger.debug(f"  المادة {article.number}: {article.content[:100]}...")
         else:
             logger.warning("⚠️ لم يتم استخراج أي مواد قانونية من النص")
-            logger.debug(f"📝 عينة من النص: {cleaned_text[:500]}...")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"📝 عينة من النص: {self._clean_text(text[:2000])[:500]}...")
         
         return articles
 
     def _extract_fallback_articles(self, text: str) -> List[LegalArticle]:
-        """استخراج بديل إذا لم توجد مواد واضحة"""
+        """
+        استخراج بديل إذا لم توجد مواد واضحة: فقرات طويلة (مفصولة بسطر فارغ) من كل صفحة،
+        برقم صفحتها الفعلي، وكل فقرة تُنظف على حدة.
+        """
         articles = []
+        index = 0
         
-        # تقسيم النص إلى فقرات طويلة
-        paragraphs = re.split(r'\n\s*\n', text)
-        
-        for i, paragraph in enumerate(paragraphs):
-            paragraph = paragraph.strip()
-            if len(paragraph) > 50:  # فقرات طويلة فقط
-                articles.append(LegalArticle(
-                    number=str(i + 1),
-                    content=paragraph,
-                    page=1,
-                    full_text=paragraph,
-                    tokens=len(paragraph.split())
-                ))
+        for page, segment in self._iter_page_segments(text):
+            # تقسيم الصفحة إلى فقرات طويلة
+            for paragraph in re.split(r'\n\s*\n', segment):
+                paragraph = self._clean_text(paragraph)
+                if not paragraph:
+                    continue
+                index += 1
+                if len(paragraph) > 50:  # فقرات طويلة فقط
+                    articles.append(LegalArticle(
+                        number=str(index),
+                        content=paragraph,
+                        page=page,
+                        full_text=paragraph,
+                        tokens=len(paragraph.split())
+                    ))
+                    if len(articles) >= 20:  # حد أقصى 20 فقرة
+                        return articles
         
-        return articles[:20]  # حد أقصى 20 فقرة
+        return articles
 
     def _clean_text(self, text: str) -> str:
         """تنظيف النص"""
@@ -466,7 +683,8 @@ class AdvancedPDFProcessor:
         text = re.sub(r'\.([^\s])', r'. \1', text)
         return text.strip()
 
-    def _clean_article_content(self, content: str) -> str:
+    @staticmethod
+    def _clean_article_content(content: str) -> str:
         """تنظيف محتوى المادة"""
         # إزالة رموز خاصة
         content = re.sub(r'[•\-\*]', '', content)
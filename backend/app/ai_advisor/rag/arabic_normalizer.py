@@ -0,0 +1,95 @@
+# backend/app/ai_advisor/rag/arabic_normalizer.py
+import re
+import logging
+from functools import lru_cache
+from typing import Iterable, List
+
+logger = logging.getLogger(__name__)
+
+# تطبيع النص العربي (نفس القواعد مطبقة في دالة SQL ai_normalize_arabic):
+# التشكيل + الألف الخنجرية + التطويل تُحذف، و أ/إ/آ/ٱ -> ا، ى -> ي، ة -> ه
+ARABIC_DIACRITICS_PATTERN = '[\u064B-\u065F\u0670\u0640]'
+ARABIC_CHAR_VARIANTS = '\u0623\u0625\u0622\u0671\u0649\u0629'
+ARABIC_CHAR_TARGETS = '\u0627\u0627\u0627\u0627\u064A\u0647'
+
+# جدول ترجمة واحد (str.translate ينفذ كل الاستبدالات في مرور واحد بلغة C)
+_TRANSLATION_TABLE = {
+    **{code: None for code in range(0x064B, 0x0660)},   # التشكيل
+    0x0670: None,                                       # الألف الخنجرية
+    0x0640: None,                                       # التطويل
+    **str.maketrans(ARABIC_CHAR_VARIANTS, ARABIC_CHAR_TARGETS),
+    **str.maketrans('٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹', '01234567890123456789'),
+}
+
+_TOKEN_RE = re.compile(r'\w+')
+
+# السوابق واللواحق حسب خوارزمية Light10 (بعد التطبيع: ة -> ه)
+_PREFIXES = ('وال', 'بال', 'كال', 'فال', 'لل', 'ال')
+_SUFFIXES = ('ها', 'ان', 'ات', 'ون', 'ين', 'يه', 'ه', 'ي')
+
+_STOP_WORDS = {
+    'ما', 'ماذا', 'هي', 'هو', 'هم', 'كيف', 'لماذا', 'متى', 'أين', 'من', 'هل', 'على', 'في', 'إلى',
+    'عن', 'مع', 'أو', 'أن', 'إن', 'التي', 'الذي', 'الذين', 'هذا', 'هذه', 'ذلك', 'تلك', 'كان',
+    'قد', 'لا', 'لم', 'لن', 'ثم', 'كل', 'بين', 'عند', 'بعد', 'قبل', 'حتى', 'إذا', 'غير', 'أي',
+    'وفقا', 'حسب',
+}
+
+class ArabicNormalizer:
+    """
+    مطبّع ومجذّع خفيف (Light Stemmer) للنص العربي القانوني.
+
+    يُستخدم عند الابتلاع (لملء عمود normalized_tokens الذي يُبنى منه chunk_tsv)
+    وعند الاستعلام (لاستخراج الكلمات المفتاحية)، حتى تتطابق صيغ مثل
+    "المادة" و"مادة" و"مادّة" و"الماده" على نفس الجذع.
+    """
+
+    def __init__(self, min_token_length: int = 2):
+        self.min_token_length = min_token_length
+        self.stop_words = {self.normalize(word) for word in _STOP_WORDS}
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """تطبيع الحروف فقط (بدون تقسيم أو تجذيع)"""
+        return (text or '').translate(_TRANSLATION_TABLE)
+
+    @staticmethod
+    @lru_cache(maxsize=100_000)
+    def stem(token: str) -> str:
+        """
+        تجذيع خفيف (Light10): حذف "و" العطف، ثم أداة تعريف واحدة، ثم اللواحق الشائعة،
+        مع الإبقاء على جذع من حرفين على الأقل. الأرقام تبقى كما هي.
+        """
+        if token.isdigit():
+            return token
+
+        if len(token) >= 4 and token.startswith('و'):
+            token = token[1:]
+
+        for prefix in _PREFIXES:
+            if token.startswith(prefix) and len(token) - len(prefix) >= 2:
+                token = token[len(prefix):]
+                break
+
+        for suffix in _SUFFIXES:
+            if token.endswith(suffix) and len(token) - len(suffix) >= 2:
+                token = token[:-len(suffix)]
+
+        return token
+
+    def tokenize(self, text: str) -> List[str]:
+        """تطبيع + تقسيم + حذف كلمات التوقف + تجذيع"""
+        stems = []
+        for token in _TOKEN_RE.findall(self.normalize(text)):
+            if token in self.stop_words or (len(token) < self.min_token_length and not token.isdigit()):
+                continue
+            stems.append(self.stem(token))
+        return stems
+
+    def normalize_for_index(self, texts: Iterable[str]) -> List[str]:
+        """تحويل دفعة نصوص إلى نص الجذوع المخزن في normalized_tokens"""
+        return [' '.join(self.tokenize(text)) for text in texts]
+
+    def query_terms(self, query: str, max_terms: int = 8) -> List[str]:
+        """جذوع الاستعلام الفريدة (بنفس ترتيب ظهورها)"""
+        terms = list(dict.fromkeys(self.tokenize(query)))
+        return terms[:max_terms]
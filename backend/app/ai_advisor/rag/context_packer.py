@@ -0,0 +1,291 @@
+# backend/app/ai_advisor/rag/context_packer.py
+import logging
+import math
+import os
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from .arabic_normalizer import ArabicNormalizer
+
+try:
+    import tiktoken
+except ImportError:  # (اختياري - بدونه يُستخدم تقدير بعدد الحروف)
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# حدود الجمل في النص القانوني العربي (نقطة، علامات استفهام/تعجب، فاصلة منقوطة عربية، سطر جديد)
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?؟؛])\s+|\n+')
+
+# متوسط الحروف لكل token في النص العربي عند غياب tiktoken (تقدير متحفظ)
+_CHARS_PER_TOKEN = 3.0
+
+class TokenCounter:
+    """
+    عدّاد tokens بمُرمّز النموذج المستهدف.
+    نماذج OpenAI تستخدم مُرمّزها الفعلي، وباقي المزودين (Gemini / Claude) ليس لهم
+    مُرمّز محلي فيُستخدم o200k_base كتقريب قريب للنص العربي.
+    إذا تعذر تحميل المُرمّز (tiktoken يُنزّل ملف BPE عند أول استخدام، فيفشل بدون شبكة)
+    يُستخدم تقدير بعدد الحروف مثل llm_scheduler.estimate_tokens.
+    """
+
+    FALLBACK_ENCODING = "o200k_base"
+
+    def __init__(self, model_name: Optional[str] = None):
+        self.model_name = model_name
+        self.encoding_name = None
+        self._encoding = None
+        if tiktoken:
+            unknown_model = True
+            try:
+                self._encoding = tiktoken.encoding_for_model(model_name) if model_name else None
+            except KeyError:
+                self._encoding = None
+            except Exception as e:  # (فشل تنزيل/قراءة ملف BPE: لا نحاول تنزيلاً ثانياً)
+                unknown_model = False
+                logger.warning(f"⚠️ TokenCounter: تعذر تحميل مُرمّز tiktoken: {e} - تقدير بعدد الحروف")
+            if self._encoding is None and unknown_model:
+                try:
+                    self._encoding = tiktoken.get_encoding(self.FALLBACK_ENCODING)
+                except Exception as e:
+                    logger.warning(f"⚠️ TokenCounter: تعذر تحميل مُرمّز tiktoken: {e} - تقدير بعدد الحروف")
+            if self._encoding is not None:
+                self.encoding_name = self._encoding.name
+        self._count = lru_cache(maxsize=50_000)(self._count_uncached)
+
+    def _count_uncached(self, text: str) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return math.ceil(len(text) / _CHARS_PER_TOKEN)
+
+    def count(self, text: str) -> int:
+        return self._count(text) if text else 0
+
+@dataclass
+class PackedContext:
+    """نتيجة التعبئة: النص النهائي + تقرير الـ tokens الموفرة"""
+    text: str
+    tokens_used: int
+    tokens_before: int
+    sources_used: int
+    sentences_used: int
+    sentences_dropped: int
+    duplicates_removed: int
+    documents: List[Dict[str, Any]] = field(default_factory=list)
+
+    @property
+    def tokens_saved(self) -> int:
+        return max(self.tokens_before - self.tokens_used, 0)
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "tokens_before": self.tokens_before,
+            "tokens_used": self.tokens_used,
+            "tokens_saved": self.tokens_saved,
+            "sources_used": self.sources_used,
+            "sentences_used": self.sentences_used,
+            "sentences_dropped": self.sentences_dropped,
+            "duplicates_removed": self.duplicates_removed,
+        }
+
+@dataclass
+class _Sentence:
+    doc_index: int
+    position: int
+    text: str
+    tokens: int
+    stems: Set[str]
+    relevance: float
+
+class ContextPacker:
+    """
+    تعبئة سياق الـ LLM ضمن ميزانية tokens بدلاً من لصق الأجزاء كاملة:
+
+    1. إزالة التكرار: الأجزاء المتداخلة من نفس المادة (overlap التقسيم) تُدمج على مستوى الجملة.
+    2. تقسيم كل مصدر إلى جمل وحساب صلة كل جملة (ترتيب المصدر + تغطية جذوع الاستعلام).
+    3. ملء الميزانية بـ Maximal Marginal Relevance: الجملة الأعلى صلة والأقل تكراراً لما اختير.
+    4. إعادة تجميع الجمل المختارة بترتيبها الأصلي تحت ترويسة مختصرة لكل مصدر.
+    """
+
+    DEFAULT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+    DEFAULT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))
+    # الجمل الأقصر من هذا (بقايا ترقيم أو أرقام منفردة) لا تُرسل
+    MIN_SENTENCE_TOKENS = 3
+
+    def __init__(self,
+                 model_name: Optional[str] = None,
+                 token_budget: int = DEFAULT_TOKEN_BUDGET,
+                 mmr_lambda: float = DEFAULT_MMR_LAMBDA,
+                 token_counter: Optional[TokenCounter] = None):
+        """
+        Args:
+            model_name: اسم النموذج المستهدف (لاختيار المُرمّز).
+            token_budget: أقصى عدد tokens لنص السياق.
+            mmr_lambda: الموازنة بين الصلة (1.0) وتجنب التكرار (0.0).
+        """
+        self.token_budget = token_budget
+        self.mmr_lambda = mmr_lambda
+        self.counter = token_counter or TokenCounter(model_name)
+        self.normalizer = ArabicNormalizer()
+        self.stats = {"requests": 0, "tokens_before": 0, "tokens_used": 0, "duplicates_removed": 0}
+
+    # ------------------------------------------------------------------
+    # أدوات داخلية
+    # ------------------------------------------------------------------
+    @staticmethod
+    def _header(index: int, doc: Dict[str, Any]) -> str:
+        metadata = doc.get('metadata', {})
+        header = f"[المصدر {index}] {metadata.get('document_title', 'غير معروف')}"
+        if metadata.get('article_number'):
+            header += f" - المادة {metadata['article_number']}"
+        return header
+
+    @staticmethod
+    def _article_key(doc: Dict[str, Any]) -> Tuple[Any, Any]:
+        metadata = doc.get('metadata', {})
+        article = metadata.get('article_number')
+        if article in (None, '', 'N/A'):
+            # (بدون رقم مادة لا نعرف التداخل إلا بالجزء نفسه)
+            article = ('chunk', metadata.get('chunk_id') or id(doc))
+        return metadata.get('document_id') or metadata.get('document_title'), article
+
+    def _split_sentences(self, text: str) -> List[str]:
+        return [s.strip() for s in _SENTENCE_SPLIT_RE.split(text or "") if s and s.strip()]
+
+    @staticmethod
+    def _similarity(a: Set[str], b: Set[str]) -> float:
+        if not a or not b:
+            return 0.0
+        return len(a & b) / len(a | b)
+
+    def _group_documents(self, documents: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[List[str]], int]:
+        """
+        دمج الأجزاء من نفس المادة (بترتيب أول ظهور) مع حذف الجمل المكررة أو المتضمنة في جملة سابقة.
+        Returns:
+            (المصادر الممثلة، جمل كل مصدر، عدد الجمل المحذوفة كتكرار)
+        """
+        groups: Dict[Tuple[Any, Any], int] = {}
+        heads: List[Dict[str, Any]] = []
+        sentences: List[List[str]] = []
+        seen: List[List[str]] = []
+        duplicates = 0
+
+        for doc in documents:
+            key = self._article_key(doc)
+            if key not in groups:
+                groups[key] = len(heads)
+                heads.append(doc)
+                sentences.append([])
+                seen.append([])
+            index = groups[key]
+
+            for sentence in self._split_sentences(doc.get('content', '')):
+                normalized = " ".join(ArabicNormalizer.normalize(sentence).split())
+                if any(normalized in previous for previous in seen[index]):
+                    duplicates += 1
+                    continue
+                seen[index].append(normalized)
+                sentences[index].append(sentence)
+
+        return heads, sentences, duplicates
+
+    # ------------------------------------------------------------------
+    # الواجهة العامة
+    # ------------------------------------------------------------------
+    def pack(self, query: str, documents: List[Dict[str, Any]],
+             token_budget: Optional[int] = None,
+             baseline_text: Optional[str] = None) -> PackedContext:
+        """
+        بناء نص السياق ضمن الميزانية.
+
+        Args:
+            documents: المصادر بعد إعادة الترتيب (الأفضل أولاً).
+            baseline_text: النص الذي كان سيُرسل بدون تعبئة (لحساب الـ tokens الموفرة).
+        """
+        budget = token_budget or self.token_budget
+        tokens_before = self.counter.count(baseline_text) if baseline_text is not None else \
+            sum(self.counter.count(doc.get('content', '')) for doc in documents)
+
+        heads, grouped, duplicates = self._group_documents(documents)
+        query_stems = set(self.normalizer.query_terms(query, max_terms=32))
+
+        candidates: List[_Sentence] = []
+        for doc_index, sentences in enumerate(grouped):
+            # المصدر الأعلى ترتيباً له أولوية (1.0 للأول وتتناقص)
+            doc_prior = 1.0 - doc_index / max(len(grouped), 1)
+            for position, sentence in enumerate(sentences):
+                tokens = self.counter.count(sentence)
+                if tokens < self.MIN_SENTENCE_TOKENS:
+                    continue
+                stems = set(self.normalizer.tokenize(sentence))
+                coverage = len(query_stems & stems) / len(query_stems) if query_stems else 0.0
+                candidates.append(_Sentence(doc_index, position, sentence, tokens, stems,
+                                            relevance=0.5 * doc_prior + 0.5 * coverage))
+
+        # --- ملء الميزانية بـ MMR ---
+        selected: List[_Sentence] = []
+        headers_used: Set[int] = set()
+        used = 0
+        remaining = list(range(len(candidates)))
+        # أقصى تشابه لكل مرشح مع ما اختير حتى الآن (يُحدّث بعد كل اختيار بدلاً من إعادة حسابه)
+        redundancy = [0.0] * len(candidates)
+
+        while remaining:
+            best_index = max(
+                remaining,
+                key=lambda i: self.mmr_lambda * candidates[i].relevance - (1 - self.mmr_lambda) * redundancy[i]
+            )
+            remaining.remove(best_index)
+            best = candidates[best_index]
+
+            cost = best.tokens
+            if best.doc_index not in headers_used:
+                cost += self.counter.count(self._header(best.doc_index + 1, heads[best.doc_index])) + 2
+            if used + cost > budget:
+                continue
+            selected.append(best)
+            headers_used.add(best.doc_index)
+            used += cost
+            for i in remaining:
+                redundancy[i] = max(redundancy[i], self._similarity(candidates[i].stems, best.stems))
+
+        # --- إعادة التجميع بالترتيب الأصلي ---
+        by_doc: Dict[int, List[_Sentence]] = {}
+        for sentence in selected:
+            by_doc.setdefault(sentence.doc_index, []).append(sentence)
+
+        parts, used_docs = [], []
+        for source_number, doc_index in enumerate(sorted(by_doc), start=1):
+            body = " ".join(s.text for s in sorted(by_doc[doc_index], key=lambda s: s.position))
+            parts.append(f"{self._header(source_number, heads[doc_index])}\n{body}")
+            used_docs.append(heads[doc_index])
+
+        text = "\n\n".join(parts) if parts else "لا توجد مستندات في قاعدة المعرفة."
+        packed = PackedContext(
+            text=text,
+            tokens_used=self.counter.count(text),
+            tokens_before=tokens_before,
+            sources_used=len(used_docs),
+            sentences_used=len(selected),
+            sentences_dropped=len(candidates) - len(selected),
+            duplicates_removed=duplicates,
+            documents=used_docs,
+        )
+
+        self.stats["requests"] += 1
+        self.stats["tokens_before"] += packed.tokens_before
+        self.stats["tokens_used"] += packed.tokens_used
+        self.stats["duplicates_removed"] += duplicates
+        return packed
+
+    def get_stats(self) -> Dict[str, Any]:
+        before = self.stats["tokens_before"] or 1
+        return {
+            **self.stats,
+            "tokens_saved": self.stats["tokens_before"] - self.stats["tokens_used"],
+            "saving_ratio": round(1 - self.stats["tokens_used"] / before, 3),
+            "token_budget": self.token_budget,
+            "encoding": self.counter.encoding_name or f"~{_CHARS_PER_TOKEN:g} chars/token",
+        }
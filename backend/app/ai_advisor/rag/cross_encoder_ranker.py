@@ -1,11 +1,17 @@
+import hashlib
 import logging
+import os
 from typing import List, Dict, Any, Optional
-from sentence_transformers import CrossEncoder
 import numpy as np
 import asyncio
 
 # استيراد مدير الكاش
 from ..core.cache_manager import CacheManager 
+from ..core.inference_backends import (
+    ARABIC_LEGAL_PAIRS, load_cross_encoder, resolve_backend,
+    scores_match, select_validated_backend
+)
+from .arabic_normalizer import ArabicNormalizer
 
 logger = logging.getLogger(__name__)
 
@@ -14,14 +20,37 @@ class CrossEncoderRanker:
     يستخدم نموذج Cross-Encoder (المصنف المتقدم) لإعادة ترتيب 
     النتائج الأولية المسترجعة من الـ semantic_retriever.
     هذه هي "المرحلة الثانية" من الاسترجاع (Reranking) لضمان أعلى دقة.
+
+    الكاش على مستوى الزوج (استعلام مطبّع، chunk_id): المرشحون المتداخلون بين
+    أسئلة متشابهة يعيدون استخدام درجاتهم، ولا يُشغَّل النموذج إلا على الأزواج الجديدة.
     """
+
+    # درجة الزوج ثابتة لنفس النموذج، لذا يمكن الاحتفاظ بها مدة أطول من الإجابات
+    PAIR_CACHE_TTL = int(os.getenv("RERANK_PAIR_CACHE_TTL", str(24 * 3600)))
+
+    # إعدادات الترتيب المتتالي (Cascade) الافتراضية
+    CASCADE_ENABLED = os.getenv("RERANKER_CASCADE", "true").lower() in ("1", "true", "yes")
+    CASCADE_STAGE1_KEEP = int(os.getenv("RERANKER_CASCADE_KEEP", "12"))
+    CASCADE_STAGE1_MIN_SCORE = float(os.getenv("RERANKER_CASCADE_MIN_SCORE", "0.0"))
+    # (الخطوة الأولى top_k زوجاً، ثم STEP لكل خطوة: مع KEEP=12 و top_k=5 يمكن التوقف بعد 8)
+    CASCADE_STAGE2_STEP = int(os.getenv("RERANKER_CASCADE_STEP", "3"))
+    CASCADE_PATIENCE = int(os.getenv("RERANKER_CASCADE_PATIENCE", "1"))
     
     def __init__(
         self, 
         model_name: str = 'BAAI/bge-reranker-base', 
         top_k: int = 5,
         batch_size: int = 16,
-        cache_manager: Optional[CacheManager] = None
+        cache_manager: Optional[CacheManager] = None,
+        backend: Optional[str] = None,
+        backend_tolerance: Optional[float] = None,
+        cascade: Optional[bool] = None,
+        stage1_keep: Optional[int] = None,
+        stage1_min_score: Optional[float] = None,
+        stage1_dense_weight: float = 0.7,
+        stage1_lexical_weight: float = 0.3,
+        stage2_step: Optional[int] = None,
+        stage2_patience: Optional[int] = None
     ):
         """
         تهيئة المصنف.
@@ -32,63 +61,240 @@ class CrossEncoderRanker:
             top_k: عدد النتائج النهائية التي سيتم إرجاعها بعد إعادة الترتيب.
             batch_size: حجم الدفعة للمعالجة (لزيادة كفاءة الـ GPU/CPU).
             cache_manager: مدير الكاش لتخزين النتائج المكلفة حسابياً.
+            backend: واجهة الاستدلال (torch | int8)، الافتراضي من RERANKER_BACKEND.
+            backend_tolerance: أقصى فرق مسموح في الدرجات مقارنة بمسار PyTorch.
+            cascade: تفعيل الترتيب المتتالي (الافتراضي من RERANKER_CASCADE).
+            stage1_keep: عدد المرشحين الذين يتجاوزون المرحلة الرخيصة إلى الـ Cross-Encoder.
+            stage1_min_score: أقل درجة رخيصة مقبولة (ما دونها يُستبعد مبكراً).
+            stage1_dense_weight / stage1_lexical_weight: أوزان التشابه الدلالي وتداخل الجذوع.
+            stage2_step: عدد الأزواج التي يقيّمها الـ Cross-Encoder في كل خطوة بعد الأولى
+                         (الخطوة الأولى top_k زوجاً على الأقل).
+            stage2_patience: عدد الخطوات المتتالية التي يبقى فيها أفضل K ثابتاً قبل التوقف.
         """
         try:
-            self.model = CrossEncoder(model_name)
+            backend = backend or resolve_backend("RERANKER_BACKEND")
+            if backend_tolerance is None:
+                backend_tolerance = float(os.getenv("RERANKER_BACKEND_TOLERANCE", "0.1"))
+            
+            self.model, self.backend = select_validated_backend(
+                kind="CrossEncoderRanker",
+                backend=backend,
+                load_fn=lambda b: load_cross_encoder(model_name, b),
+                run_fn=lambda m: m.predict(ARABIC_LEGAL_PAIRS, show_progress_bar=False),
+                compare_fn=scores_match,
+                tolerance=backend_tolerance
+            )
             self.top_k = top_k
             self.batch_size = batch_size
             self.cache_manager = cache_manager
-            logger.info(f"✅ تم تحميل CrossEncoderRanker بنجاح باستخدام نموذج: {model_name}")
+            self.model_name = model_name
+            self.normalizer = ArabicNormalizer()
+            
+            self.cascade = self.CASCADE_ENABLED if cascade is None else cascade
+            self.stage1_keep = max(stage1_keep or self.CASCADE_STAGE1_KEEP, top_k)
+            self.stage1_min_score = (self.CASCADE_STAGE1_MIN_SCORE
+                                     if stage1_min_score is None else stage1_min_score)
+            self.stage1_dense_weight = stage1_dense_weight
+            self.stage1_lexical_weight = stage1_lexical_weight
+            self.stage2_step = max(stage2_step or self.CASCADE_STAGE2_STEP, 1)
+            self.stage2_patience = max(stage2_patience or self.CASCADE_PATIENCE, 1)
+            
+            self.stats = {
+                "pairs_requested": 0, "pairs_cached": 0, "pairs_scored": 0,
+                "cascade_calls": 0, "stage1_pruned": 0, "stage2_early_exit_skipped": 0,
+                "early_exits": 0,
+            }
+            logger.info(f"✅ تم تحميل CrossEncoderRanker بنجاح باستخدام نموذج: {model_name} (واجهة: {self.backend})")
         except Exception as e:
             logger.error(f"❌ فشل تحميل نموذج CrossEncoder: {model_name}. خطأ: {e}")
             raise
 
-    async def rerank_documents(self, query: str, candidates: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    def _pair_cache_keys(self, query: str, candidates: List[Dict[str, Any]]) -> List[str]:
         """
-        إعادة ترتيب قائمة المستندات المرشحة (candidates) بناءً على الاستعلام (query).
+        مفاتيح ثابتة بين العمليات وإعادة التشغيل (SHA-256 بدلاً من hash() العشوائي):
+        rerank:<نموذج/واجهة>:<بصمة الاستعلام المطبّع>:<chunk_id أو بصمة المحتوى>
         """
-        if not candidates:
-            logger.debug("لا توجد مستندات مرشحة لإعادة الترتيب.")
-            return []
-            
-        # --- 1. التحقق من الكاش ---
-        # مفتاح الكاش يعتمد على الاستعلام ومحتوى المستندات المرشحة
-        if self.cache_manager:
+        normalized_query = " ".join(ArabicNormalizer.normalize(query).split())
+        query_digest = hashlib.sha256(normalized_query.encode('utf-8')).hexdigest()[:32]
+        prefix = f"rerank:{self.model_name}:{self.backend}:{query_digest}"
+
+        keys = []
+        for doc in candidates:
+            chunk_id = doc['metadata'].get('chunk_id')
+            if chunk_id is None:
+                chunk_id = "h" + hashlib.sha256(doc['content'].encode('utf-8')).hexdigest()[:32]
+            keys.append(f"{prefix}:{chunk_id}")
+        return keys
+
+    async def _cached_pairs(self, query: str, candidates: List[Dict[str, Any]]) -> Dict[str, float]:
+        """درجات الأزواج المخزنة في الكاش (رحلة واحدة) - مفتاح الزوج -> الدرجة"""
+        if not self.cache_manager or not candidates:
+            return {}
+        keys = self._pair_cache_keys(query, candidates)
+        try:
+            cached = await self.cache_manager.get_many(keys)
+        except Exception as e:
+            logger.warning(f"⚠️ فشل التحقق من كاش درجات إعادة الترتيب: {e}")
+            return {}
+        return {key: float(value) for key, value in zip(keys, cached) if value is not None}
+
+    async def _score_pairs(self, query: str, candidates: List[Dict[str, Any]],
+                           precomputed: Optional[Dict[str, float]] = None,
+                           check_cache: bool = True) -> np.ndarray:
+        """
+        درجات كل المرشحين: المعروفة مسبقاً (precomputed) أو المخزنة في الكاش تُستخدم
+        كما هي، والباقي يُحسب في استدعاء predict واحد ثم يُخزن.
+
+        Args:
+            check_cache: False إذا كان precomputed يشمل ما في الكاش أصلاً (لا رحلة إضافية).
+        """
+        scores = np.full(len(candidates), np.nan, dtype=np.float32)
+        keys: List[str] = []
+        if precomputed or self.cache_manager:
+            keys = self._pair_cache_keys(query, candidates)
+
+        if precomputed:
+            for i, key in enumerate(keys):
+                if key in precomputed:
+                    scores[i] = precomputed[key]
+
+        if self.cache_manager and check_cache and np.isnan(scores).any():
             try:
-                candidate_ids = hash(tuple(doc['metadata'].get('chunk_id', doc['content']) for doc in candidates))
-                cache_key = f"rerank:{query}:{candidate_ids}"
-                cached_results = await self.cache_manager.get(cache_key)
-                if cached_results:
-                    logger.debug(f"🔍 تم العثور على نتائج إعادة الترتيب في الكاش لـ: {query[:50]}...")
-                    return cached_results
+                for i, cached in enumerate(await self.cache_manager.get_many(keys)):
+                    if cached is not None and np.isnan(scores[i]):
+                        scores[i] = float(cached)
             except Exception as e:
-                logger.warning(f"⚠️ فشل التحقق من كاش إعادة الترتيب: {e}")
+                logger.warning(f"⚠️ فشل التحقق من كاش درجات إعادة الترتيب: {e}")
+                keys = []
 
-        # --- 2. إعداد أزواج (الاستعلام، المستند) للنموذج ---
-        # (query, document_content)
-        pairs = [(query, doc['content']) for doc in candidates]
-        
-        # --- 3. تشغيل النموذج (عملية مكلفة) ---
-        # نستخدم asyncio.to_thread لتشغيل النموذج (وهو متزامن Sync) 
-        # في "ثريد" منفصل لمنع تجميد (Blocking) الـ Event Loop.
-        try:
-            logger.debug(f"🚀 بدء إعادة ترتيب {len(pairs)} مستند لـ: {query[:50]}...")
-            
-            def _predict():
-                # تشغيل النموذج مع batching لإدارة الذاكرة والأداء
-                return self.model.predict(
-                    pairs, 
-                    batch_size=self.batch_size, 
-                    show_progress_bar=False  # (يمكن تفعيلها للـ debugging)
+        missing = [i for i in range(len(candidates)) if np.isnan(scores[i])]
+        self.stats["pairs_requested"] += len(candidates)
+        self.stats["pairs_cached"] += len(candidates) - len(missing)
+        self.stats["pairs_scored"] += len(missing)
+
+        if not missing:
+            logger.debug(f"🔍 كل درجات إعادة الترتيب ({len(candidates)}) من الكاش لـ: {query[:50]}...")
+            return scores
+
+        # (query, document_content) للأزواج غير المخزنة فقط
+        pairs = [(query, candidates[i]['content']) for i in missing]
+        logger.debug(f"🚀 بدء إعادة ترتيب {len(pairs)}/{len(candidates)} مستند (الباقي من الكاش) لـ: {query[:50]}...")
+
+        def _predict():
+            # تشغيل النموذج مع batching لإدارة الذاكرة والأداء
+            return self.model.predict(
+                pairs, 
+                batch_size=self.batch_size, 
+                show_progress_bar=False  # (يمكن تفعيلها للـ debugging)
+            )
+
+        # تشغيل الدالة المتزامنة في ثريد منفصل لمنع تجميد الـ Event Loop
+        new_scores = np.asarray(await asyncio.to_thread(_predict), dtype=np.float32).reshape(-1)
+        scores[missing] = new_scores
+
+        if keys and self.cache_manager:
+            try:
+                await self.cache_manager.set_many(
+                    {keys[i]: float(score) for i, score in zip(missing, new_scores)},
+                    ttl=self.PAIR_CACHE_TTL
                 )
+            except Exception as e:
+                logger.warning(f"⚠️ فشل تخزين درجات إعادة الترتيب في الكاش: {e}")
 
-            # تشغيل الدالة المتزامنة في ثريد منفصل
-            scores = await asyncio.to_thread(_predict)
-            
-            # التأكد من أن المخرجات هي numpy array
-            if not isinstance(scores, np.ndarray):
-                scores = np.array(scores)
+        return scores
 
+    def _cheap_scores(self, query: str, candidates: List[Dict[str, Any]]) -> np.ndarray:
+        """
+        المرحلة الأولى (رخيصة): مزيج من التشابه الدلالي المحسوب مسبقاً في الاسترجاع
+        ونسبة جذوع الاستعلام الموجودة في نص المرشح.
+        """
+        query_terms = set(self.normalizer.query_terms(query, max_terms=32))
+        scores = np.zeros(len(candidates), dtype=np.float32)
+
+        for i, doc in enumerate(candidates):
+            # درجة keyword هي ts_rank وليست Cosine، فلا تُستخدم كتشابه دلالي
+            dense = doc.get('similarity', 0.0) if doc.get('search_type', 'semantic') != 'keyword' else 0.0
+            overlap = 0.0
+            if query_terms:
+                overlap = len(query_terms & set(self.normalizer.tokenize(doc['content']))) / len(query_terms)
+            scores[i] = self.stage1_dense_weight * float(dense) + self.stage1_lexical_weight * overlap
+
+        return scores
+
+    async def _cascade_scores(self, query: str, candidates: List[Dict[str, Any]]) -> np.ndarray:
+        """
+        الترتيب المتتالي: المرحلة الرخيصة تستبعد المرشحين الضعفاء، ثم يقيّم الـ Cross-Encoder
+        الناجين على خطوات (بترتيب الدرجة الرخيصة) ويتوقف عندما يثبت أفضل K.
+        درجات الناجين المخزنة في الكاش تُجلب مرة واحدة قبل الخطوات.
+
+        Returns:
+            درجات الـ Cross-Encoder (NaN للمرشحين الذين لم يُقيَّموا).
+        """
+        self.stats["cascade_calls"] += 1
+        cheap = self._cheap_scores(query, candidates)
+        order = [int(i) for i in np.argsort(-cheap, kind="stable")]
+
+        survivors = [i for i in order if cheap[i] >= self.stage1_min_score][:self.stage1_keep]
+        if len(survivors) < self.top_k:
+            # لا نستبعد تحت حد top_k حتى لا تقل النتائج عن المطلوب
+            survivors = order[:self.top_k]
+        self.stats["stage1_pruned"] += len(candidates) - len(survivors)
+
+        known = await self._cached_pairs(query, [candidates[i] for i in survivors])
+
+        scores = np.full(len(candidates), np.nan, dtype=np.float32)
+        previous_top: Optional[set] = None
+        stable_steps = 0
+        scored = 0
+        # (الخطوة الأولى تكفي لأول أفضل K، فأول مقارنة للثبات ممكنة في الخطوة الثانية)
+        step = max(self.top_k, self.stage2_step)
+
+        while scored < len(survivors):
+            batch = survivors[scored:scored + step]
+            scores[batch] = await self._score_pairs(
+                query, [candidates[i] for i in batch], known, check_cache=False
+            )
+            scored += len(batch)
+            step = self.stage2_step
+
+            scored_ids = survivors[:scored]
+            current_top = set(sorted(scored_ids, key=lambda i: scores[i], reverse=True)[:self.top_k])
+            stable_steps = stable_steps + 1 if current_top == previous_top else 0
+            previous_top = current_top
+
+            if stable_steps >= self.stage2_patience and scored < len(survivors):
+                skipped = len(survivors) - scored
+                self.stats["early_exits"] += 1
+                self.stats["stage2_early_exit_skipped"] += skipped
+                logger.debug(f"⏹️ Cascade: أفضل {self.top_k} ثابت، تخطي {skipped} زوج متبقٍ")
+                break
+
+        logger.debug(
+            f"🪜 Cascade: {len(candidates)} مرشح -> {len(survivors)} بعد المرحلة الرخيصة "
+            f"-> {scored} قُيّم بالـ Cross-Encoder"
+        )
+        return scores
+
+    async def rerank_documents(self, query: str, candidates: List[Dict[str, Any]],
+                               cascade: Optional[bool] = None) -> List[Dict[str, Any]]:
+        """
+        إعادة ترتيب قائمة المستندات المرشحة (candidates) بناءً على الاستعلام (query).
+        
+        Args:
+            cascade: تجاوز إعداد الترتيب المتتالي لهذا الطلب فقط.
+        """
+        if not candidates:
+            logger.debug("لا توجد مستندات مرشحة لإعادة الترتيب.")
+            return []
+
+        use_cascade = self.cascade if cascade is None else cascade
+
+        # --- 1. حساب الدرجات (من الكاش أو النموذج) ---
+        try:
+            if use_cascade and len(candidates) > self.top_k:
+                scores = await self._cascade_scores(query, candidates)
+            else:
+                scores = await self._score_pairs(query, candidates)
             logger.debug(f"📊 تم حساب درجات إعادة الترتيب بنجاح.")
 
         except Exception as e:
@@ -96,9 +302,11 @@ class CrossEncoderRanker:
             # في حالة الفشل، نرجع النتائج الأصلية بترتيبها
             return candidates[:self.top_k]
 
-        # --- 4. دمج النتائج وفرزها ---
+        # --- 2. دمج النتائج وفرزها ---
         ranked_results = []
         for i, doc in enumerate(candidates):
+            if np.isnan(scores[i]):
+                continue  # (استُبعد في مرحلة رخيصة أو بعد التوقف المبكر)
             new_score = float(scores[i])
             
             # إضافة/تحديث البيانات الوصفية
@@ -115,15 +323,19 @@ class CrossEncoderRanker:
         sorted_results = sorted(ranked_results, key=lambda x: x['rerank_score'], reverse=True)
         
         # اختيار أفضل K نتائج فقط
-        final_results = sorted_results[:self.top_k]
-
-        # --- 5. تخزين النتيجة في الكاش ---
-        if self.cache_manager:
-            try:
-                # (cache_key تم حسابه في الخطوة 1)
-                await self.cache_manager.set(cache_key, final_results, ttl=3600) # تخزين لمدة ساعة
-            except Exception as e:
-                logger.warning(f"⚠️ فشل تخزين نتائج إعادة الترتيب في الكاش: {e}")
-
-        return final_results
+        return sorted_results[:self.top_k]
 
+    def get_stats(self) -> Dict[str, Any]:
+        """نسبة الأزواج المخدومة من الكاش، وعدد الأزواج التي استبعدتها كل مرحلة"""
+        requested = self.stats["pairs_requested"] or 1
+        return {
+            **self.stats,
+            "pair_hit_rate": round(self.stats["pairs_cached"] / requested, 3),
+            "cascade_config": {
+                "enabled": self.cascade,
+                "stage1_keep": self.stage1_keep,
+                "stage1_min_score": self.stage1_min_score,
+                "stage2_step": self.stage2_step,
+                "stage2_patience": self.stage2_patience,
+            },
+        }
@@ -0,0 +1,312 @@
+# backend/app/ai_advisor/rag/ingest_manifest.py
+import asyncio
+import hashlib
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class ManifestEntry:
+    file_path: str
+    content_hash: str
+    file_size: int
+    mtime_ns: int
+    document_id: Optional[int]
+
+@dataclass
+class FileChange:
+    """ملف يحتاج عملاً: ابتلاع جديد، أو إعادة ابتلاع مستند موجود (document_id)"""
+    file_path: str
+    action: str
+    content_hash: str
+    file_size: int
+    mtime_ns: int
+    document_id: Optional[int] = None
+    previous_path: Optional[str] = None
+
+@dataclass
+class IngestPlan:
+    """نتيجة مقارنة الملفات على القرص بالسجل"""
+    to_ingest: List[FileChange] = field(default_factory=list)
+    # تغييرات لا تحتاج ابتلاعاً (تُطبق عبر IngestManifest.sync)
+    touched: List[FileChange] = field(default_factory=list)
+    moved: List[FileChange] = field(default_factory=list)
+    duplicates: List[FileChange] = field(default_factory=list)
+    adopted: List[FileChange] = field(default_factory=list)
+    deleted: List[ManifestEntry] = field(default_factory=list)
+    unchanged: int = 0
+    manifest_size: int = 0
+
+    def summary(self) -> Dict[str, int]:
+        return {
+            "new": sum(1 for c in self.to_ingest if c.action == IngestManifest.NEW),
+            "changed": sum(1 for c in self.to_ingest if c.action == IngestManifest.CHANGED),
+            "unchanged": self.unchanged,
+            "moved": len(self.moved),
+            "duplicates": len(self.duplicates),
+            "adopted": len(self.adopted),
+            "deleted": len(self.deleted),
+        }
+
+class IngestManifest:
+    """
+    سجل دائم للملفات المبتلعة في جدول ai_ingest_manifest (مسار، بصمة المحتوى، الحجم، mtime).
+
+    - الملف بنفس الحجم و mtime يُتخطى بدون قراءته.
+    - غير ذلك تُحسب بصمة SHA-256 للمحتوى:
+        * نفس البصمة لنفس المسار: تحديث mtime فقط (مثلاً touch أو نسخ احتياطي).
+        * البصمة لمسار اختفى: الملف نُقل/أعيدت تسميته، فيُحدَّث المسار بدون إعادة ابتلاع.
+        * البصمة لمسار آخر موجود: نسخة مكررة تشير لنفس المستند.
+        * بصمة مختلفة لمسار معروف: إعادة ابتلاع تحدّث المستند نفسه (المواد المتغيرة فقط).
+    - مسارات السجل التي لم تعد موجودة تُحذف مع مستنداتها وأجزائها (ما لم يشر إليها مسار آخر).
+      إذا كان المفقود أكثر من GC_MAX_RATIO من السجل (مثلاً مجلد بيانات غير مركّب) يُتخطى
+      الحذف ما لم يُطلب صراحة (force_gc).
+    """
+
+    TABLE_NAME = "ai_ingest_manifest"
+    HASH_CHUNK_SIZE = 1024 * 1024
+    GC_MAX_RATIO = float(os.getenv("INGEST_GC_MAX_RATIO", "0.1"))
+    GC_MIN_FILES = int(os.getenv("INGEST_GC_MIN_FILES", "5"))
+
+    NEW, CHANGED = "new", "changed"
+
+    def __init__(self, vector_db):
+        """
+        Args:
+            vector_db: كائن PgVectorManager (نستخدم الـ pool الخاص به).
+        """
+        self.vector_db = vector_db
+
+    async def ensure_table(self, conn):
+        """إنشاء جدول السجل إن لم يكن موجوداً"""
+        await conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {self.TABLE_NAME} (
+                file_path VARCHAR(1000) PRIMARY KEY,
+                content_hash CHAR(64) NOT NULL,
+                file_size BIGINT NOT NULL,
+                mtime_ns BIGINT NOT NULL,
+                document_id INTEGER REFERENCES ai_legal_documents(id) ON DELETE CASCADE,
+                ingested_at TIMESTAMP DEFAULT NOW(),
+                updated_at TIMESTAMP DEFAULT NOW()
+            )
+        ''')
+        await conn.execute(f'''
+            CREATE INDEX IF NOT EXISTS idx_ingest_manifest_hash ON {self.TABLE_NAME}(content_hash)
+        ''')
+
+    # ------------------------------------------------------------------
+    # أدوات داخلية
+    # ------------------------------------------------------------------
+    @classmethod
+    def file_hash(cls, file_path: str) -> str:
+        """بصمة SHA-256 للمحتوى (قراءة على دفعات بذاكرة ثابتة)"""
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(cls.HASH_CHUNK_SIZE), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _in_scope(file_path: str, scope: Optional[List[str]], extensions: Optional[set]) -> bool:
+        if extensions is not None and os.path.splitext(file_path)[1].lower() not in extensions:
+            return False
+        if scope is None:
+            return True
+        return any(file_path.startswith(root.rstrip(os.sep) + os.sep) for root in scope)
+
+    async def load(self) -> Dict[str, ManifestEntry]:
+        async with self.vector_db.pool.acquire() as conn:
+            rows = await conn.fetch(
+                f"SELECT file_path, content_hash, file_size, mtime_ns, document_id FROM {self.TABLE_NAME}"
+            )
+        return {row['file_path']: ManifestEntry(**dict(row)) for row in rows}
+
+    async def _legacy_documents(self, paths: List[str]) -> Dict[str, int]:
+        """مستندات مبتلعة قبل وجود السجل (معروفة بالمسار فقط)"""
+        if not paths:
+            return {}
+        async with self.vector_db.pool.acquire() as conn:
+            rows = await conn.fetch('''
+                SELECT file_path, MAX(id) AS document_id
+                FROM ai_legal_documents
+                WHERE file_path = ANY($1::text[])
+                GROUP BY file_path
+            ''', paths)
+        return {row['file_path']: row['document_id'] for row in rows}
+
+    # ------------------------------------------------------------------
+    # الواجهة العامة
+    # ------------------------------------------------------------------
+    async def plan(self, file_paths: Iterable[str], scope: Optional[Iterable[str]] = None,
+                   extensions: Optional[Iterable[str]] = None) -> IngestPlan:
+        """
+        مقارنة الملفات الحالية بالسجل.
+
+        Args:
+            file_paths: كل الملفات الموجودة حالياً (مسارات مطلقة).
+            scope: المجلدات التي مُسحت بالكامل؛ مسارات السجل المفقودة داخلها فقط تُعتبر محذوفة
+                   (None = السجل كله).
+            extensions: امتدادات الملفات التي شملها المسح (None = كل الامتدادات).
+        """
+        entries = await self.load()
+        by_hash: Dict[str, List[ManifestEntry]] = {}
+        references: Dict[int, int] = {}
+        for entry in entries.values():
+            by_hash.setdefault(entry.content_hash, []).append(entry)
+            if entry.document_id is not None:
+                references[entry.document_id] = references.get(entry.document_id, 0) + 1
+
+        present = {os.path.abspath(path) for path in file_paths}
+        roots = [os.path.abspath(root) for root in scope] if scope is not None else None
+        suffixes = {ext.lower() for ext in extensions} if extensions is not None else None
+        plan = IngestPlan(manifest_size=len(entries))
+        pending: List[FileChange] = []
+        claimed: set = set()  # (مسارات قديمة انتقل محتواها لمسار جديد)
+        new_hashes: set = set()
+
+        for path in sorted(present):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entry = entries.get(path)
+            if entry and entry.file_size == stat.st_size and entry.mtime_ns == stat.st_mtime_ns:
+                plan.unchanged += 1
+                continue
+
+            try:
+                content_hash = await asyncio.to_thread(self.file_hash, path)
+            except OSError as e:
+                logger.warning(f"⚠️ IngestManifest: تعذر قراءة {path}: {e}")
+                continue
+            change = FileChange(path, self.NEW, content_hash, stat.st_size, stat.st_mtime_ns,
+                                document_id=entry.document_id if entry else None)
+
+            if entry and entry.content_hash == content_hash:
+                plan.touched.append(change)
+                continue
+
+            if entry is None:
+                same_content = [e for e in by_hash.get(content_hash, []) if e.file_path not in claimed]
+                vanished = [e for e in same_content if e.file_path not in present and not os.path.exists(e.file_path)]
+                if vanished:
+                    change.previous_path = vanished[0].file_path
+                    change.document_id = vanished[0].document_id
+                    claimed.add(change.previous_path)
+                    plan.moved.append(change)
+                    continue
+                if same_content:
+                    change.document_id = same_content[0].document_id
+                    plan.duplicates.append(change)
+                    continue
+                if content_hash in new_hashes:
+                    # (نسخة من ملف جديد في نفس المسح: تُسجل كمكررة في المسح التالي بعد ابتلاع الأصل)
+                    logger.debug(f"IngestManifest: تأجيل نسخة مكررة {path}")
+                    continue
+                new_hashes.add(content_hash)
+                pending.append(change)
+            else:
+                change.action = self.CHANGED
+                if references.get(entry.document_id, 0) > 1:
+                    # (المستند مشترك مع نسخة مكررة لم تتغير: الملف المعدل يأخذ مستنداً جديداً)
+                    change.document_id = None
+                plan.to_ingest.append(change)
+
+        # ملفات بلا سجل لكن لها مستند بنفس المسار (ابتلاع سابق لإضافة السجل): تُعتمد كما هي
+        legacy = await self._legacy_documents([change.file_path for change in pending])
+        for change in pending:
+            if change.file_path in legacy:
+                change.document_id = legacy[change.file_path]
+                plan.adopted.append(change)
+            else:
+                plan.to_ingest.append(change)
+
+        plan.deleted = [
+            entry for path, entry in entries.items()
+            if path not in present and path not in claimed
+            and self._in_scope(path, roots, suffixes) and not os.path.exists(path)
+        ]
+        return plan
+
+    async def sync(self, plan: IngestPlan, force_gc: bool = False) -> Dict[str, int]:
+        """
+        تطبيق ما لا يحتاج ابتلاعاً: تحديث mtime، المسارات المنقولة، النسخ المكررة، اعتماد
+        المستندات القديمة، وحذف المستندات (وأجزائها) للملفات المحذوفة.
+
+        Args:
+            force_gc: حذف مستندات الملفات المفقودة حتى لو تجاوزت حد GC_MAX_RATIO من السجل.
+        """
+        removed_documents = 0
+        deleted = plan.deleted
+        gc_limit = max(self.GC_MIN_FILES, int(plan.manifest_size * self.GC_MAX_RATIO))
+        if len(deleted) > gc_limit and not force_gc:
+            logger.warning(
+                f"⚠️ IngestManifest: {len(deleted)} من {plan.manifest_size} ملف مسجل مفقود (الحد {gc_limit}) - "
+                f"تم تخطي حذف المستندات. تحقق من وجود مجلد البيانات أو أعد التشغيل مع --gc"
+            )
+            deleted = []
+        async with self.vector_db.pool.acquire() as conn:
+            async with conn.transaction():
+                for change in plan.touched + plan.duplicates + plan.adopted:
+                    await self._upsert(conn, change, change.document_id)
+
+                for change in plan.moved:
+                    await conn.execute(f'''
+                        UPDATE {self.TABLE_NAME}
+                        SET file_path = $2, file_size = $3, mtime_ns = $4, updated_at = NOW()
+                        WHERE file_path = $1
+                    ''', change.previous_path, change.file_path, change.file_size, change.mtime_ns)
+                    if change.document_id is not None:
+                        await conn.execute('''
+                            UPDATE ai_legal_documents SET file_path = $2, updated_at = NOW()
+                            WHERE id = $1 AND file_path = $3
+                        ''', change.document_id, change.file_path, change.previous_path)
+                    logger.info(f"🔀 IngestManifest: {change.previous_path} -> {change.file_path} (بدون إعادة ابتلاع)")
+
+                for entry in deleted:
+                    await conn.execute(f"DELETE FROM {self.TABLE_NAME} WHERE file_path = $1", entry.file_path)
+                    if entry.document_id is None:
+                        continue
+                    # (المستند قد يكون مشتركاً مع نسخة مكررة ما زالت موجودة)
+                    still_referenced = await conn.fetchval(
+                        f"SELECT 1 FROM {self.TABLE_NAME} WHERE document_id = $1 LIMIT 1", entry.document_id
+                    )
+                    if still_referenced:
+                        continue
+                    # (الأجزاء تُحذف بالـ ON DELETE CASCADE)
+                    await conn.execute("DELETE FROM ai_legal_documents WHERE id = $1", entry.document_id)
+                    removed_documents += 1
+                    logger.info(f"🧹 IngestManifest: حذف المستند {entry.document_id} (الملف لم يعد موجوداً: {entry.file_path})")
+
+        summary = {
+            **plan.summary(), "deleted": len(deleted), "documents_removed": removed_documents,
+            "gc_skipped": len(plan.deleted) - len(deleted),
+        }
+        logger.info(
+            f"📒 IngestManifest: {summary['new']} جديد، {summary['changed']} معدل، {summary['unchanged']} بدون تغيير، "
+            f"{summary['moved']} منقول، {summary['duplicates']} مكرر، {summary['deleted']} محذوف"
+        )
+        return summary
+
+    async def _upsert(self, conn, change: FileChange, document_id: Optional[int]):
+        await conn.execute(f'''
+            INSERT INTO {self.TABLE_NAME} (file_path, content_hash, file_size, mtime_ns, document_id)
+            VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT (file_path) DO UPDATE SET
+                content_hash = EXCLUDED.content_hash,
+                file_size = EXCLUDED.file_size,
+                mtime_ns = EXCLUDED.mtime_ns,
+                document_id = EXCLUDED.document_id,
+                updated_at = NOW()
+        ''', change.file_path, change.content_hash, change.file_size, change.mtime_ns, document_id)
+
+    async def record(self, change: FileChange, document_id: Any):
+        """تسجيل ملف بعد ابتلاعه بنجاح (يُستدعى بعد كتابة المستند وأجزائه)"""
+        try:
+            async with self.vector_db.pool.acquire() as conn:
+                await self._upsert(conn, change, document_id if isinstance(document_id, int) else None)
+        except Exception as e:
+            logger.error(f"❌ IngestManifest: فشل تسجيل {change.file_path}: {e}")
@@ -1,17 +1,29 @@
 # backend/app/ai_advisor/rag/semantic_retriever.py
+import asyncio
 from datetime import datetime
+import hashlib
 import json
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, AsyncGenerator
 import logging
 from .advanced_pdf_processor import ProcessingResult, AdvancedPDFProcessor
 from .smart_chunker import SmartChunker
 from .pgvector_manager import PgVectorManager
+from .arabic_normalizer import ArabicNormalizer
 from ..core.hybrid_embedder import HybridEmbedder
 
 logger = logging.getLogger(__name__)
 
+# ثابت Reciprocal Rank Fusion (القيمة المعتادة في الأدبيات)
+RRF_K = 60
+
 class SemanticRetriever:
     """مسترجع دلالي متقدم للمعلومات القانونية - يدعم AWS Textract والمعالجة المحلية"""
+
+    # بيانات وصفية تتغير مع كل ابتلاع دون تغير الجزء نفسه (موضعه، محرك المعالجة، توقيت المعالجة):
+    # لا تدخل في مقارنة diff_chunks حتى لا يُعاد كتابة كل جزء بعد إضافة فقرة واحدة
+    VOLATILE_CHUNK_KEYS = frozenset({
+        "chunk_index", "total_chunks", "processing_engine", "processed_at", "ingested_at", "processing_time",
+    })
     
     def __init__(self, database_url: str):
         self.vector_db = PgVectorManager(database_url)
@@ -29,11 +41,16 @@ class SemanticRetriever:
             else:
                 raise Exception("فشل تهيئة قاعدة البيانات")
     
-    async def ingest_legal_document(self, pdf_path: str, metadata: Dict[str, Any]) -> Dict[str, Any]:
+    async def ingest_legal_document(self, pdf_path: str, metadata: Dict[str, Any],
+                                    document_id: Optional[int] = None) -> Dict[str, Any]:
         """
         استيعاب وثيقة قانونية باستخدام AWS Textract كخيار أساسي
         مع fallback للمعالجة المحلية إذا فشل الاتصال بـ AWS
+
+        document_id: مستند موجود يُعاد ابتلاعه (الملف تغير) عبر update_legal_document.
         """
+        if document_id is not None:
+            return await self.update_legal_document(pdf_path, document_id, metadata)
         try:
             # المحاولة الأولى: استخدام AWS Textract للاستخراج المتقدم
             aws_result = await self._ingest_with_aws(pdf_path, metadata)
@@ -80,18 +97,35 @@ class SemanticRetriever:
             logger.warning(f"⚠️ فشل المعالجة باستخدام AWS: {e}")
             return {"success": False, "error": f"AWS Textract failed: {str(e)}"}
     
-    async def _ingest_locally(self, pdf_path: str, metadata: Dict[str, Any]) -> Dict[str, Any]:
-        """استيعاب المستند باستخدام المعالجة المحلية (fallback)"""
+    async def update_legal_document(self, pdf_path: str, document_id: int, metadata: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        تحديث مستند موجود من نسخة جديدة (طبعة معدلة من القانون).
+
+        تُستخرج المواد من النسخة الجديدة وتُقارن بالأجزاء المخزنة ببصمة النص المطبَّع لكل
+        article_number: المواد المعدلة أو الجديدة فقط تُضمَّن وتُكتب، والمحذوفة تُحذف،
+        والباقية تبقى بصفوفها وتضميناتها.
+        """
+        return await self._ingest_locally(pdf_path, metadata, document_id)
+
+    async def _ingest_locally(self, pdf_path: str, metadata: Dict[str, Any],
+                              document_id: Optional[int] = None) -> Dict[str, Any]:
+        """استيعاب المستند باستخدام المعالجة المحلية (fallback، أو تحديث مستند موجود)"""
         try:
             processor = AdvancedPDFProcessor()
             # ✅ التصحيح: استخدام process_legal_document بدلاً من process_law_pdf
             result = processor.process_legal_document(pdf_path)
             
             # حفظ المستند في قاعدة البيانات
-            document_id = await self._save_document_to_db(result, metadata)
+            is_update = document_id is not None
+            document_id = await self._save_document_to_db(result, metadata, document_id)
             
-            # تقسيم النص إلى أجزاء
-            chunks_created = await self._chunk_and_save_document_fixed(result, document_id, metadata)
+            # تقسيم النص إلى أجزاء (عند التحديث: الأجزاء المتغيرة فقط)
+            if is_update:
+                chunk_diff = await self._update_document_chunks(result, document_id, metadata)
+                chunks_created = chunk_diff["embedded"]
+            else:
+                chunk_diff = None
+                chunks_created = await self._chunk_and_save_document_fixed(result, document_id, metadata)
             
             return {
                 "success": True,
@@ -100,6 +134,7 @@ class SemanticRetriever:
                 "articles_processed": len(result.articles),
                 "pages_processed": result.total_pages,
                 "chunks_created": chunks_created,
+                "chunk_diff": chunk_diff,
                 "stats": result.stats,
                 "metadata": {**result.metadata, **metadata},
                 "sample_articles": [
@@ -123,10 +158,36 @@ class SemanticRetriever:
             logger.error(f"❌ فشل المعالجة المحلية: {e}")
             return {"success": False, "error": f"Local processing failed: {str(e)}"}
     
-    async def _save_document_to_db(self, result: ProcessingResult, metadata: Dict[str, Any]) -> int:
-        """حفظ المستند في قاعدة البيانات"""
+    async def _save_document_to_db(self, result: ProcessingResult, metadata: Dict[str, Any],
+                                   document_id: Optional[int] = None) -> int:
+        """حفظ المستند في قاعدة البيانات (أو تحديث سجل مستند موجود عند إعادة الابتلاع)"""
         try:
             async with self.vector_db.pool.acquire() as conn:
+                if document_id is not None:
+                    updated = await conn.fetchval('''
+                        UPDATE ai_legal_documents SET
+                            title = $2, content = $3, metadata = $4, document_type = $5,
+                            country = $6, file_path = $7, file_size = $8, processing_stats = $9,
+                            updated_at = $10
+                        WHERE id = $1
+                        RETURNING id
+                    ''',
+                        document_id,
+                        metadata.get('title', 'Untitled'),
+                        result.full_text,
+                        json.dumps({**result.metadata, **metadata}),
+                        metadata.get('document_type', 'law'),
+                        metadata.get('country', 'unknown'),
+                        metadata.get('file_path'),
+                        metadata.get('file_size', 0),
+                        json.dumps(result.stats),
+                        datetime.now()
+                    )
+                    if updated is not None:
+                        logger.info(f"💾 تم تحديث المستند في قاعدة البيانات (ID: {document_id})")
+                        return document_id
+                    # (المستند حُذف في الأثناء: يُنشأ من جديد)
+
                 document_id = await conn.fetchval('''
                     INSERT INTO ai_legal_documents (
                         title, content, metadata, document_type, 
@@ -154,95 +215,159 @@ class SemanticRetriever:
             logger.error(f"❌ فشل حفظ المستند في قاعدة البيانات: {e}")
             raise Exception(f"فشل حفظ المستند: {e}")
     
+    @staticmethod
+    def chunk_text_hash(text: str) -> str:
+        """بصمة النص المطبَّع (التشكيل/أشكال الحروف/المسافات لا تغير البصمة)"""
+        normalized = " ".join(ArabicNormalizer.normalize(text or "").split())
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def stable_chunk_metadata(cls, metadata: Dict[str, Any]) -> Dict[str, Any]:
+        """البيانات الوصفية للجزء بدون المفاتيح المتغيرة (أساس المقارنة في diff_chunks)"""
+        return {key: value for key, value in metadata.items() if key not in cls.VOLATILE_CHUNK_KEYS}
+
+    @staticmethod
+    def build_chunk_rows(result: ProcessingResult, metadata: Dict[str, Any],
+                         chunker: SmartChunker) -> Tuple[List[str], List[Dict[str, Any]], List[Optional[str]]]:
+        """
+        أجزاء المستند (النص الكامل مقسماً + المواد كأجزاء منفصلة) جاهزة للتضمين.
+        دالة نقية بلا اتصال بقاعدة البيانات، فتعمل أيضاً داخل عمليات الابتلاع المتوازي.
+
+        Returns:
+            (النصوص، البيانات الوصفية لكل جزء، رقم المادة لكل جزء)
+        """
+        processing_engine = result.stats.get('processing_engine', 'unknown')
+        chunk_hash = SemanticRetriever.chunk_text_hash
+        texts: List[str] = []
+        row_meta: List[Dict[str, Any]] = []
+        article_numbers: List[Optional[str]] = []
+        
+        # 1. تقسيم النص الكامل إلى أجزاء
+        full_text_chunks = chunker.chunk_text(result.full_text)
+        
+        for i, chunk_text in enumerate(full_text_chunks):
+            if not chunk_text.strip():
+                continue
+            texts.append(chunk_text)
+            row_meta.append({
+                **metadata,
+                "chunk_index": i,
+                "total_chunks": len(full_text_chunks),
+                "chunk_type": "full_text",
+                "processing_engine": processing_engine,
+                "text_hash": chunk_hash(chunk_text)
+            })
+            article_numbers.append(None)
+        
+        # 2. المواد كأجزاء منفصلة
+        for article in result.articles or []:
+            if article.content and len(article.content.strip()) > 10:
+                texts.append(article.content)
+                row_meta.append({
+                    **metadata,
+                    "article_number": article.number,
+                    "article_page": article.page,
+                    "article_section": article.section,
+                    "chunk_type": "article",
+                    "processing_engine": processing_engine,
+                    "text_hash": chunk_hash(article.content)
+                })
+                article_numbers.append(article.number)
+
+        return texts, row_meta, article_numbers
+
+    async def write_chunks(self, result: ProcessingResult, document_id: int,
+                           texts: List[str], embeddings: Any,
+                           row_meta: List[Dict[str, Any]], article_numbers: List[Optional[str]]) -> int:
+        """كتابة جماعية (COPY) لأجزاء مستند مع تضميناتها في معاملة واحدة"""
+        if len(embeddings) != len(texts):
+            raise Exception(f"عدد التضمينات ({len(embeddings)}) لا يطابق عدد الأجزاء ({len(texts)})")
+
+        rows = list(zip(texts, embeddings, row_meta, article_numbers))
+        write_stats = await self.vector_db.bulk_insert_chunks(document_id, rows)
+        result.stats['chunk_write'] = write_stats
+        return write_stats['rows']
+
+    async def diff_chunks(self, result: ProcessingResult, document_id: int,
+                          texts: List[str], row_meta: List[Dict[str, Any]],
+                          article_numbers: List[Optional[str]]) -> Dict[str, int]:
+        """
+        تحديث أجزاء مستند موجود بالفرق فقط.
+
+        كل جزء جديد يُطابق بجزء مخزن له نفس (article_number، بصمة النص المطبَّع):
+        المطابق يبقى كما هو (تُحدَّث بياناته الوصفية فقط إن تغير غير المتغير منها -
+        VOLATILE_CHUNK_KEYS لا تُقارن)، وغير المطابق يُضمَّن
+        ويُكتب، والمخزن الذي لم يطابقه شيء يُحذف - كل ذلك في معاملة واحدة.
+        """
+        stored = await self.vector_db.fetch_document_chunks(document_id)
+        available: Dict[Tuple[Optional[str], str], List[Dict[str, Any]]] = {}
+        for row in stored:
+            text_hash = row['metadata'].get('text_hash') or self.chunk_text_hash(row['text'])
+            available.setdefault((row['article_number'], text_hash), []).append(row)
+
+        changed: List[int] = []
+        metadata_updates: List[Tuple[int, Dict[str, Any]]] = []
+        for i, (meta, article_number) in enumerate(zip(row_meta, article_numbers)):
+            matches = available.get((article_number, meta['text_hash']))
+            if matches:
+                row = matches.pop(0)
+                if self.stable_chunk_metadata(row['metadata']) != self.stable_chunk_metadata(meta):
+                    metadata_updates.append((row['id'], meta))
+            else:
+                changed.append(i)
+        delete_ids = [row['id'] for rows in available.values() for row in rows]
+
+        embeddings = await self.embedder.get_embeddings([texts[i] for i in changed]) if changed else []
+        if len(embeddings) != len(changed):
+            raise Exception(f"عدد التضمينات ({len(embeddings)}) لا يطابق عدد الأجزاء المتغيرة ({len(changed)})")
+
+        rows = [(texts[i], embedding, row_meta[i], article_numbers[i]) for i, embedding in zip(changed, embeddings)]
+        result.stats['chunk_write'] = await self.vector_db.bulk_insert_chunks(
+            document_id, rows, delete_ids=delete_ids, metadata_updates=metadata_updates
+        )
+        diff = {
+            "unchanged": len(texts) - len(changed),
+            "embedded": len(changed),
+            "deleted": len(delete_ids),
+            "metadata_updated": len(metadata_updates),
+        }
+        result.stats['chunk_diff'] = diff
+        logger.info(
+            f"🔁 تحديث المستند {document_id}: {diff['embedded']} جزء جديد/معدل، {diff['deleted']} محذوف، "
+            f"{diff['unchanged']} بدون تغيير (من {len(texts)})"
+        )
+        return diff
+
+    async def _update_document_chunks(self, result: ProcessingResult, document_id: int,
+                                      metadata: Dict[str, Any]) -> Dict[str, int]:
+        """تقسيم النسخة الجديدة من المستند ثم تحديث أجزائه بالفرق فقط"""
+        texts, row_meta, article_numbers = self.build_chunk_rows(result, metadata, self.chunker)
+        if not texts:
+            # (استخراج فاشل على الأرجح: لا نحذف أجزاء المستند الحالية)
+            logger.warning(f"⚠️ لا توجد أجزاء صالحة في النسخة الجديدة من المستند {document_id} - أُبقيت الأجزاء الحالية")
+            return {"unchanged": 0, "embedded": 0, "deleted": 0, "metadata_updated": 0}
+        return await self.diff_chunks(result, document_id, texts, row_meta, article_numbers)
+    
     async def _chunk_and_save_document_fixed(self, result: ProcessingResult, document_id: int, metadata: Dict[str, Any]) -> int:
-        """تقسيم المستند إلى أجزاء وحفظها - الإصدار المصحح النهائي"""
+        """
+        تقسيم المستند إلى أجزاء وحفظها.
+        
+        كل أجزاء المستند (النص الكامل + المواد) تُضمَّن في استدعاء get_embeddings واحد،
+        ثم تُكتب دفعة واحدة عبر COPY داخل معاملة واحدة.
+        """
         try:
-            chunks_created = 0
-            
-            # 1. تقسيم النص الكامل إلى أجزاء
-            full_text_chunks = self.chunker.chunk_text(result.full_text)
+            texts, row_meta, article_numbers = self.build_chunk_rows(result, metadata, self.chunker)
             
-            for i, chunk_text in enumerate(full_text_chunks):
-                if not chunk_text.strip():
-                    continue
-                    
-                # إنشاء تضمين للجزء
-                chunk_embedding = await self.embedder.get_embedding(chunk_text)
-                
-                # ✅ التحويل الآمن للتضمين
-                if hasattr(chunk_embedding, 'tolist'):
-                    embedding_list = chunk_embedding.tolist()
-                else:
-                    embedding_list = list(chunk_embedding)
-                
-                # ✅ التأكد من أن جميع العناصر هي floats
-                embedding_list = [float(x) for x in embedding_list]
-                
-                # ✅ التحويل إلى string format
-                embedding_str = '[' + ','.join(map(str, embedding_list)) + ']'
-                
-                # حفظ الجزء في قاعدة البيانات
-                async with self.vector_db.pool.acquire() as conn:
-                    await conn.execute('''
-                        INSERT INTO ai_document_chunks 
-                        (document_id, chunk_text, embedding, metadata, created_at)
-                        VALUES ($1, $2, $3::vector, $4, $5)
-                    ''', 
-                        document_id,
-                        chunk_text,
-                        embedding_str,  # ✅ إرسال ك string مع تحويل إلى vector
-                        json.dumps({
-                            **metadata,
-                            "chunk_index": i,
-                            "total_chunks": len(full_text_chunks),
-                            "chunk_type": "full_text",
-                            "processing_engine": result.stats.get('processing_engine', 'unknown')
-                        }),
-                        datetime.now()
-                    )
-                chunks_created += 1
+            if not texts:
+                logger.warning("⚠️ لا توجد أجزاء صالحة للحفظ")
+                return 0
             
-            # 2. حفظ المواد كأجزاء منفصلة
-            if result.articles:
-                for article in result.articles:
-                    if article.content and len(article.content.strip()) > 10:
-                        article_embedding = await self.embedder.get_embedding(article.content)
-                        
-                        # ✅ التحويل الآمن للتضمين
-                        if hasattr(article_embedding, 'tolist'):
-                            article_embedding_list = article_embedding.tolist()
-                        else:
-                            article_embedding_list = list(article_embedding)
-                        
-                        # ✅ التأكد من أن جميع العناصر هي floats
-                        article_embedding_list = [float(x) for x in article_embedding_list]
-                        
-                        # ✅ التحويل إلى string format
-                        article_embedding_str = '[' + ','.join(map(str, article_embedding_list)) + ']'
-                        
-                        async with self.vector_db.pool.acquire() as conn:
-                            await conn.execute('''
-                                INSERT INTO ai_document_chunks 
-                                (document_id, chunk_text, embedding, metadata, article_number, created_at)
-                                VALUES ($1, $2, $3::vector, $4, $5, $6)
-                            ''', 
-                                document_id,
-                                article.content,
-                                article_embedding_str,  # ✅ إرسال ك string مع تحويل إلى vector
-                                json.dumps({
-                                    **metadata,
-                                    "article_number": article.number,
-                                    "article_page": article.page,
-                                    "article_section": article.section,
-                                    "chunk_type": "article",
-                                    "processing_engine": result.stats.get('processing_engine', 'unknown')
-                                }),
-                                article.number,
-                                datetime.now()
-                            )
-                        chunks_created += 1
+            # 3. تضمين دفعي واحد لكل أجزاء المستند
+            embeddings = await self.embedder.get_embeddings(texts)
             
-            logger.info(f"✂️ تم إنشاء {chunks_created} جزء من المستند")
+            # 4. كتابة جماعية (COPY) في معاملة واحدة
+            chunks_created = await self.write_chunks(result, document_id, texts, embeddings, row_meta, article_numbers)
+            logger.info(f"✂️ تم إنشاء {chunks_created} جزء من المستند ({result.stats['chunk_write']['rows_per_sec']} صف/ث)")
             return chunks_created
             
         except Exception as e:
@@ -250,8 +375,11 @@ class SemanticRetriever:
             return 0
     
     async def retrieve_relevant_content(self, query: str, max_results: int = 8, 
-                                      filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
-        """استرجاع المحتوى ذي الصلة"""
+                                      filters: Optional[Dict[str, Any]] = None,
+                                      similarity_threshold: float = 0.6,
+                                      probes: Optional[int] = None,
+                                      ef_search: Optional[int] = None) -> List[Dict[str, Any]]:
+        """استرجاع المحتوى ذي الصلة (probes / ef_search تضبط دقة الفهرس لكل استعلام)"""
         try:
             if not self.is_initialized:
                 await self.initialize()
@@ -269,7 +397,9 @@ class SemanticRetriever:
                 limit=max_results,
                 document_type=document_type,
                 country=country,
-                similarity_threshold=0.6
+                similarity_threshold=similarity_threshold,
+                probes=probes,
+                ef_search=ef_search
             )
             
             # تنسيق النتائج
@@ -281,7 +411,8 @@ class SemanticRetriever:
                     'metadata': chunk.metadata,
                     'article_number': chunk.metadata.get('article_number'),
                     'document_title': chunk.metadata.get('document_title'),
-                    'confidence': self._calculate_confidence(chunk)
+                    'confidence': self._calculate_confidence(chunk),
+                    'search_type': 'semantic'
                 })
             
             logger.info(f"🔍 تم استرجاع {len(formatted_results)} نتيجة للاستعلام: {query[:50]}...")
@@ -291,84 +422,162 @@ class SemanticRetriever:
             logger.error(f"❌ فشل استرجاع المحتوى: {e}")
             return []
     
-    async def hybrid_search(self, query: str, keyword_fallback: bool = True) -> List[Dict[str, Any]]:
-        """بحث هجين يجمع بين الدلالي والكلمات المفتاحية"""
+    async def hybrid_search(self, query: str, max_results: int = 8,
+                            filters: Optional[Dict[str, Any]] = None,
+                            dense_weight: float = 1.0,
+                            lexical_weight: float = 1.0,
+                            rrf_k: int = RRF_K,
+                            similarity_threshold: float = 0.6,
+                            candidate_multiplier: int = 2) -> List[Dict[str, Any]]:
+        """
+        بحث هجين حقيقي: البحث الدلالي (pgvector) والبحث النصي (tsvector) يعملان
+        بالتوازي، ثم تُدمج القائمتان بـ Reciprocal Rank Fusion.
+
+        Args:
+            dense_weight / lexical_weight: وزن كل مسار في الدمج (0 يعطل المسار).
+            rrf_k: ثابت RRF (القيمة الأكبر تقلل أثر الفرق بين المراتب الأولى).
+            candidate_multiplier: كل مسار يجلب max_results * candidate_multiplier مرشحاً.
+        """
+        fused: List[Dict[str, Any]] = []
+        async for stage, results in self.hybrid_search_batches(
+            query, max_results=max_results, filters=filters,
+            dense_weight=dense_weight, lexical_weight=lexical_weight, rrf_k=rrf_k,
+            similarity_threshold=similarity_threshold, candidate_multiplier=candidate_multiplier
+        ):
+            if stage == 'fused':
+                fused = results
+        return fused
+
+    async def hybrid_search_batches(self, query: str, max_results: int = 8,
+                                    filters: Optional[Dict[str, Any]] = None,
+                                    dense_weight: float = 1.0,
+                                    lexical_weight: float = 1.0,
+                                    rrf_k: int = RRF_K,
+                                    similarity_threshold: float = 0.6,
+                                    candidate_multiplier: int = 2) -> AsyncGenerator[Tuple[str, List[Dict[str, Any]]], None]:
+        """
+        نفس البحث الهجين لكن على مراحل: كل مسار يُرجع نتائجه فور انتهائه
+        (('keyword', ...) عادةً قبل ('semantic', ...) لأن المسار النصي لا ينتظر تضمين الاستعلام)،
+        ثم ('fused', ...) بعد الدمج. يسمح للمستدعي باستخدام نتائج المسار الأسرع قبل اكتمال الاسترجاع.
+        """
         try:
-            # البحث الدلالي الأساسي
-            semantic_results = await self.retrieve_relevant_content(query)
-            
-            # إذا كانت النتائج ضعيفة، استخدم البحث بالكلمات المفتاحية
-            if keyword_fallback and (not semantic_results or all(r['similarity'] < 0.7 for r in semantic_results)):
-                keyword_results = await self._keyword_search(query)
-                return keyword_results
-            
-            return semantic_results
-            
+            if not self.is_initialized:
+                await self.initialize()
+
+            candidates = max_results * max(candidate_multiplier, 1)
+
+            tasks: Dict[asyncio.Task, str] = {}
+            if dense_weight > 0:
+                tasks[asyncio.create_task(self.retrieve_relevant_content(
+                    query, max_results=candidates, filters=filters,
+                    similarity_threshold=similarity_threshold
+                ))] = 'semantic'
+            if lexical_weight > 0:
+                tasks[asyncio.create_task(self._keyword_search(
+                    query, limit=candidates, filters=filters
+                ))] = 'keyword'
+
+            results_by_type: Dict[str, List[Dict[str, Any]]] = {'semantic': [], 'keyword': []}
+            try:
+                pending = set(tasks)
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        results_by_type[tasks[task]] = task.result()
+                        if pending:
+                            # (الدفعة الأخيرة لا تُرسل منفردة: الدمج يليها مباشرة)
+                            yield tasks[task], results_by_type[tasks[task]]
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+            dense_results, lexical_results = results_by_type['semantic'], results_by_type['keyword']
+            fused = self._fuse_rrf(
+                [(dense_results, dense_weight), (lexical_results, lexical_weight)],
+                rrf_k=rrf_k
+            )[:max_results]
+
+            logger.info(
+                f"🔀 بحث هجين: {len(dense_results)} دلالي + {len(lexical_results)} نصي "
+                f"-> {len(fused)} نتيجة بعد الدمج"
+            )
+            yield 'fused', fused
+
         except Exception as e:
             logger.error(f"❌ فشل البحث الهجين: {e}")
-            return []
-    
-    async def _keyword_search(self, query: str) -> List[Dict[str, Any]]:
-        """بحث بالكلمات المفتاحية (احتياطي)"""
+            yield 'fused', []
+
+    @staticmethod
+    def _fuse_rrf(ranked_lists: List[Tuple[List[Dict[str, Any]], float]],
+                  rrf_k: int = RRF_K) -> List[Dict[str, Any]]:
+        """
+        دمج قوائم مرتبة بـ Reciprocal Rank Fusion:
+            score(d) = Σ weight_i / (rrf_k + rank_i(d))
+        المفتاح هو chunk_id، فالجزء الذي يظهر في القائمتين يجمع نقاط الاثنتين.
+        """
+        fused: Dict[Any, Dict[str, Any]] = {}
+        sources: Dict[Any, set] = {}
+
+        for results, weight in ranked_lists:
+            if weight <= 0:
+                continue
+            for rank, result in enumerate(results, start=1):
+                key = result['metadata'].get('chunk_id') or hash(result['content'])
+                score = weight / (rrf_k + rank)
+                if key not in fused:
+                    fused[key] = {**result, 'fusion_score': 0.0}
+                    sources[key] = set()
+                elif result.get('search_type') == 'semantic':
+                    # نُبقي تشابه الـ Cosine الحقيقي للعرض وإعادة الترتيب
+                    fused[key].update({k: v for k, v in result.items() if k != 'fusion_score'})
+                fused[key]['fusion_score'] += score
+                sources[key].add(result.get('search_type', 'semantic'))
+
+        for key, result in fused.items():
+            result['search_type'] = 'hybrid' if len(sources[key]) > 1 else next(iter(sources[key]))
+
+        return sorted(fused.values(), key=lambda r: r['fusion_score'], reverse=True)
+
+    async def _keyword_search(self, query: str, limit: int = 10,
+                              filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """بحث نصي على chunk_tsv (فهرس GIN) بالكلمات المفتاحية المستخرجة من الاستعلام"""
         try:
-            async with self.vector_db.pool.acquire() as conn:
-                # استخراج الكلمات المفتاحية من الاستعلام
-                keywords = self._extract_keywords(query)
-                
-                if not keywords:
-                    return []
-                
-                # بناء استعلام البحث
-                search_conditions = " OR ".join([f"chunk_text ILIKE '%{kw}%'" for kw in keywords])
-                
-                rows = await conn.fetch(f'''
-                    SELECT 
-                        dc.id,
-                        dc.chunk_text,
-                        dc.metadata,
-                        dc.article_number,
-                        ld.title as document_title,
-                        0.5 as similarity  -- ثقة متوسطة للبحث بالكلمات المفتاحية
-                    FROM ai_document_chunks dc
-                    JOIN ai_legal_documents ld ON dc.document_id = ld.id
-                    WHERE {search_conditions}
-                    LIMIT 10
-                ''')
-                
-                results = []
-                for row in rows:
-                    results.append({
-                        'content': row['chunk_text'],
-                        'similarity': row['similarity'],
-                        'metadata': json.loads(row['metadata']) if row['metadata'] else {},
-                        'article_number': row['article_number'],
-                        'document_title': row['document_title'],
-                        'confidence': 0.5,
-                        'search_type': 'keyword'
-                    })
-                
-                logger.info(f"🔤 تم العثور على {len(results)} نتيجة بالكلمات المفتاحية")
-                return results
-                
+            if not self.is_initialized:
+                await self.initialize()
+
+            keywords = self._extract_keywords(query)
+            if not keywords:
+                return []
+
+            chunks = await self.vector_db.lexical_search(
+                " OR ".join(keywords),
+                limit=limit,
+                document_type=filters.get('document_type') if filters else None,
+                country=filters.get('country') if filters else None
+            )
+
+            results = []
+            for chunk in chunks:
+                results.append({
+                    'content': chunk.text,
+                    'similarity': chunk.similarity,
+                    'metadata': chunk.metadata,
+                    'article_number': chunk.metadata.get('article_number'),
+                    'document_title': chunk.metadata.get('document_title'),
+                    'confidence': 0.5,
+                    'search_type': 'keyword'
+                })
+
+            logger.info(f"🔤 تم العثور على {len(results)} نتيجة بالكلمات المفتاحية")
+            return results
+
         except Exception as e:
             logger.error(f"❌ فشل البحث بالكلمات المفتاحية: {e}")
             return []
     
     def _extract_keywords(self, query: str) -> List[str]:
-        """استخراج الكلمات المفتاحية من الاستعلام"""
-        # قائمة بالكلمات الشائعة التي يمكن تجاهلها
-        stop_words = {'ما', 'هي', 'كيف', 'لماذا', 'متى', 'أين', 'من', 'هل', 'على', 'في', 'من'}
-        
-        # تقسيم الاستعلام إلى كلمات
-        words = query.split()
-        
-        # تصفية الكلمات المهمة
-        keywords = [
-            word for word in words 
-            if len(word) > 2 and word not in stop_words
-        ]
-        
-        return keywords[:5]  # الحد الأقصى 5 كلمات مفتاحية
+        """استخراج جذوع الكلمات المفتاحية (تطبيع + حذف كلمات التوقف + تجذيع خفيف)"""
+        return self.vector_db.text_normalizer.query_terms(query)
     
     def _calculate_confidence(self, chunk: Any) -> float:
         """حساب درجة الثقة للنتيجة"""
@@ -399,5 +608,6 @@ class SemanticRetriever:
                 'max_chunk_size': self.chunker.max_chunk_size,
                 'overlap': self.chunker.overlap
             },
+            'vector_index': await self.vector_db.index_manager.get_index_health(),
             'retrieval_ready': self.is_initialized
         }
\ No newline at end of file
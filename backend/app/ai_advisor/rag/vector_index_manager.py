@@ -0,0 +1,374 @@
+# backend/app/ai_advisor/rag/vector_index_manager.py
+import logging
+import math
+import os
+import time
+import json
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class IndexHealth:
+    index_name: str
+    index_type: str
+    params: Dict[str, Any]
+    row_count: int
+    build_seconds: float
+    recall: Optional[float]
+    built_at: datetime
+
+class VectorIndexManager:
+    """
+    مدير دورة حياة فهرس المتجهات على ai_document_chunks.embedding.
+
+    - يحسب معاملات الفهرس (HNSW أو ivfflat) من عدد الصفوف الفعلي.
+    - يبني الفهرس الجديد بـ CREATE INDEX CONCURRENTLY ثم يستبدل القديم في معاملة قصيرة
+      (حذف القديم + إعادة تسمية الجديد معاً)، ويحذف الفهرس المؤقت إذا فشل البناء.
+    - إذا بقي الـ recall تحت الحد تُرفع المعاملات (boost) مع كل إعادة بناء، بفاصل زمني متزايد.
+    - يسجل صحة الفهرس (عدد الصفوف عند البناء، زمن البناء، الـ recall على عينة)
+      في جدول ai_vector_index_metadata.
+    """
+
+    TABLE_NAME = "ai_document_chunks"
+    COLUMN_NAME = "embedding"
+    INDEX_NAME = "idx_document_chunks_embedding"
+    OPCLASS = "vector_cosine_ops"
+
+    # إعادة البناء عند تضاعف الجدول أو هبوط الـ recall تحت الحد
+    REBUILD_GROWTH_FACTOR = 2.0
+    MIN_RECALL = 0.90
+    # إعادة البناء بسبب الـ recall: كل محاولة ترفع المعاملات درجة (حتى MAX_RECALL_BOOST)
+    # ولا تتم قبل مرور REBUILD_BACKOFF * 2^(درجة سابقة) ثانية على البناء السابق
+    MAX_RECALL_BOOST = int(os.getenv("VECTOR_INDEX_MAX_RECALL_BOOST", "3"))
+    REBUILD_BACKOFF = float(os.getenv("VECTOR_INDEX_REBUILD_BACKOFF_SECONDS", "3600"))
+    # مهلة قفل الجدول أثناء استبدال الفهرس (لا نحجز طابور الاستعلامات خلف عملية طويلة)
+    SWAP_LOCK_TIMEOUT = os.getenv("VECTOR_INDEX_SWAP_LOCK_TIMEOUT", "5s")
+    # كل عملية تعيد قراءة معاملات البحث (probes / ef_search) من سجل الصحة النشط بهذا الفاصل،
+    # فتصل المعاملات المرفوعة بعد إعادة بناء في عملية أخرى لكل عمال الـ API
+    SEARCH_PARAMS_REFRESH = float(os.getenv("VECTOR_INDEX_PARAMS_REFRESH_SECONDS", "300"))
+
+    def __init__(self, vector_db, default_index_type: str = "hnsw"):
+        """
+        Args:
+            vector_db: كائن PgVectorManager (نستخدم الـ pool الخاص به).
+            default_index_type: "hnsw" (الافتراضي) أو "ivfflat".
+        """
+        self.vector_db = vector_db
+        self.default_index_type = default_index_type
+        self._params_loaded_at = 0.0
+
+    async def ensure_metadata_table(self, conn):
+        """إنشاء جدول بيانات صحة الفهرس إن لم يكن موجوداً"""
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS ai_vector_index_metadata (
+                id SERIAL PRIMARY KEY,
+                index_name VARCHAR(200) NOT NULL,
+                index_type VARCHAR(20) NOT NULL,
+                params JSONB,
+                row_count BIGINT,
+                build_seconds DOUBLE PRECISION,
+                recall DOUBLE PRECISION,
+                is_active BOOLEAN DEFAULT TRUE,
+                built_at TIMESTAMP DEFAULT NOW()
+            )
+        ''')
+
+    @staticmethod
+    def recommend_params(row_count: int, index_type: str = "hnsw", boost: int = 0) -> Dict[str, Any]:
+        """
+        حساب معاملات الفهرس من عدد الصفوف (حسب توصيات pgvector).
+
+        ivfflat: lists = rows/1000 حتى مليون صف ثم sqrt(rows)، و probes = sqrt(lists).
+        HNSW: m و ef_construction يكبران مع حجم المجموعة للحفاظ على الـ recall.
+        boost: كل درجة تضاعف probes / ef_search و ef_construction (بعد recall منخفض).
+        """
+        row_count = max(int(row_count or 0), 0)
+        boost = max(int(boost or 0), 0)
+
+        if index_type == "ivfflat":
+            if row_count <= 1_000_000:
+                lists = max(row_count // 1000, 1)
+            else:
+                lists = int(math.sqrt(row_count))
+            probes = min(max(int(math.sqrt(lists)), 1) * 2 ** boost, lists)
+            return {"lists": lists, "probes": probes, "boost": boost}
+
+        if index_type == "hnsw":
+            if row_count < 100_000:
+                m, ef_construction = 16, 64
+            elif row_count < 1_000_000:
+                m, ef_construction = 24, 128
+            else:
+                m, ef_construction = 32, 200
+            return {
+                "m": m,
+                "ef_construction": min(ef_construction * 2 ** boost, 1000),
+                "ef_search": min(max(40, m * 4) * 2 ** boost, 1000),
+                "boost": boost,
+            }
+
+        raise ValueError(f"نوع فهرس غير مدعوم: {index_type}")
+
+    def _index_ddl(self, index_name: str, index_type: str, params: Dict[str, Any], concurrently: bool) -> str:
+        """بناء جملة CREATE INDEX حسب النوع والمعاملات"""
+        if index_type == "ivfflat":
+            with_clause = f"lists = {int(params['lists'])}"
+        else:
+            with_clause = f"m = {int(params['m'])}, ef_construction = {int(params['ef_construction'])}"
+
+        return (
+            f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {index_name} "
+            f"ON {self.TABLE_NAME} USING {index_type} ({self.COLUMN_NAME} {self.OPCLASS}) "
+            f"WITH ({with_clause})"
+        )
+
+    async def create_initial_index(self, conn):
+        """
+        إنشاء الفهرس الافتراضي عند تهيئة الجداول.
+        HNSW لا يحتاج بيانات تدريب، لذا إنشاؤه على جدول فارغ آمن (بعكس ivfflat).
+        """
+        params = self.recommend_params(0, "hnsw")
+        await conn.execute(self._index_ddl(self.INDEX_NAME, "hnsw", params, concurrently=False))
+
+    async def _count_rows(self, conn) -> int:
+        return await conn.fetchval(
+            f"SELECT COUNT(*) FROM {self.TABLE_NAME} WHERE {self.COLUMN_NAME} IS NOT NULL"
+        )
+
+    def _apply_search_params(self, index_type: str, params: Dict[str, Any]):
+        """تطبيق معاملات البحث للفهرس النشط على مدير المتجهات"""
+        if index_type == "ivfflat" and params.get("probes"):
+            self.vector_db.ivfflat_probes = int(params["probes"])
+        elif index_type == "hnsw" and params.get("ef_search"):
+            self.vector_db.hnsw_ef_search = int(params["ef_search"])
+
+    async def load_search_params(self, conn) -> bool:
+        """قراءة معاملات البحث من سجل الصحة النشط (عند التهيئة وبعدها دورياً)"""
+        row = await conn.fetchrow('''
+            SELECT index_type, params
+            FROM ai_vector_index_metadata
+            WHERE index_name = $1 AND is_active
+            ORDER BY built_at DESC
+            LIMIT 1
+        ''', self.INDEX_NAME)
+        self._params_loaded_at = time.monotonic()
+        if not row or not row['params']:
+            return False
+        self._apply_search_params(row['index_type'], json.loads(row['params']))
+        return True
+
+    async def refresh_search_params(self):
+        """إعادة قراءة معاملات البحث إذا مر SEARCH_PARAMS_REFRESH (فشلها لا يوقف البحث)"""
+        if time.monotonic() - self._params_loaded_at < self.SEARCH_PARAMS_REFRESH:
+            return
+        self._params_loaded_at = time.monotonic()
+        try:
+            async with self.vector_db.pool.acquire() as conn:
+                await self.load_search_params(conn)
+        except Exception as e:
+            logger.warning(f"⚠️ تعذر تحديث معاملات البحث من سجل صحة الفهرس: {e}")
+
+    async def _drop_temp_index(self, conn, temp_name: str):
+        """حذف فهرس مؤقت فشل بناؤه أو استبداله (CONCURRENTLY الفاشل يترك فهرساً INVALID يُحدَّث مع كل كتابة)"""
+        try:
+            await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {temp_name}")
+        except Exception as e:
+            logger.error(f"❌ تعذر حذف الفهرس المؤقت {temp_name} - احذفه يدوياً: {e}")
+
+    async def build_index(self, index_type: Optional[str] = None, concurrently: bool = True,
+                          measure_recall: bool = True, boost: int = 0) -> IndexHealth:
+        """
+        بناء (أو إعادة بناء) فهرس المتجهات بمعاملات مشتقة من عدد الصفوف.
+
+        يُبنى فهرس جديد باسم مؤقت، ثم يُحذف القديم ويُعاد تسمية الجديد في معاملة واحدة
+        (لا توجد لحظة بلا فهرس)، بحيث يبقى البحث يعمل طوال فترة البناء.
+        إذا فشل البناء أو الاستبدال يُحذف الفهرس المؤقت ويبقى القديم كما هو.
+        """
+        index_type = index_type or self.default_index_type
+        pool = self.vector_db.pool
+
+        async with pool.acquire() as conn:
+            row_count = await self._count_rows(conn)
+            params = self.recommend_params(row_count, index_type, boost)
+            temp_name = f"{self.INDEX_NAME}_{index_type}_{int(time.time())}"
+
+            logger.info(f"🏗️ بناء فهرس {index_type} على {row_count} صف بالمعاملات {params}...")
+            started = time.perf_counter()
+
+            try:
+                # CREATE INDEX CONCURRENTLY لا يعمل داخل معاملة (asyncpg ينفذ هنا بدون معاملة)
+                await conn.execute(self._index_ddl(temp_name, index_type, params, concurrently))
+                async with conn.transaction():
+                    await conn.execute(f"SET LOCAL lock_timeout = '{self.SWAP_LOCK_TIMEOUT}'")
+                    await conn.execute(f"DROP INDEX IF EXISTS {self.INDEX_NAME}")
+                    await conn.execute(f"ALTER INDEX {temp_name} RENAME TO {self.INDEX_NAME}")
+            except BaseException:
+                await self._drop_temp_index(conn, temp_name)
+                raise
+
+            build_seconds = time.perf_counter() - started
+            logger.info(f"✅ اكتمل بناء الفهرس خلال {build_seconds:.1f} ثانية")
+
+        # تطبيق معاملات البحث الموصى بها على مدير المتجهات (وتُحفظ مع سجل الصحة
+        # فتقرؤها باقي العمليات عبر refresh_search_params وعند إعادة التشغيل)
+        self._apply_search_params(index_type, params)
+
+        recall = await self.measure_recall() if measure_recall and row_count else None
+
+        health = IndexHealth(
+            index_name=self.INDEX_NAME,
+            index_type=index_type,
+            params=params,
+            row_count=row_count,
+            build_seconds=build_seconds,
+            recall=recall,
+            built_at=datetime.now()
+        )
+        await self._record_health(health)
+        return health
+
+    async def measure_recall(self, sample_size: int = 20, k: int = 10) -> Optional[float]:
+        """
+        قياس الـ recall@k للفهرس على عينة من المتجهات المخزنة:
+        مقارنة نتائج الفهرس التقريبي مع البحث الدقيق (Sequential Scan).
+        """
+        pool = self.vector_db.pool
+        try:
+            async with pool.acquire() as conn:
+                sample = await conn.fetch(f'''
+                    SELECT {self.COLUMN_NAME} AS vec
+                    FROM {self.TABLE_NAME} TABLESAMPLE SYSTEM (10)
+                    WHERE {self.COLUMN_NAME} IS NOT NULL
+                    LIMIT $1
+                ''', sample_size)
+                if not sample:
+                    return None
+
+                knn_sql = f'''
+                    SELECT id FROM {self.TABLE_NAME}
+                    WHERE {self.COLUMN_NAME} IS NOT NULL
+                    ORDER BY {self.COLUMN_NAME} <=> $1::vector
+                    LIMIT $2
+                '''
+                hits, total = 0, 0
+                for row in sample:
+                    async with conn.transaction():
+                        await conn.execute(
+                            f"SET LOCAL ivfflat.probes = {int(self.vector_db.ivfflat_probes)}; "
+                            f"SET LOCAL hnsw.ef_search = {int(max(self.vector_db.hnsw_ef_search, k))};"
+                        )
+                        approx = {r['id'] for r in await conn.fetch(knn_sql, row['vec'], k)}
+                    async with conn.transaction():
+                        await conn.execute("SET LOCAL enable_indexscan = off;")
+                        exact = {r['id'] for r in await conn.fetch(knn_sql, row['vec'], k)}
+                    hits += len(approx & exact)
+                    total += len(exact)
+
+                recall = hits / total if total else None
+                logger.info(f"🎯 recall@{k} للفهرس على {len(sample)} استعلام: {recall:.3f}")
+                return recall
+
+        except Exception as e:
+            logger.warning(f"⚠️ فشل قياس recall الفهرس: {e}")
+            return None
+
+    async def _record_health(self, health: IndexHealth):
+        """تسجيل صحة الفهرس الجديد وتعطيل السجلات السابقة"""
+        async with self.vector_db.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    "UPDATE ai_vector_index_metadata SET is_active = FALSE WHERE index_name = $1",
+                    health.index_name
+                )
+                await conn.execute('''
+                    INSERT INTO ai_vector_index_metadata
+                    (index_name, index_type, params, row_count, build_seconds, recall, is_active, built_at)
+                    VALUES ($1, $2, $3, $4, $5, $6, TRUE, $7)
+                ''',
+                    health.index_name,
+                    health.index_type,
+                    json.dumps(health.params),
+                    health.row_count,
+                    health.build_seconds,
+                    health.recall,
+                    health.built_at
+                )
+
+    async def get_index_health(self) -> Optional[Dict[str, Any]]:
+        """إرجاع آخر سجل صحة للفهرس مع عدد الصفوف الحالي"""
+        async with self.vector_db.pool.acquire() as conn:
+            row = await conn.fetchrow('''
+                SELECT index_name, index_type, params, row_count, build_seconds, recall, built_at
+                FROM ai_vector_index_metadata
+                WHERE index_name = $1 AND is_active
+                ORDER BY built_at DESC
+                LIMIT 1
+            ''', self.INDEX_NAME)
+            current_rows = await self._count_rows(conn)
+
+        if not row:
+            return None
+
+        health = dict(row)
+        health['params'] = json.loads(health['params']) if health['params'] else {}
+        health['current_row_count'] = current_rows
+        return health
+
+    def _rebuild_reason(self, health: Optional[Dict[str, Any]]) -> Optional[str]:
+        """سبب إعادة البناء: "missing" | "growth" | "recall" (أو None)"""
+        if not health:
+            return "missing"
+
+        built_rows = health['row_count'] or 0
+        if health['current_row_count'] >= max(built_rows, 1000) * self.REBUILD_GROWTH_FACTOR:
+            return "growth"
+
+        if health['recall'] is not None and health['recall'] < self.MIN_RECALL:
+            return "recall"
+
+        return None
+
+    async def needs_rebuild(self) -> bool:
+        """هل نما الجدول أو انخفض الـ recall بما يستدعي إعادة البناء؟"""
+        return self._rebuild_reason(await self.get_index_health()) is not None
+
+    async def maybe_rebuild(self, index_type: Optional[str] = None) -> Optional[IndexHealth]:
+        """
+        يُستدعى بعد الابتلاع الجماعي: يعيد بناء الفهرس (CONCURRENTLY) فقط عند الحاجة.
+
+        إعادة البناء بنفس المعاملات لا تصلح recall منخفضاً، لذلك كل إعادة بناء بسبب
+        الـ recall ترفع المعاملات درجة، ولا تتكرر قبل انقضاء فاصل يتضاعف مع كل درجة.
+        """
+        try:
+            health = await self.get_index_health()
+            reason = self._rebuild_reason(health)
+            if reason is None:
+                logger.info("✅ فهرس المتجهات بحالة جيدة - لا حاجة لإعادة البناء")
+                return None
+
+            boost = (health or {}).get('params', {}).get('boost', 0)
+            if reason == "recall":
+                if boost >= self.MAX_RECALL_BOOST:
+                    logger.warning(
+                        f"⚠️ recall الفهرس ({health['recall']:.3f}) ما زال تحت {self.MIN_RECALL} "
+                        f"بأعلى معاملات (درجة {boost}) - لا إعادة بناء تلقائية، راجع نوع الفهرس"
+                    )
+                    return None
+                wait = self.REBUILD_BACKOFF * 2 ** boost
+                age = (datetime.now() - health['built_at']).total_seconds()
+                if age < wait:
+                    logger.info(
+                        f"⏳ recall الفهرس منخفض ({health['recall']:.3f}) لكن آخر بناء منذ {age:.0f}ث "
+                        f"- إعادة البناء بعد {wait - age:.0f}ث"
+                    )
+                    return None
+                boost += 1
+
+            return await self.build_index(index_type=index_type, concurrently=True, boost=boost)
+        except Exception as e:
+            logger.error(f"❌ فشل إعادة بناء فهرس المتجهات: {e}")
+            return None
+
@@ -61,18 +61,11 @@ class DocumentAnalyzer:
         if not document_text.strip():
             return {"error": "النص فارغ."}
 
-        # --- 1. التحقق من الكاش ---
-        cache_key = ""
-        if self.cache_manager:
-            text_hash = hashlib.sha256(document_text.encode('utf-8')).hexdigest()
-            cache_key = f"analyze:{text_hash}"
-            cached_analysis = await self.cache_manager.get(cache_key)
-            if cached_analysis:
-                logger.debug("DocumentAnalyzer: تم العثور على التحليل في الكاش.")
-                return cached_analysis
+        raw_response = ""
 
-        # --- 2. استدعاء LLM لإنشاء الـ JSON ---
-        try:
+        # --- 1. استدعاء LLM لإنشاء الـ JSON ---
+        async def _analyze() -> Dict[str, Any]:
+            nonlocal raw_response
             # نستخدم نموذج "ذكي" لضمان الالتزام بتعليمات JSON المعقدة
             raw_response = await self.orchestrator.generate_response(
                 system_prompt=self.ANALYSIS_PROMPT_TEMPLATE,
@@ -81,14 +74,17 @@ class DocumentAnalyzer:
                 use_cache=False 
             )
 
-            # --- 3. تنظيف ومعالجة الـ JSON ---
-            analysis_json = self._extract_json_from_response(raw_response)
-            
-            # --- 4. تخزين النتيجة في الكاش ---
-            if self.cache_manager:
-                await self.cache_manager.set(cache_key, analysis_json, ttl=86400) # 24 ساعة
+            # --- 2. تنظيف ومعالجة الـ JSON ---
+            return self._extract_json_from_response(raw_response)
 
-            return analysis_json
+        try:
+            if not self.cache_manager:
+                return await _analyze()
+
+            # --- 3. الكاش (24 ساعة) مع منع تكرار التحليل المتزامن لنفس المستند ---
+            text_hash = hashlib.sha256(document_text.encode('utf-8')).hexdigest()
+            cache_key = f"analyze:{text_hash}"
+            return await self.cache_manager.get_or_set(cache_key, _analyze, ttl=86400)
 
         except json.JSONDecodeError as json_err:
             logger.error(f"❌ DocumentAnalyzer: فشل في تحليل JSON. الخطأ: {json_err}. الاستجابة الخام: {raw_response[:200]}...")
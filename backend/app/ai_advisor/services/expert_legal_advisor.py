@@ -1,9 +1,14 @@
+import asyncio
 import logging
 from typing import Optional, Dict, Any, List, AsyncGenerator
 from ..core.multi_llm_orchestrator import MultiLLMOrchestrator
 from ..core.cache_manager import CacheManager
+from ..core.semantic_answer_cache import SemanticAnswerCache
+from ..core.request_coalescer import RequestCoalescer
 from ..rag.semantic_retriever import SemanticRetriever
 from ..rag.cross_encoder_ranker import CrossEncoderRanker
+from ..rag.arabic_normalizer import ArabicNormalizer
+from ..rag.context_packer import ContextPacker, PackedContext
 import hashlib
 import json
 
@@ -40,11 +45,19 @@ class ExpertLegalAdvisor:
 **الإجابة القانونية:**
 """
 
+    # علامة الخطأ التي يضعها المنسق داخل النص عند الفشل (هذه الإجابات لا تُخزن)
+    ERROR_MARKER = "[حدث خطأ في النظام"
+    # حجم الجزء (بالحروف) عند إعادة بث إجابة مخزنة
+    REPLAY_CHUNK_CHARS = 80
+
     def __init__(self, 
                  orchestrator: MultiLLMOrchestrator,
                  retriever: SemanticRetriever,
                  reranker: CrossEncoderRanker,
-                 cache_manager: Optional[CacheManager] = None):
+                 cache_manager: Optional[CacheManager] = None,
+                 semantic_cache: Optional[SemanticAnswerCache] = None,
+                 coalescer: Optional[RequestCoalescer] = None,
+                 context_packer: Optional[ContextPacker] = None):
         """
         تهيئة المستشار الخبير.
         
@@ -53,37 +66,66 @@ class ExpertLegalAdvisor:
             retriever: مسترجع المستندات (المرحلة 1).
             reranker: مصنف إعادة الترتيب (المرحلة 2).
             cache_manager: مدير الكاش لتخزين الإجابات النهائية.
+            semantic_cache: كاش دلالي للأسئلة المعاد صياغتها (يُنشأ تلقائياً مع cache_manager).
+            coalescer: دمج الطلبات المتطابقة الجارية (داخل العملية وبين العمليات عبر Redis).
+            context_packer: تعبئة السياق ضمن ميزانية tokens (تُنشأ بمُرمّز نموذج "smart").
         """
         self.orchestrator = orchestrator
         self.retriever = retriever
         self.reranker = reranker
         self.cache_manager = cache_manager
+        if semantic_cache is None and cache_manager:
+            semantic_cache = SemanticAnswerCache(
+                embedder=retriever.embedder,
+                cache_manager=cache_manager,
+                version_fn=retriever.vector_db.get_corpus_version
+            )
+        self.semantic_cache = semantic_cache
+        self.coalescer = coalescer or RequestCoalescer(cache_manager)
+        self.context_packer = context_packer or ContextPacker(model_name=orchestrator.get_model_name("smart"))
         logger.info("✅ ExpertLegalAdvisor Service: تم التهيئة بنجاح.")
 
     async def _retrieve_and_rank(self, query: str, filters: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """
-        تنفيذ خطوتي الاسترجاع وإعادة الترتيب.
+        تنفيذ خطوتي الاسترجاع وإعادة الترتيب على مراحل متداخلة:
+        دفعة البحث النصي تصل أولاً (لا تنتظر تضمين الاستعلام) فيبدأ الـ Cross-Encoder
+        بتقييمها بينما يعمل البحث الدلالي، ودرجاتها تُكتب في كاش الأزواج. بعد الدمج
+        يُقيَّم ما لم يُقيَّم بعد من المرشحين فقط.
         """
-        # --- المرحلة 1: الاسترجاع الدلالي (سريع) ---
-        # نجلب عدد كبير نسبياً من المرشحين (e.g., 25)
-        initial_candidates = await self.retriever.retrieve_relevant_content(
-            query, 
-            max_results=25, 
-            filters=filters
-        )
+        max_results = 25
+        warmup: Optional[asyncio.Task] = None
+        initial_candidates: List[Dict[str, Any]] = []
+        try:
+            # --- المرحلة 1: الاسترجاع الهجين (دلالي + نصي بالتوازي) ---
+            async for stage, results in self.retriever.hybrid_search_batches(
+                query, max_results=max_results, filters=filters
+            ):
+                if stage == 'keyword' and results and self.reranker.cache_manager:
+                    # (نسخ: rerank_documents يعدل المستندات، والدمج يشارك نفس metadata)
+                    early = [{**doc, 'metadata': dict(doc['metadata'])} for doc in results[:max_results]]
+                    warmup = asyncio.create_task(self.reranker.rerank_documents(query, early, cascade=False))
+                elif stage == 'fused':
+                    initial_candidates = results
+            if warmup:
+                # (درجات الدفعة المبكرة يجب أن تصل للكاش قبل تقييم ناتج الدمج)
+                await warmup
+        finally:
+            if warmup and not warmup.done():
+                warmup.cancel()
+
         if not initial_candidates:
             logger.warning(f"RAG: لم يتم العثور على مستندات مرشحة للاستعلام: {query[:50]}...")
             return []
 
         # --- المرحلة 2: إعادة الترتيب (دقيق) ---
-        # الـ Reranker سيختار أفضل K (e.g., 5) من الـ 25
+        # الـ Reranker سيختار أفضل K (e.g., 5) من الـ 25 (أزواج الدفعة النصية من الكاش)
         reranked_docs = await self.reranker.rerank_documents(query, initial_candidates)
         
         logger.debug(f"RAG: تم العثور على {len(reranked_docs)} مستند ذي صلة بعد إعادة الترتيب.")
         return reranked_docs
 
     def _format_context(self, documents: List[Dict[str, Any]]) -> str:
-        """تنسيق المستندات المسترجعة في "سياق" نصي واحد للـ LLM."""
+        """تنسيق المستندات المسترجعة كاملة (المرجع لحساب الـ tokens الموفرة بالتعبئة)."""
         if not documents:
             return "لا توجد مستندات في قاعدة المعرفة."
             
@@ -100,6 +142,123 @@ class ExpertLegalAdvisor:
 """)
         return "\n".join(context_parts)
 
+    @staticmethod
+    def _query_fingerprint(query: str, filters: Optional[Dict[str, Any]]) -> str:
+        """بصمة السؤال بعد التطبيع (التشكيل/الهمزات/المسافات لا تغير الإجابة) + الفلاتر"""
+        normalized_query = " ".join(ArabicNormalizer.normalize(query).split())
+        return hashlib.sha256(f"{normalized_query}{json.dumps(filters, sort_keys=True)}".encode('utf-8')).hexdigest()
+
+    def _build_context(self, query: str, documents: List[Dict[str, Any]]) -> PackedContext:
+        """سياق الـ LLM ضمن ميزانية الـ tokens (المصادر مرقمة بنفس ترتيب قائمة sources المرسلة)"""
+        packed = self.context_packer.pack(query, documents, baseline_text=self._format_context(documents))
+        report = packed.report()
+        logger.info(
+            f"📦 ContextPacker: {report['tokens_used']}/{report['tokens_before']} token "
+            f"(وفّر {report['tokens_saved']}، {report['sources_used']} مصدر، "
+            f"{report['duplicates_removed']} جملة مكررة)"
+        )
+        return packed
+
+    async def _answer_cache_key(self, query: str, filters: Optional[Dict[str, Any]]) -> str:
+        """
+        مفتاح الكاش الدقيق للإجابة (مشترك بين المسار الكامل والمتدفق).
+        يتضمن نسخة المستندات حتى لا تُعاد إجابة قديمة لنفس السؤال بعد تحديث مستند.
+        """
+        fingerprint = self._query_fingerprint(query, filters)
+        if self.semantic_cache:
+            return f"rag_answer:{await self.semantic_cache.corpus_tag()}:{fingerprint}"
+        return f"rag_answer:{fingerprint}"
+
+    async def _lookup_cached_answer(self, query: str, filters: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """البحث عن إجابة مخزنة: المفتاح الدقيق أولاً ثم الكاش الدلالي"""
+        if not self.cache_manager:
+            return None
+
+        cached_answer = await self.cache_manager.get(await self._answer_cache_key(query, filters))
+        if cached_answer:
+            logger.debug("ExpertAdvisor: تم العثور على الإجابة في الكاش.")
+            return cached_answer
+
+        # الكاش الدلالي (صياغة أخرى لسؤال سبقت الإجابة عليه بنفس الفلاتر ونفس المواد/القوانين)
+        if self.semantic_cache:
+            try:
+                similar_answer = await self.semantic_cache.lookup(query, filters)
+                if similar_answer:
+                    logger.debug("ExpertAdvisor: إجابة من الكاش الدلالي لسؤال مشابه.")
+                    return similar_answer
+            except Exception as e:
+                logger.warning(f"⚠️ ExpertAdvisor: فشل البحث في الكاش الدلالي: {e}")
+        return None
+
+    async def _store_answer(self, query: str, filters: Optional[Dict[str, Any]], result: Dict[str, Any]):
+        """تخزين الإجابة النهائية في الكاش الدقيق والدلالي (الإجابات الفاشلة لا تُخزن)"""
+        if not self.cache_manager or self.ERROR_MARKER in (result.get("answer") or ""):
+            return
+        try:
+            await self.cache_manager.set(await self._answer_cache_key(query, filters), result, ttl=3600) # ساعة واحدة
+            if self.semantic_cache and result.get("sources"):
+                # (لا نخزن دلالياً إجابات بلا مصادر حتى لا تنتشر "لا توجد معلومات" لأسئلة مشابهة)
+                await self.semantic_cache.store(query, filters, result)
+        except Exception as e:
+            logger.warning(f"⚠️ ExpertAdvisor: فشل تخزين الإجابة في الكاش: {e}")
+
+    def _replay_chunks(self, answer: str) -> List[str]:
+        """تقسيم إجابة مخزنة إلى أجزاء (على حدود الكلمات) لإعادة بثها بنفس صيغة البث"""
+        chunks, current = [], ""
+        for word in answer.split(" "):
+            candidate = f"{current} {word}" if current else word
+            if len(candidate) > self.REPLAY_CHUNK_CHARS and current:
+                chunks.append(current + " ")
+                current = word
+            else:
+                current = candidate
+        if current:
+            chunks.append(current)
+        return chunks
+
+    async def _replay_answer(self, cached_answer: Dict[str, Any]) -> AsyncGenerator[Dict[str, Any], None]:
+        """إعادة بث إجابة مخزنة بنفس صيغة رسائل البث"""
+        yield {"type": "retrieval_done", "content": cached_answer.get("sources", [])}
+        for chunk in self._replay_chunks(cached_answer.get("answer", "")):
+            yield {"type": "text", "content": chunk}
+        yield {"type": "sources", "content": cached_answer.get("sources", [])}
+
+    async def _generate_stream(self, query: str, filters: Optional[Dict[str, Any]]) -> AsyncGenerator[Dict[str, Any], None]:
+        """بث إجابة جديدة (استرجاع + ترتيب + LLM) ثم تخزينها"""
+        # --- 1. الاسترجاع وإعادة الترتيب ---
+        reranked_docs = await self._retrieve_and_rank(query, filters)
+        
+        # --- 2. تعبئة السياق ضمن الميزانية ---
+        packed = self._build_context(query, reranked_docs)
+        context_str = packed.text
+
+        # --- 3. إرسال المصادر فوراً (قبل أول token من الـ LLM) ---
+        sources = [doc['metadata'] for doc in packed.documents]
+        yield {"type": "retrieval_done", "content": sources}
+        
+        # --- 4. بناء البرومبت ---
+        system_prompt = self.EXPERT_PROMPT.format(context=context_str, query=query)
+        
+        # --- 5. بث الإجابة (Streaming) ---
+        logger.debug(f"Streaming RAG response for: {query[:50]}...")
+        
+        answer_parts: List[str] = []
+        async for chunk in self.orchestrator.generate_response_stream(
+            system_prompt=system_prompt,
+            human_prompt=query, # (يمكن ترك هذا فارغاً لأن السؤال مدمج في برومبت النظام)
+            model_key="smart"
+        ):
+            answer_parts.append(chunk)
+            yield {"type": "text", "content": chunk}
+
+        # --- 6. إرسال المصادر بعد انتهاء البث ---
+        # (للتوافق مع العملاء الذين ينتظرون رسالة sources في النهاية)
+        yield {"type": "sources", "content": sources}
+
+        # --- 7. تخزين الإجابة الكاملة ---
+        # (البث يعمل في مهمة الـ coalescer، فيكتمل ويُخزن حتى لو قطع العميل الاتصال)
+        await self._store_answer(query, filters, {"answer": "".join(answer_parts), "sources": sources})
+
     async def answer_question_stream(
         self, 
         query: str, 
@@ -107,32 +266,26 @@ class ExpertLegalAdvisor:
     ) -> AsyncGenerator[Dict[str, Any], None]:
         """
         الإجابة على سؤال (مع بث متدفق - Streaming) مدعوم بالمصادر.
-        (لا يستخدم الكاش).
+        (يستخدم نفس كاش الإجابات: الإصابة تُعاد كبث سريع بنفس صيغة الرسائل،
+        والإجابة الجديدة تُخزن بعد اكتمال البث).
+        الأسئلة المتطابقة المتزامنة تشترك في بث واحد للـ LLM.
         """
         try:
-            # --- 1. الاسترجاع وإعادة الترتيب ---
-            reranked_docs = await self._retrieve_and_rank(query, filters)
-            
-            # --- 2. تنسيق السياق ---
-            context_str = self._format_context(reranked_docs)
-            
-            # --- 3. بناء البرومبت ---
-            system_prompt = self.EXPERT_PROMPT.format(context=context_str, query=query)
-            
-            # --- 4. بث الإجابة (Streaming) ---
-            logger.debug(f"Streaming RAG response for: {query[:50]}...")
-            
-            async for chunk in self.orchestrator.generate_response_stream(
-                system_prompt=system_prompt,
-                human_prompt=query, # (يمكن ترك هذا فارغاً لأن السؤال مدمج في برومبت النظام)
-                model_key="smart"
-            ):
-                yield {"type": "text", "content": chunk}
+            # --- 0. الكاش: إعادة بث الإجابة المخزنة ---
+            cached_answer = await self._lookup_cached_answer(query, filters)
+            if cached_answer:
+                async for message in self._replay_answer(cached_answer):
+                    yield message
+                return
 
-            # --- 5. إرسال المصادر بعد انتهاء البث ---
-            # (هذا يسمح للـ Frontend بعرض المصادر بعد اكتمال الإجابة)
-            sources = [doc['metadata'] for doc in reranked_docs]
-            yield {"type": "sources", "content": sources}
+            # --- 1. بث مدمج (مشترك مع أي طلب جارٍ لنفس السؤال) ---
+            async for message in self.coalescer.stream(
+                self._query_fingerprint(query, filters),
+                lambda: self._generate_stream(query, filters),
+                result_fn=lambda: self._lookup_cached_answer(query, filters),
+                replay_fn=self._replay_answer
+            ):
+                yield message
 
         except Exception as e:
             logger.error(f"❌ ExpertAdvisor (Stream): فشل. خطأ: {e}")
@@ -148,41 +301,46 @@ class ExpertLegalAdvisor:
         (يستخدم الكاش).
         """
         
-        # --- 1. التحقق من الكاش ---
-        cache_key = ""
-        if self.cache_manager:
-            query_hash = hashlib.sha256(f"{query}{json.dumps(filters, sort_keys=True)}".encode('utf-8')).hexdigest()
-            cache_key = f"rag_answer:{query_hash}"
-            cached_answer = await self.cache_manager.get(cache_key)
-            if cached_answer:
-                logger.debug("ExpertAdvisor: تم العثور على الإجابة في الكاش.")
-                return cached_answer
+        # --- 1. التحقق من الكاش (الدقيق ثم الدلالي) ---
+        cached_answer = await self._lookup_cached_answer(query, filters)
+        if cached_answer:
+            return cached_answer
+
+        # --- 2. حساب واحد لكل الطلبات المتطابقة الجارية ---
+        return await self.coalescer.run(
+            self._query_fingerprint(query, filters),
+            lambda: self._generate_answer(query, filters),
+            result_fn=lambda: self._lookup_cached_answer(query, filters)
+        )
 
-        # --- 2. الاسترجاع وإعادة الترتيب ---
+    async def _generate_answer(self, query: str, filters: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """إنشاء إجابة جديدة كاملة (استرجاع + ترتيب + LLM) ثم تخزينها"""
+        # --- 1. الاسترجاع وإعادة الترتيب ---
         reranked_docs = await self._retrieve_and_rank(query, filters)
-        context_str = self._format_context(reranked_docs)
+        packed = self._build_context(query, reranked_docs)
+        context_str = packed.text
         
-        # --- 3. بناء البرومبت ---
+        # --- 2. بناء البرومبت ---
         system_prompt = self.EXPERT_PROMPT.format(context=context_str, query=query)
         
-        # --- 4. إنشاء الإجابة الكاملة ---
+        # --- 3. إنشاء الإجابة الكاملة ---
         try:
             full_response = await self.orchestrator.generate_response(
                 system_prompt=system_prompt,
                 human_prompt=query,
                 model_key="smart",
-                use_cache=False # (الكاش يتم هنا على مستوى الخدمة)
+                use_cache=False, # (الكاش يتم هنا على مستوى الخدمة)
+                priority="interactive"
             )
             
-            sources = [doc['metadata'] for doc in reranked_docs]
+            sources = [doc['metadata'] for doc in packed.documents]
             final_result = {"answer": full_response, "sources": sources}
 
-            # --- 5. تخزين النتيجة في الكاش ---
-            if self.cache_manager:
-                await self.cache_manager.set(cache_key, final_result, ttl=3600) # ساعة واحدة
+            # --- 4. تخزين النتيجة في الكاش ---
+            await self._store_answer(query, filters, final_result)
 
             return final_result
 
         except Exception as e:
             logger.error(f"❌ ExpertAdvisor (Full): فشل. خطأ: {e}")
-            return {"answer": f"حدث خطأ في النظام: {e}", "sources": []}
\ No newline at end of file
+            return {"answer": f"حدث خطأ في النظام: {e}", "sources": []}
@@ -36,7 +36,8 @@ class LegalTranslator:
     async def translate_text(self, 
                              text: str, 
                              source_lang: str, 
-                             target_lang: str) -> str:
+                             target_lang: str,
+                             priority: str = "interactive") -> str:
         """
         ترجمة نص قانوني من لغة إلى أخرى.
         
@@ -44,6 +45,7 @@ class LegalTranslator:
             text: النص المراد ترجمته.
             source_lang: اللغة المصدر (e.g., "العربية").
             target_lang: اللغة الهدف (e.g., "الإنجليزية").
+            priority: أولوية الطلب عند المزود ("batch" للترجمة بالجملة).
             
         Returns:
             النص المترجم.
@@ -51,38 +53,31 @@ class LegalTranslator:
         if not text.strip():
             return ""
 
-        # --- 1. التحقق من الكاش أولاً ---
-        cache_key = ""
-        if self.cache_manager:
-            # إنشاء مفتاح كاش فريد وآمن
-            text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
-            cache_key = f"translate:{text_hash}:{source_lang}:{target_lang}"
-            cached_translation = await self.cache_manager.get(cache_key)
-            if cached_translation:
-                logger.debug("LegalTranslator: تم العثور على الترجمة في الكاش.")
-                return cached_translation
-
-        # --- 2. بناء البرومبت والاتصال بـ LLM ---
-        try:
+        # --- 1. بناء البرومبت والاتصال بـ LLM ---
+        async def _translate() -> str:
             system_prompt = self.LEGAL_TRANSLATION_PROMPT.format(
                 source_lang=source_lang, 
                 target_lang=target_lang
             )
             
             # نستخدم نموذج "ذكي" (smart) لضمان دقة الترجمة القانونية
-            translated_text = await self.orchestrator.generate_response(
+            return await self.orchestrator.generate_response(
                 system_prompt=system_prompt,
                 human_prompt=text,
                 model_key="smart", # استخدام أفضل نموذج متاح (e.g., GPT-4o, Claude 3.5 Sonnet)
-                use_cache=False # (الكاش يتم هنا على مستوى الخدمة)
+                use_cache=False, # (الكاش يتم هنا على مستوى الخدمة)
+                priority=priority
             )
 
-            # --- 3. تخزين النتيجة في الكاش ---
-            if self.cache_manager:
-                # تخزين الترجمة الناجحة لمدة 24 ساعة
-                await self.cache_manager.set(cache_key, translated_text, ttl=86400)
+        try:
+            if not self.cache_manager:
+                return await _translate()
 
-            return translated_text
+            # --- 2. الكاش: الترجمة الناجحة تُخزن 24 ساعة ---
+            # (get_or_set يمنع تكرار استدعاء الـ LLM لنفس النص إذا طُلب بالتزامن)
+            text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+            cache_key = f"translate:{text_hash}:{source_lang}:{target_lang}"
+            return await self.cache_manager.get_or_set(cache_key, _translate, ttl=86400)
 
         except Exception as e:
             logger.error(f"❌ LegalTranslator: فشل في ترجمة النص. خطأ: {e}")
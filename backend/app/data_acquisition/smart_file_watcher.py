@@ -3,67 +3,341 @@ import asyncio
 import os
 import time
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
 import logging
 
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:  # (اختياري - بدونه تُستخدم المراقبة بالمسح الدوري)
+    Observer = None
+    FileSystemEventHandler = object
+
 logger = logging.getLogger(__name__)
 
+# أنواع أحداث نظام الملفات التي تعني تغير المحتوى (فتح/قراءة الملف لا تهمنا)
+_CONTENT_EVENTS = {"created", "modified", "moved", "deleted", "closed"}
+
+class _WatchdogHandler(FileSystemEventHandler):
+    """يُستدعى من خيط watchdog (inotify على Linux) وينقل المسارات لـ Event Loop المراقب"""
+
+    def __init__(self, watcher: "SmartFileWatcher"):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.event_type not in _CONTENT_EVENTS:
+            return
+        paths = [event.src_path]
+        if getattr(event, "dest_path", None):
+            paths.append(event.dest_path)
+        for path in paths:
+            path = os.fsdecode(path)
+            if event.is_directory:
+                if os.path.isdir(path):
+                    # مجلد نُسخ/نُقل إلى الشجرة: ملفاته لا تصدر أحداثاً خاصة بها
+                    if event.event_type in ("created", "moved"):
+                        for root, _, names in os.walk(path):
+                            for name in names:
+                                self.watcher.notify(os.path.join(root, name))
+                elif event.event_type in ("deleted", "moved"):
+                    # مجلد حُذف/نُقل خارج الشجرة: مستندات ملفاته تُحذف من السجل
+                    self.watcher.notify(path, directory=True)
+                continue
+            self.watcher.notify(path)
+
 class SmartFileWatcher:
-    def __init__(self, rag_service=None):
+    """
+    مراقبة مجلدات البيانات وابتلاع الملفات الجديدة/المعدلة تلقائياً:
+
+    - أحداث نظام الملفات (watchdog: inotify على Linux) بدلاً من مسح الشجرة كل دقيقة،
+      مع الرجوع للمسح الدوري إذا لم تتوفر المكتبة أو فشل تشغيلها.
+    - Debounce: الملف يُعتبر جاهزاً بعد DEBOUNCE_SECONDS بلا أحداث وبحجم/mtime ثابتين
+      (لا نبتلع ملفاً ما زال يُنسخ).
+    - الملفات الجاهزة تُجمع في دفعات (دفعة تُرسل عند هدوء الأحداث أو امتلائها أو بعد
+      BATCH_WINDOW_SECONDS) عبر طابور محدود لعامل الابتلاع.
+    - مسح كامل واحد عند البدء لالتقاط ما تغير أثناء توقف الخدمة.
+    """
+
+    SUPPORTED_EXTENSIONS = {
+        '.pdf', '.txt', '.md', '.docx', '.doc',
+        '.jpg', '.jpeg', '.png', '.tiff', '.bmp'
+    }
+
+    USE_EVENTS = os.getenv("WATCHER_USE_EVENTS", "true").lower() == "true"
+    DEBOUNCE_SECONDS = float(os.getenv("WATCHER_DEBOUNCE_SECONDS", "2.0"))
+    BATCH_WINDOW_SECONDS = float(os.getenv("WATCHER_BATCH_WINDOW_SECONDS", "10.0"))
+    BATCH_SIZE = int(os.getenv("WATCHER_BATCH_SIZE", "25"))
+    # (بالدفعات: إذا تأخر الابتلاع تتوقف الدفعات الجديدة وتتراكم المسارات بلا تكرار)
+    QUEUE_SIZE = int(os.getenv("WATCHER_QUEUE_SIZE", "4"))
+    POLL_INTERVAL = float(os.getenv("WATCHER_POLL_INTERVAL", "60"))
+
+    def __init__(self, rag_service=None, base_path: Optional[str] = None):
         self.rag_service = rag_service
-        self.base_path = Path("backend/data/countries")
+        self.base_path = Path(base_path or "backend/data/countries")
+        # بدون قاعدة بيانات (لا يوجد سجل ابتلاع) نعود لمجموعة في الذاكرة
         self.processed_files = set()
-        
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._observer = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._queue: Optional[asyncio.Queue] = None
+        # المسارات التي وصلتها أحداث ولم تهدأ بعد: path -> (وقت آخر حدث، (الحجم، mtime))
+        self._pending: Dict[str, Tuple[float, Optional[Tuple[int, int]]]] = {}
+
+        self.stats = {"mode": None, "events": 0, "batches": 0, "ingested": 0, "failed": 0}
+
+    @property
+    def manifest(self):
+        """سجل الابتلاع الدائم (IngestManifest) من قاعدة بيانات خدمة RAG إن وُجدت"""
+        vector_db = getattr(self.rag_service, "vector_db", None)
+        if vector_db is None or getattr(vector_db, "pool", None) is None:
+            return None
+        return getattr(vector_db, "ingest_manifest", None)
+
+    # ------------------------------------------------------------------
+    # أدوات داخلية
+    # ------------------------------------------------------------------
+    def _is_supported(self, path: str) -> bool:
+        name = os.path.basename(path)
+        if name.startswith(('.', '~$')):  # (ملفات مؤقتة للمحررات والمتصفحات)
+            return False
+        return os.path.splitext(name)[1].lower() in self.SUPPORTED_EXTENSIONS
+
+    @staticmethod
+    def _stat(path: str) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def _classify(self, file_path: str) -> Optional[Tuple[str, str]]:
+        """(الدولة، التصنيف) من موقع الملف: countries/<country>/<category>/..."""
+        try:
+            parts = Path(file_path).relative_to(self.base_path.resolve()).parts
+        except ValueError:
+            return None
+        if len(parts) < 3:
+            return None
+        return parts[0], parts[1]
+
+    def _group(self, file_paths: List[str]) -> Dict[str, Any]:
+        grouped: Dict[str, Any] = {}
+        for file_path in file_paths:
+            location = self._classify(file_path)
+            if location:
+                country, category = location
+                grouped.setdefault(country, {}).setdefault(category, []).append(file_path)
+        return grouped
+
+    # ------------------------------------------------------------------
+    # الأحداث
+    # ------------------------------------------------------------------
+    def notify(self, path: str, directory: bool = False):
+        """تسجيل حدث لملف أو مجلد محذوف (آمن للاستدعاء من أي خيط)"""
+        if self._loop is None or not (directory or self._is_supported(path)):
+            return
+        self._loop.call_soon_threadsafe(self._on_event, path, directory)
+
+    def _on_event(self, path: str, directory: bool = False):
+        path = os.path.realpath(path)
+        if directory:
+            path = path.rstrip(os.sep) + os.sep  # (المجلدات تُميَّز بالفاصل في آخرها)
+        self._pending[path] = (self._loop.time(), self._stat(path))
+        self.stats["events"] += 1
+        self._wakeup.set()
+
+    def _start_observer(self) -> bool:
+        if not self.USE_EVENTS:
+            return False
+        if Observer is None:
+            logger.warning("⚠️ مكتبة watchdog غير مثبتة - المراقبة بالمسح الدوري")
+            return False
+        if not self.base_path.is_dir():
+            logger.warning(f"⚠️ مجلد البيانات غير موجود: {self.base_path} - المراقبة بالمسح الدوري")
+            return False
+        try:
+            observer = Observer()
+            observer.schedule(_WatchdogHandler(self), str(self.base_path.resolve()), recursive=True)
+            observer.start()
+        except Exception as e:  # (مثلاً تجاوز حد inotify watches)
+            logger.warning(f"⚠️ تعذر تشغيل مراقبة الأحداث: {e} - المراقبة بالمسح الدوري")
+            return False
+        self._observer = observer
+        return True
+
+    def stop(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join(timeout=5)
+            self._observer = None
+
+    async def _event_loop(self):
+        """
+        تحويل الأحداث إلى دفعات: بدون أحداث ينتظر بلا استهلاك (سوى فحص صحة المراقب
+        كل POLL_INTERVAL)، ومع الأحداث يستيقظ كل نصف فترة الـ Debounce.
+        """
+        batch: List[str] = []
+        batch_started = 0.0
+
+        while True:
+            now = self._loop.time()
+            timeout = self.DEBOUNCE_SECONDS / 2 if self._pending else self.POLL_INTERVAL
+            if batch:
+                timeout = min(timeout, max(self.BATCH_WINDOW_SECONDS - (now - batch_started), 0.0))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            if self._observer is not None and not self._observer.is_alive():
+                logger.error("❌ توقف مراقب الأحداث - التحول للمسح الدوري")
+                self._observer = None
+                if batch:
+                    await self._queue.put(batch)
+                return
+
+            now = self._loop.time()
+            for path, (last_event, last_stat) in list(self._pending.items()):
+                if now - last_event < self.DEBOUNCE_SECONDS:
+                    continue
+                stat = self._stat(path)
+                if stat != last_stat:
+                    # (الملف ما زال يُكتب: ننتظر فترة هدوء أخرى)
+                    self._pending[path] = (now, stat)
+                    continue
+                del self._pending[path]
+                if path not in batch:
+                    if not batch:
+                        batch_started = now
+                    batch.append(path)
+
+            if batch and (not self._pending or len(batch) >= self.BATCH_SIZE
+                          or now - batch_started >= self.BATCH_WINDOW_SECONDS):
+                self.stats["batches"] += 1
+                await self._queue.put(batch)  # (Backpressure: ينتظر إذا امتلأ الطابور)
+                batch = []
+
+    async def _poll_loop(self):
+        while True:
+            await asyncio.sleep(self.POLL_INTERVAL)
+            try:
+                await self._enqueue_scan()
+            except Exception as e:
+                logger.error(f"❌ خطأ في المراقبة: {e}")
+
+    async def _enqueue_scan(self):
+        new_files = await self.scan_for_new_files()
+        paths = [path for categories in new_files.values() for files in categories.values() for path in files]
+        for i in range(0, len(paths), self.BATCH_SIZE):
+            self.stats["batches"] += 1
+            await self._queue.put(paths[i:i + self.BATCH_SIZE])
+
+    async def _ingest_worker(self):
+        while True:
+            batch = await self._queue.get()
+            try:
+                await self.process_batch(batch)
+            except Exception as e:
+                logger.error(f"❌ خطأ في معالجة دفعة من {len(batch)} ملف: {e}")
+            finally:
+                self._queue.task_done()
+
+    # ------------------------------------------------------------------
+    # الواجهة العامة
+    # ------------------------------------------------------------------
     async def start_monitoring(self):
         """بدء المراقبة الذكية للمجلدات"""
         logger.info("🚀 بدء مراقبة مجلدات البيانات الذكية...")
-        
-        while True:
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._queue = asyncio.Queue(maxsize=self.QUEUE_SIZE)
+        worker = asyncio.create_task(self._ingest_worker())
+
+        try:
+            # المراقب يبدأ قبل المسح الأولي حتى لا يضيع ملف يصل أثناءه
+            events = self._start_observer()
             try:
-                new_files = await self.scan_for_new_files()
-                if new_files:
-                    await self.process_new_files(new_files)
-                    
-                await asyncio.sleep(60)  # فحص كل دقيقة
-                
+                await self._enqueue_scan()
             except Exception as e:
-                logger.error(f"❌ خطأ في المراقبة: {e}")
-                await asyncio.sleep(300)  # انتظار 5 دقائق عند الخطأ
-    
+                logger.error(f"❌ خطأ في المسح الأولي: {e}")
+
+            if events:
+                self.stats["mode"] = "events"
+                logger.info(f"👀 مراقبة الأحداث على {self.base_path} (debounce {self.DEBOUNCE_SECONDS:g}ث)")
+                await self._event_loop()
+            self.stats["mode"] = "polling"
+            logger.info(f"🔁 مراقبة بالمسح الدوري كل {self.POLL_INTERVAL:g}ث")
+            await self._poll_loop()
+        finally:
+            self.stop()
+            worker.cancel()
+
     async def scan_for_new_files(self) -> Dict[str, Any]:
-        """مسح ذكي للملفات الجديدة"""
-        new_files = {}
-        
+        """
+        مسح ذكي للملفات الجديدة أو المعدلة.
+        مع سجل الابتلاع: الملفات غير المتغيرة (حجم + mtime) تُتخطى بدون قراءتها، والمنقولة
+        تُحدَّث بدون إعادة ابتلاع، ومستندات الملفات المحذوفة تُحذف مع أجزائها.
+        """
+        if not self.base_path.is_dir():
+            return {}
+
+        found = []
         for country_dir in self.base_path.iterdir():
             if not country_dir.is_dir():
                 continue
-                
+
             for category_dir in country_dir.iterdir():
                 if not category_dir.is_dir():
                     continue
-                    
-                for file_path in category_dir.glob("*.pdf"):
-                    if str(file_path) not in self.processed_files:
-                        country = country_dir.name
-                        category = category_dir.name
-                        
-                        if country not in new_files:
-                            new_files[country] = {}
-                        if category not in new_files[country]:
-                            new_files[country][category] = []
-                            
-                        new_files[country][category].append(str(file_path))
-                        
-        return new_files
-    
-    async def process_new_files(self, new_files: Dict[str, Any]):
-        """معالجة الملفات الجديدة تلقائياً"""
+
+                for file_path in category_dir.rglob("*"):
+                    if file_path.is_file() and self._is_supported(file_path.name):
+                        found.append(str(file_path.resolve()))
+
+        manifest = self.manifest
+        if manifest is not None:
+            plan = await manifest.plan(found, scope=[str(self.base_path.resolve())],
+                                       extensions=self.SUPPORTED_EXTENSIONS)
+            await manifest.sync(plan)
+            candidates = [change.file_path for change in plan.to_ingest]
+        else:
+            candidates = [path for path in found if path not in self.processed_files]
+
+        return self._group(candidates)
+
+    async def process_batch(self, file_paths: List[str]):
+        """
+        معالجة دفعة مسارات وصلتها أحداث: مقارنتها بسجل الابتلاع (جديد/معدل/منقول/محذوف)
+        ثم ابتلاع ما يحتاج ابتلاعاً فقط.
+        """
+        existing = [path for path in file_paths if os.path.isfile(path)]
+        removed = [path for path in file_paths if path not in existing]
+        logger.info(f"📦 دفعة مراقبة: {len(existing)} ملف جديد/معدل، {len(removed)} محذوف")
+
+        manifest = self.manifest
+        if manifest is not None:
+            # (مجلدات المحذوفات فقط: السجل لا يُحذف منه إلا ما اختفى فعلاً من القرص)
+            scope = {path if path.endswith(os.sep) else os.path.dirname(path) for path in removed}
+            plan = await manifest.plan(existing, scope=sorted(scope), extensions=self.SUPPORTED_EXTENSIONS)
+            # (حذف وصلت أحداثه صراحة: لا يخضع لحد الأمان الخاص بالمسح الكامل)
+            await manifest.sync(plan, force_gc=True)
+            changes = {change.file_path: change for change in plan.to_ingest}
+            await self.process_new_files(self._group(list(changes)), changes)
+        else:
+            await self.process_new_files(self._group([p for p in existing if p not in self.processed_files]))
+
+    async def process_new_files(self, new_files: Dict[str, Any], changes: Optional[Dict[str, Any]] = None):
+        """معالجة الملفات الجديدة تلقائياً (changes: سجلات خطة الابتلاع لكل مسار)"""
+        changes = changes or {}
         for country, categories in new_files.items():
             for category, files in categories.items():
                 for file_path in files:
                     try:
                         logger.info(f"🔄 معالجة تلقائية: {file_path}")
-                        
+
                         # إضافة الملف للنظام RAG تلقائياً
                         if self.rag_service:
                             metadata = {
@@ -74,17 +348,35 @@ class SmartFileWatcher:
                                 "auto_processed": True,
                                 "processed_at": time.time()
                             }
-                            
+
+                            change = changes.get(file_path)
+                            if change is not None:
+                                metadata["file_size"] = change.file_size
+
                             result = await self.rag_service.ingest_legal_document(
                                 pdf_path=file_path,
-                                metadata=metadata
+                                metadata=metadata,
+                                document_id=change.document_id if change else None
                             )
-                            
+
                             if result.get("success"):
-                                self.processed_files.add(file_path)
+                                if change is not None:
+                                    await self.manifest.record(change, result.get("document_id"))
+                                else:
+                                    self.processed_files.add(file_path)
+                                self.stats["ingested"] += 1
                                 logger.info(f"✅ تمت المعالجة التلقائية: {file_path}")
                             else:
+                                self.stats["failed"] += 1
                                 logger.error(f"❌ فشل المعالجة التلقائية: {file_path}")
-                                
+
                     except Exception as e:
-                        logger.error(f"❌ خطأ في المعالجة التلقائية: {e}")
\ No newline at end of file
+                        self.stats["failed"] += 1
+                        logger.error(f"❌ خطأ في المعالجة التلقائية: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "pending": len(self._pending),
+            "queued_batches": self._queue.qsize() if self._queue else 0,
+        }
@@ -0,0 +1,6 @@
+# backend/tests/conftest.py
+import os
+import sys
+
+# (الاختبارات تستورد الحزمة كما يستوردها الخادم: from app.ai_advisor...)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
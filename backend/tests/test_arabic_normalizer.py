@@ -0,0 +1,42 @@
+# backend/tests/test_arabic_normalizer.py
+from app.ai_advisor.rag.arabic_normalizer import ArabicNormalizer
+
+
+def test_normalize_letters_diacritics_and_tatweel():
+    assert ArabicNormalizer.normalize("أإآٱ") == "اااا"
+    assert ArabicNormalizer.normalize("مستشفى") == "مستشفي"
+    assert ArabicNormalizer.normalize("مادّة") == "ماده"
+    assert ArabicNormalizer.normalize("قـــانون") == "قانون"
+    assert ArabicNormalizer.normalize(None) == ""
+
+
+def test_normalize_digits():
+    assert ArabicNormalizer.normalize("المادة ١٢") == "الماده 12"
+    assert ArabicNormalizer.normalize("۱۴۴۵") == "1445"
+
+
+def test_stem_variants_share_stem():
+    normalizer = ArabicNormalizer()
+    stems = {normalizer.tokenize(word)[0] for word in ("المادة", "مادة", "مادّة", "الماده")}
+    assert len(stems) == 1
+
+
+def test_stem_keeps_digits_and_short_tokens():
+    assert ArabicNormalizer.stem("2023") == "2023"
+    assert ArabicNormalizer.stem("ال") == "ال"
+
+
+def test_tokenize_drops_stop_words():
+    tokens = ArabicNormalizer().tokenize("ما هي عقوبة التزوير في النظام")
+    assert ArabicNormalizer.stem("عقوبه") in tokens
+    assert "ما" not in tokens and "في" not in tokens
+
+
+def test_query_terms_unique_and_limited():
+    normalizer = ArabicNormalizer()
+    terms = normalizer.query_terms("العقد العقد عقد الإيجار المادة 5", max_terms=2)
+    assert terms == [normalizer.stem("عقد"), normalizer.stem("ايجار")]
+
+
+def test_normalize_for_index():
+    assert ArabicNormalizer().normalize_for_index(["", "المادة 5"]) == ["", "ماد 5"]
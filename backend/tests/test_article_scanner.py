@@ -0,0 +1,63 @@
+# backend/tests/test_article_scanner.py
+import pytest
+
+pytest.importorskip("requests")
+
+from app.ai_advisor.rag.advanced_pdf_processor import ArticleScanner
+
+
+def _scan(pages, inline=False):
+    scanner = ArticleScanner(inline=inline)
+    for page, text in enumerate(pages, start=1):
+        scanner.feed(text, page)
+    return scanner, scanner.finish()
+
+
+def test_articles_keep_their_page():
+    _, articles = _scan([
+        "المادة 1: يسري هذا النظام على جميع العاملين.\n",
+        "المادة 2: تحدد اللائحة التنفيذية الإجراءات اللازمة.\n",
+    ])
+    assert [(a.number, a.page) for a in articles] == [("1", 1), ("2", 2)]
+
+
+def test_header_split_across_pages_is_carried():
+    _, articles = _scan([
+        "المادة 1: يسري هذا النظام على جميع العاملين.\nالمادة",
+        " 2: تحدد اللائحة التنفيذية الإجراءات اللازمة.\n",
+    ])
+    assert [(a.number, a.page) for a in articles] == [("1", 1), ("2", 2)]
+    assert "المادة" not in articles[0].content
+
+
+def test_reference_at_page_end_is_not_a_header():
+    _, articles = _scan([
+        "المادة 1: يعاقب المخالف وفقاً للمادة",
+        "5 من نظام العقوبات بغرامة مالية.\n",
+    ])
+    assert [a.number for a in articles] == ["1"]
+    assert "5 من نظام العقوبات" in articles[0].content
+
+
+def test_inline_mode_does_not_carry_partial_header():
+    _, articles = _scan([
+        "المادة 1: يعاقب المخالف وفقاً للمادة",
+        "5 من نظام العقوبات بغرامة مالية.",
+    ], inline=True)
+    assert [a.number for a in articles] == ["1"]
+
+
+def test_duplicate_articles_keep_longest_content():
+    scanner, articles = _scan([
+        "المادة 3: نص قصير للمادة.\n",
+        "المادة ٣: نص أطول للمادة الثالثة يتضمن تفاصيل إضافية.\n",
+    ])
+    assert len(articles) == 1
+    assert articles[0].number == "3"
+    assert "تفاصيل إضافية" in articles[0].content
+    assert scanner.duplicates == 1
+
+
+def test_bis_articles_are_distinct():
+    _, articles = _scan(["المادة 4: الحكم الأصلي للمادة.\nالمادة 4 مكرر: حكم مضاف للمادة.\n"])
+    assert [a.number for a in articles] == ["4", "4 مكرر"]
@@ -0,0 +1,183 @@
+# backend/tests/test_ingest_manifest.py
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+from app.ai_advisor.rag.ingest_manifest import IngestManifest
+
+
+class FakeConnection:
+    """اتصال وهمي يحاكي جدولي ai_ingest_manifest و ai_legal_documents في الذاكرة"""
+
+    def __init__(self, db):
+        self.db = db
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def fetch(self, query, *args):
+        if "FROM ai_legal_documents" in query:
+            return []
+        return [dict(row) for row in self.db.manifest.values()]
+
+    async def fetchval(self, query, document_id):
+        return 1 if any(row["document_id"] == document_id for row in self.db.manifest.values()) else None
+
+    async def execute(self, query, *args):
+        query = " ".join(query.split())
+        if query.startswith("INSERT INTO ai_ingest_manifest"):
+            path, content_hash, size, mtime_ns, document_id = args
+            self.db.manifest[path] = {
+                "file_path": path, "content_hash": content_hash, "file_size": size,
+                "mtime_ns": mtime_ns, "document_id": document_id,
+            }
+        elif query.startswith("UPDATE ai_ingest_manifest"):
+            previous, path, size, mtime_ns = args
+            row = self.db.manifest.pop(previous)
+            row.update(file_path=path, file_size=size, mtime_ns=mtime_ns)
+            self.db.manifest[path] = row
+        elif query.startswith("DELETE FROM ai_ingest_manifest"):
+            self.db.manifest.pop(args[0], None)
+        elif query.startswith("DELETE FROM ai_legal_documents"):
+            self.db.deleted_documents.append(args[0])
+
+
+class FakePool:
+    def __init__(self):
+        self.manifest = {}
+        self.deleted_documents = []
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield FakeConnection(self)
+
+
+class FakeVectorDB:
+    def __init__(self):
+        self.pool = FakePool()
+
+
+def _write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content, encoding="utf-8")
+    return str(path)
+
+
+def _register(db, path, document_id):
+    """تسجيل ملف كأنه ابتُلع سابقاً"""
+    stat = os.stat(path)
+    db.pool.manifest[path] = {
+        "file_path": path, "content_hash": IngestManifest.file_hash(path),
+        "file_size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "document_id": document_id,
+    }
+
+
+def test_rename_is_moved_not_reingested(tmp_path):
+    db = FakeVectorDB()
+    old = _write(tmp_path / "laws" / "labor.txt", "قانون العمل")
+    _register(db, old, 7)
+    new = str(tmp_path / "laws" / "labor_2023.txt")
+    os.rename(old, new)
+
+    manifest = IngestManifest(db)
+    plan = asyncio.run(manifest.plan([new], scope=[str(tmp_path)]))
+
+    assert plan.to_ingest == []
+    assert plan.deleted == []
+    assert len(plan.moved) == 1
+    assert plan.moved[0].previous_path == old
+    assert plan.moved[0].document_id == 7
+
+    asyncio.run(manifest.sync(plan))
+    assert set(db.pool.manifest) == {new}
+    assert db.pool.manifest[new]["document_id"] == 7
+
+
+def test_duplicate_shares_document_id(tmp_path):
+    db = FakeVectorDB()
+    original = _write(tmp_path / "a" / "law.txt", "نظام الشركات")
+    _register(db, original, 3)
+    copy = _write(tmp_path / "b" / "law_copy.txt", "نظام الشركات")
+
+    manifest = IngestManifest(db)
+    plan = asyncio.run(manifest.plan([original, copy]))
+
+    assert plan.to_ingest == []
+    assert plan.unchanged == 1
+    assert [(c.file_path, c.document_id) for c in plan.duplicates] == [(copy, 3)]
+
+    asyncio.run(manifest.sync(plan))
+    assert db.pool.manifest[copy]["document_id"] == 3
+
+
+def test_changed_duplicate_gets_new_document(tmp_path):
+    db = FakeVectorDB()
+    original = _write(tmp_path / "a" / "law.txt", "نظام الشركات")
+    copy = _write(tmp_path / "b" / "law_copy.txt", "نظام الشركات")
+    _register(db, original, 3)
+    _register(db, copy, 3)
+    _write(tmp_path / "b" / "law_copy.txt", "نظام الشركات المعدل")
+
+    plan = asyncio.run(IngestManifest(db).plan([original, copy]))
+
+    assert len(plan.to_ingest) == 1
+    change = plan.to_ingest[0]
+    assert change.file_path == copy
+    assert change.action == IngestManifest.CHANGED
+    assert change.document_id is None
+
+
+def test_changed_file_keeps_own_document(tmp_path):
+    db = FakeVectorDB()
+    path = _write(tmp_path / "law.txt", "نظام العمل")
+    _register(db, path, 5)
+    _write(tmp_path / "law.txt", "نظام العمل المعدل")
+
+    plan = asyncio.run(IngestManifest(db).plan([path]))
+
+    assert [(c.action, c.document_id) for c in plan.to_ingest] == [(IngestManifest.CHANGED, 5)]
+
+
+def test_missing_folder_skips_gc_unless_forced(tmp_path):
+    db = FakeVectorDB()
+    root = tmp_path / "data"
+    paths = [_write(root / f"law_{i}.txt", f"قانون رقم {i}") for i in range(IngestManifest.GC_MIN_FILES + 1)]
+    for document_id, path in enumerate(paths, start=1):
+        _register(db, path, document_id)
+    for path in paths:
+        os.remove(path)
+
+    manifest = IngestManifest(db)
+    plan = asyncio.run(manifest.plan([], scope=[str(root)]))
+    assert len(plan.deleted) == len(paths)
+
+    summary = asyncio.run(manifest.sync(plan))
+    assert summary["deleted"] == 0
+    assert summary["gc_skipped"] == len(paths)
+    assert db.pool.deleted_documents == []
+    assert set(db.pool.manifest) == set(paths)
+
+    summary = asyncio.run(manifest.sync(plan, force_gc=True))
+    assert summary["deleted"] == len(paths)
+    assert summary["documents_removed"] == len(paths)
+    assert sorted(db.pool.deleted_documents) == list(range(1, len(paths) + 1))
+    assert db.pool.manifest == {}
+
+
+def test_deleted_copy_keeps_shared_document(tmp_path):
+    db = FakeVectorDB()
+    original = _write(tmp_path / "a" / "law.txt", "نظام الشركات")
+    copy = _write(tmp_path / "b" / "law_copy.txt", "نظام الشركات")
+    _register(db, original, 3)
+    _register(db, copy, 3)
+    os.remove(copy)
+
+    manifest = IngestManifest(db)
+    plan = asyncio.run(manifest.plan([original], scope=[str(tmp_path)]))
+    summary = asyncio.run(manifest.sync(plan))
+
+    assert summary["deleted"] == 1
+    assert summary["documents_removed"] == 0
+    assert db.pool.deleted_documents == []
+    assert set(db.pool.manifest) == {original}